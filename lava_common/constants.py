@@ -23,6 +23,9 @@ HTTP_DOWNLOAD_CHUNK_SIZE = 32768
 # the socket for 60s.
 HTTP_DOWNLOAD_TIMEOUT = 60
 
+# Maximum number of http resources validated concurrently
+HTTP_VALIDATE_WORKERS = 8
+
 # Size of the chunks when downloading over scp
 SCP_DOWNLOAD_CHUNK_SIZE = 32768
 
@@ -31,6 +34,11 @@ SCP_DOWNLOAD_CHUNK_SIZE = 32768
 # Files here are for download using the Apache /tmp alias.
 DISPATCHER_DOWNLOAD_DIR = "/var/lib/lava/dispatcher/tmp"
 
+# Cache of the downloaded files, shared by the jobs of the worker.
+# Kept outside of DISPATCHER_DOWNLOAD_DIR, which is served by apache, tftp
+# and nfs, so the cached files of private jobs are not exposed.
+DISPATCHER_DOWNLOAD_CACHE_DIR = "/var/lib/lava/dispatcher/worker/cache"
+
 # Distinctive prompt characters which can
 # help distinguish status messages from shell prompts.
 DISTINCTIVE_PROMPT_CHARACTERS = "\\:"
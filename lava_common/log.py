@@ -7,106 +7,407 @@
 
 import contextlib
 import datetime
+import gzip
 import logging
 import multiprocessing
+import os
+import random
+import re
 import signal
 import time
+from json import loads as json_loads
+from urllib.parse import urlencode
 
 import requests
 
 from lava_common.version import __version__
-from lava_common.yaml import yaml_safe_dump
+from lava_common.yaml import yaml_safe_dump, yaml_safe_load
+
+# Escapes used by the yaml emitter in double quoted scalars
+ESCAPES = {
+    "\0": "\\0",
+    "\x07": "\\a",
+    "\x08": "\\b",
+    "\t": "\\t",
+    "\n": "\\n",
+    "\x0b": "\\v",
+    "\x0c": "\\f",
+    "\r": "\\r",
+    "\x1b": "\\e",
+    '"': '\\"',
+    "\\": "\\\\",
+    "\x85": "\\N",
+    "\xa0": "\\_",
+    "\u2028": "\\L",
+    "\u2029": "\\P",
+}
+# Without allow_unicode, only printable ascii characters are kept as is
+ESCAPE_PATTERN = re.compile(r"[^\x20\x21\x23-\x5b\x5d-\x7e]")
+
+
+def _escape(match) -> str:
+    char = match.group()
+    escape = ESCAPES.get(char)
+    if escape is not None:
+        return escape
+    code = ord(char)
+    if code <= 0xFF:
+        return "\\x%02X" % code
+    if code <= 0xFFFF:
+        return "\\u%04X" % code
+    return "\\U%08X" % code
+
+
+def _quote(value: str) -> str:
+    # Fast path for the printable ascii strings without quotes
+    if value.isascii() and value.isprintable():
+        if '"' not in value and "\\" not in value:
+            return '"' + value + '"'
+    return '"' + ESCAPE_PATTERN.sub(_escape, value) + '"'
+
+
+def _dump(data: dict) -> str:
+    # Log records are usually made of strings only: build the line directly,
+    # as the yaml emitter would.
+    if all(type(k) is str and type(v) is str for (k, v) in data.items()):
+        return (
+            "{"
+            + ", ".join(_quote(k) + ": " + _quote(data[k]) for k in sorted(data))
+            + "}"
+        )
+    return yaml_safe_dump(
+        data, default_flow_style=True, default_style='"', width=10**6
+    )[:-1]
 
 
 def dump(data: dict) -> str:
     # Set width to a really large value in order to always get one line.
     # But keep this reasonable because the logs will be loaded by CLoader
     # that is limited to around 10**7 chars
-    data_str = yaml_safe_dump(
-        data, default_flow_style=True, default_style='"', width=10**6
-    )[:-1]
+    data_str = _dump(data)
     # Test the limit and skip if the line is too long
     if len(data_str) >= 10**6:
         if isinstance(data["msg"], str):
             data["msg"] = "<line way too long ...>"
         else:
             data["msg"] = {"skip": "line way too long ..."}
-        data_str = yaml_safe_dump(
-            data, default_flow_style=True, default_style='"', width=10**6
-        )[:-1]
+        data_str = _dump(data)
     return data_str
 
 
-def sender(conn, url: str, token: str, max_time: int) -> None:
-    HEADERS = {"User-Agent": f"lava {__version__}", "LAVA-Token": token}
-    MAX_RECORDS = 1000
-    FAILURE_SLEEP = 5
-
-    def post(session, records: list[str], index: int) -> tuple[list[str], int]:
-        # limit the number of records to send in one call
-        data, remaining = records[:MAX_RECORDS], records[MAX_RECORDS:]
+def load(data_str: str) -> dict:
+    # dump() outputs double quoted strings: when every value is a string, the
+    # line is also valid json that is way faster to parse.
+    try:
+        return json_loads(data_str)
+    except ValueError:
+        return yaml_safe_load(data_str)
+
+
+class Records:
+    """
+    Records waiting to be sent to the server, kept in memory.
+    """
+
+    def __init__(self):
+        self.records: list[str] = []
+        self.index: int = 0
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def append(self, record: str) -> None:
+        self.records.append(record)
+
+    def extend(self, records: list[str]) -> None:
+        self.records.extend(records)
+
+    def peek(self, count: int, max_size: int) -> list[str]:
+        """
+        Return the first records, limited in number and in size. At least
+        one record is returned if available.
+        """
+        size = 0
+        for index, record in enumerate(self.records[:count]):
+            size += len(record) + 1
+            if index and size > max_size:
+                return self.records[:index]
+        return self.records[:count]
+
+    def ack(self, count: int) -> None:
+        """
+        Drop the first records, acknowledged by the server.
+        """
+        del self.records[:count]
+        self.index += count
+
+    def close(self) -> None:
+        pass
+
+
+class Spool(Records):
+    """
+    Records waiting to be sent to the server, kept in an append only file.
+    The offset and the index of the first record that was not acknowledged
+    are saved in "<filename>.ack" so sending can resume after a restart.
+    """
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        self.ack_filename = f"{filename}.ack"
+        self.offset: int = 0
+        self.index: int = 0
+        with contextlib.suppress(OSError, ValueError):
+            with open(self.ack_filename, encoding="utf-8") as f_ack:
+                (offset, index) = f_ack.read().split(" ")
+                (self.offset, self.index) = (int(offset), int(index))
+        self.f_out = open(self.filename, "ab")
+        self.f_in = open(self.filename, "rb")
+        # The file was emptied after saving the offset: every record was
+        # acknowledged.
+        if self.offset > os.fstat(self.f_in.fileno()).st_size:
+            self.offset = 0
+        # Count the records that were not acknowledged
+        self.count: int = 0
+        self.f_in.seek(self.offset)
+        for _ in self.f_in:
+            self.count += 1
+        self.sizes: list[int] = []
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, record: str) -> None:
+        # Records are only made of one line
+        self.f_out.write(record.encode("utf-8", errors="replace") + b"\n")
+        self.f_out.flush()
+        self.count += 1
+
+    def extend(self, records: list[str]) -> None:
+        self.f_out.write(
+            b"".join(r.encode("utf-8", errors="replace") + b"\n" for r in records)
+        )
+        self.f_out.flush()
+        self.count += len(records)
+
+    def peek(self, count: int, max_size: int) -> list[str]:
+        records: list[str] = []
+        self.sizes = []
+        size = 0
+        self.f_in.seek(self.offset)
+        while len(records) < count:
+            line = self.f_in.readline()
+            # Skip incomplete lines
+            if not line.endswith(b"\n"):
+                break
+            size += len(line)
+            if records and size > max_size:
+                break
+            records.append(line[:-1].decode("utf-8", errors="replace"))
+            self.sizes.append(len(line))
+        return records
+
+    def ack(self, count: int) -> None:
+        self.offset += sum(self.sizes[:count])
+        self.sizes = self.sizes[count:]
+        self.index += count
+        self.count -= count
+        # Save the new offset before emptying the file, so a crash in between
+        # neither resends nor skips records.
+        self._save()
+        # Every record was sent: start again from the beginning of the file
+        if self.count == 0:
+            self.f_out.truncate(0)
+            self.offset = 0
+            self.sizes = []
+            self._save()
+
+    def _save(self) -> None:
+        tmp_filename = f"{self.ack_filename}.tmp"
+        with open(tmp_filename, "w", encoding="utf-8") as f_ack:
+            f_ack.write(f"{self.offset} {self.index}")
+        os.replace(tmp_filename, self.ack_filename)
+
+    def close(self) -> None:
+        self.f_in.close()
+        self.f_out.close()
+
+
+class Sender:
+    """
+    Send the records to the server, adapting the size of the batches to the
+    backlog and to the server latency.
+    """
+
+    # Bounds of the number of records sent in one call
+    MIN_RECORDS = 100
+    MAX_RECORDS = 10000
+    # Maximum size of the records sent in one call, before compression
+    MAX_SIZE = 2 * 1024 * 1024
+    # Send smaller batches when the server is slower than this (in seconds)
+    TARGET_LATENCY = 2
+    # Exponential backoff after failures (in seconds)
+    FAILURE_SLEEP = 1
+    FAILURE_SLEEP_MAX = 60
+
+    def __init__(self, session, url: str, token: str, stats=None, timeout=None):
+        self.session = session
+        self.url = url
+        self.timeout = timeout
+        self.headers = {
+            "User-Agent": f"lava {__version__}",
+            "LAVA-Token": token,
+            "Content-Type": "application/x-www-form-urlencoded",
+        }
+        self.stats = stats
+        self.batch: int = 1000
+        self.failures: int = 0
+        self.compress: bool = True
+
+    def post(self, records: Records) -> int | None:
+        """
+        Send the first records and return the status code, or None if the
+        server is unreachable.
+        """
+        # limit the number of records and the size of the data to send in
+        # one call
+        full = len(records) >= self.batch
+        data = records.peek(self.batch, self.MAX_SIZE)
+
+        headers = self.headers
+        body = urlencode({"records": "\n".join(data), "index": records.index})
+        body = body.encode()
+        if self.compress:
+            headers = {**self.headers, "Content-Encoding": "gzip"}
+            body = gzip.compress(body, compresslevel=1)
+
+        ret = None
+        begin = time.monotonic()
         with contextlib.suppress(requests.RequestException):
-            # Do not specify a timeout so we wait forever for an answer. This is a
-            # background process so waiting is not an issue.
-            # Will avoid resending the same request a second time if gunicorn
-            # is too slow to answer.
-            ret = session.post(
-                url,
-                data={"lines": "- " + "\n- ".join(data), "index": index},
-                headers=HEADERS,
+            # The background sender does not specify a timeout so it waits
+            # forever for an answer: waiting is not an issue and it avoids
+            # resending the same request if gunicorn is too slow to answer.
+            ret = self.session.post(
+                self.url, data=body, headers=headers, timeout=self.timeout
+            )
+        latency = time.monotonic() - begin
+
+        if ret is not None and ret.status_code == 200:
+            self.failures = 0
+            with contextlib.suppress(KeyError, ValueError):
+                count = int(ret.json()["line_count"])
+                records.ack(min(count, len(data)))
+            # Adapt the size of the batches to the server latency and to the
+            # backlog: a full batch means that the records are piling up.
+            if latency > self.TARGET_LATENCY:
+                self.batch = max(self.MIN_RECORDS, self.batch // 2)
+            elif full:
+                self.batch = min(self.MAX_RECORDS, self.batch * 2)
+        elif ret is not None and self.compress and ret.status_code == 415:
+            # The server does not accept compressed requests
+            self.compress = False
+        else:
+            # If the request fails, give some time for the server to
+            # recover from the failure.
+            self.failures += 1
+            delay = min(
+                self.FAILURE_SLEEP * 2 ** (self.failures - 1), self.FAILURE_SLEEP_MAX
             )
+            time.sleep(random.uniform(delay / 2, delay))
 
-            if ret.status_code == 200:
-                with contextlib.suppress(KeyError, ValueError):
-                    count = int(ret.json()["line_count"])
-                    data = data[count:]
-                    index += count
-            else:
-                # If the request fails, give some time for the server to
-                # recover from the failure.
-                time.sleep(FAILURE_SLEEP)
-        return (data + remaining, index)
+        if self.stats is not None:
+            self.stats[0] = len(records)
+            self.stats[1] = latency
+        return None if ret is None else ret.status_code
 
+
+def sender(conn, url: str, token: str, max_time: int, stats=None, spool=None) -> None:
+    records = Records()
+    if spool is not None:
+        with contextlib.suppress(OSError):
+            records = Spool(spool)
     last_call = time.monotonic()
-    records: list[str] = []
     leaving: bool = False
-    index: int = 0
 
     with requests.Session() as session:
+        poster = Sender(session, url, token, stats)
         while not leaving:
             # Listen for new messages if we don't have message yet or some
             # messages are already in the socket.
             if len(records) == 0 or conn.poll(max_time):
-                data = conn.recv_bytes()
+                try:
+                    data = conn.recv_bytes()
+                except EOFError:
+                    # The logger process died: send what is left
+                    data = b""
                 if data == b"":
                     leaving = True
                 else:
-                    records.append(data.decode("utf-8", errors="replace"))
+                    # Coalesced records are sent on consecutive lines
+                    records.extend(data.decode("utf-8", errors="replace").split("\n"))
 
-            records_limit = len(records) >= MAX_RECORDS
+            records_limit = len(records) >= poster.batch
             time_limit = (time.monotonic() - last_call) >= max_time
-            if records and (records_limit or time_limit):
+            if len(records) and (records_limit or time_limit):
                 last_call = time.monotonic()
                 # Send the data
-                (records, index) = post(session, records, index)
+                poster.post(records)
 
-        while records:
+        while len(records):
             # Send the data
-            (records, index) = post(session, records, index)
+            poster.post(records)
+    records.close()
+
+
+def flush_spool(url: str, token: str, spool, timeout=None) -> bool:
+    """
+    Send the records left in the spool by a sender that did not finish.
+    Return False if the server is not available and sending should be retried
+    later. Callers that cannot wait forever for the server should set a
+    timeout.
+    """
+    if not os.path.exists(spool):
+        return True
+    records = Spool(spool)
+    try:
+        with requests.Session() as session:
+            poster = Sender(session, url, token, timeout=timeout)
+            while len(records):
+                count = len(records)
+                status = poster.post(records)
+                if status is None or status >= 500:
+                    return False
+                # The records are rejected: give up
+                if poster.failures:
+                    return True
+                if status == 200 and len(records) == count:
+                    return False
+        return True
+    finally:
+        records.close()
 
 
 class HTTPHandler(logging.Handler):
-    def __init__(self, url, token, interval):
+    # Report the state of the sender at most every STATS_INTERVAL seconds, when
+    # the records are piling up or the server is slow to answer.
+    STATS_INTERVAL = 60
+    STATS_BACKLOG = 5000
+    STATS_LATENCY = 5
+
+    def __init__(self, url, token, interval, spool=None):
         super().__init__()
         self.formatter = logging.Formatter("%(message)s")
         # Create the multiprocess sender
         (reader, writer) = multiprocessing.Pipe(duplex=False)
         self.writer = writer
+        # Backlog and latency of the last request, updated by the sender
+        self.stats = multiprocessing.Array("d", 2, lock=False)
+        self.stats_reported = time.monotonic()
         # Block sigint so the sender function will not receive it.
         # TODO: block more signals?
         signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGINT])
         self.proc = multiprocessing.Process(
-            target=sender, args=(reader, url, token, interval)
+            target=sender, args=(reader, url, token, interval, self.stats, spool)
         )
         self.proc.start()
         signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGINT])
@@ -117,8 +418,36 @@ class HTTPHandler(logging.Handler):
         # This can't happen as data is a dictionary dumped in yaml format
         if data == "":
             return
+        # Send the level and the date outside of the payload so the server
+        # only has to parse the lines that it should act upon.
+        lvl = getattr(record, "lvl", record.levelname.lower())
+        dt = getattr(record, "dt", None)
+        if dt is None:
+            dt = datetime.datetime.utcfromtimestamp(record.created).isoformat()
+        # A record can hold many lines (see YAMLLogger.log_lines)
+        if "\n" in data:
+            data = "\n".join(f"{lvl} {dt} {line}" for line in data.split("\n"))
+        else:
+            data = f"{lvl} {dt} {data}"
         self.writer.send_bytes(data.encode("utf-8", errors="replace"))
 
+    def stats_message(self):
+        """
+        Return a message describing the sender state if the logs are not
+        sent fast enough.
+        """
+        now = time.monotonic()
+        if now - self.stats_reported < self.STATS_INTERVAL:
+            return None
+        (backlog, latency) = self.stats
+        if backlog < self.STATS_BACKLOG and latency < self.STATS_LATENCY:
+            return None
+        self.stats_reported = now
+        return "Slow log ingestion: %d lines waiting, last request took %.1fs" % (
+            backlog,
+            latency,
+        )
+
     def close(self):
         super().close()
 
@@ -134,8 +463,8 @@ class YAMLLogger(logging.Logger):
         self.markers = {}
         self.line = 0
 
-    def addHTTPHandler(self, url, token, interval):
-        self.handler = HTTPHandler(url, token, interval)
+    def addHTTPHandler(self, url, token, interval, spool=None):
+        self.handler = HTTPHandler(url, token, interval, spool)
         self.addHandler(self.handler)
         return self.handler
 
@@ -160,7 +489,32 @@ class YAMLLogger(logging.Logger):
             data["ns"] = kwargs["namespace"]
 
         data_str = dump(data)
-        self._log(level, data_str, ())
+        self._log(level, data_str, (), extra={"lvl": level_name, "dt": data["dt"]})
+        self.log_stats()
+
+    def log_lines(self, level, level_name, lines, **kwargs):
+        """
+        Log every line as a record of its own, with the same date, but hand
+        them to the handlers at once. The line count is the same as logging
+        them one by one.
+        """
+        if not lines:
+            return
+        self.line += len(lines)
+        data = {"dt": datetime.datetime.utcnow().isoformat(), "lvl": level_name}
+        if level_name == "feedback" and "namespace" in kwargs:
+            data["ns"] = kwargs["namespace"]
+
+        data_str = "\n".join(dump({**data, "msg": line}) for line in lines)
+        self._log(level, data_str, (), extra={"lvl": level_name, "dt": data["dt"]})
+        self.log_stats()
+
+    def log_stats(self):
+        # Make slow log ingestion visible in the logs
+        if self.handler is not None:
+            message = self.handler.stats_message()
+            if message is not None:
+                self.log_message(logging.WARNING, "warning", message)
 
     def exception(self, exc, *args, **kwargs):
         self.log_message(logging.ERROR, "exception", exc, *args, **kwargs)
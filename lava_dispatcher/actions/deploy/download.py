@@ -10,21 +10,25 @@
 # python2 only
 
 import contextlib
-import hashlib
+import fcntl
 import math
 import os
 import pathlib
 import shutil
 import subprocess  # nosec - verified.
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote_plus, urlparse
 
 import requests
 
 from lava_common.constants import (
+    DISPATCHER_DOWNLOAD_CACHE_DIR,
     FILE_DOWNLOAD_CHUNK_SIZE,
     HTTP_DOWNLOAD_CHUNK_SIZE,
     HTTP_DOWNLOAD_TIMEOUT,
+    HTTP_VALIDATE_WORKERS,
     SCP_DOWNLOAD_CHUNK_SIZE,
 )
 from lava_common.exceptions import InfrastructureError, JobError, LAVABug
@@ -37,7 +41,10 @@ from lava_dispatcher.connections.serial import ConnectDevice
 from lava_dispatcher.logical import Deployment, RetryAction
 from lava_dispatcher.power import ResetDevice
 from lava_dispatcher.protocols.lxc import LxcProtocol
-from lava_dispatcher.utils.compression import untar_file
+from lava_dispatcher.utils.cache import DownloadCache, copy_file, is_sha256
+from lava_dispatcher.utils.checksums import ALGORITHMS as CHECKSUM_ALGORITHMS
+from lava_dispatcher.utils.checksums import Checksums
+from lava_dispatcher.utils.compression import parallel_command, untar_file
 from lava_dispatcher.utils.filesystem import (
     copy_overlay_to_lxc,
     copy_to_lxc,
@@ -45,6 +52,11 @@ from lava_dispatcher.utils.filesystem import (
 )
 from lava_dispatcher.utils.network import requests_retry
 
+# fcntl.F_SETPIPE_SZ is only defined since python 3.10
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+# Size of the pipe to the decompression command
+DECOMPRESS_PIPE_SIZE = 1024 * 1024
+
 
 class DownloaderAction(RetryAction):
     """
@@ -63,6 +75,7 @@ class DownloaderAction(RetryAction):
         self.path = path  # where to download
         self.uniquify = uniquify
         self.params = params
+        self.prefetched = False
 
     def populate(self, parameters):
         self.pipeline = Pipeline(parent=self, job=self.job, parameters=parameters)
@@ -107,6 +120,149 @@ class DownloaderAction(RetryAction):
         if overlays:
             self.pipeline.add_action(AppendOverlays(self.key, params=self.params))
 
+    def run(self, connection, max_end_time):
+        if not self.prefetched:
+            self.prefetch()
+        return super().run(connection, max_end_time)
+
+    def prefetch(self):
+        """
+        Start downloading the resources of the sibling download actions in
+        the background. Each action then reads its data in turn, so the
+        logs, checksums and namespace data are the same as downloading one
+        resource after the other.
+        """
+        concurrency = int(
+            self.job.parameters.get("dispatcher", {}).get("parallel_downloads", 1)
+        )
+        siblings = [
+            action
+            for action in find_pipeline(self.job.pipeline, self)
+            if isinstance(action, DownloaderAction) and not action.prefetched
+        ]
+        for action in siblings:
+            action.prefetched = True
+        if concurrency <= 1:
+            return
+
+        handlers = [
+            action.pipeline.actions[0]
+            for action in siblings
+            if action.pipeline.actions[0].parallel
+        ]
+        if len(handlers) < 2:
+            return
+        self.logger.info(
+            "Downloading %d resources, %d at a time", len(handlers), concurrency
+        )
+        tmp_dir = self.job.mkdtemp("download-prefetch")
+        semaphore = threading.Semaphore(concurrency)
+        for index, handler in enumerate(handlers):
+            # Do not download the resources that are already cached
+            cache = handler.download_cache()
+            if cache is not None and cache.lookup(
+                handler.cache_key(), handler.params.get("sha256sum")
+            ):
+                continue
+            handler.prefetch = Prefetch(
+                handler.reader,
+                os.path.join(tmp_dir, f"{index}-{handler.key}"),
+                semaphore,
+            )
+
+
+def find_pipeline(pipeline, action):
+    """
+    Return the list of actions of the pipeline that holds the given action.
+    """
+    if pipeline is None:
+        return []
+    if action in pipeline.actions:
+        return pipeline.actions
+    for child in pipeline.actions:
+        actions = find_pipeline(child.pipeline, action)
+        if actions:
+            return actions
+    return []
+
+
+def iter_actions(pipeline):
+    """
+    Return every action of the pipeline, including the sub-pipelines.
+    """
+    if pipeline is None:
+        return
+    for action in pipeline.actions:
+        yield action
+        yield from iter_actions(action.pipeline)
+
+
+class Prefetch:
+    """
+    Download a resource in a background thread, into a temporary file that
+    can be read while the download is running.
+    """
+
+    def __init__(self, reader, filename, semaphore):
+        self.filename = filename
+        self.condition = threading.Condition()
+        self.size = 0
+        self.done = False
+        self.exc = None
+        self.cancelled = False
+        # Create the file now, the download might have to wait for its turn
+        open(filename, "wb").close()
+        self.thread = threading.Thread(
+            target=self._download, args=(reader, semaphore), daemon=True
+        )
+        self.thread.start()
+
+    def _download(self, reader, semaphore):
+        try:
+            with semaphore:
+                with open(self.filename, "ab") as f_out:
+                    for buff in reader():
+                        if self.cancelled:
+                            return
+                        f_out.write(buff)
+                        f_out.flush()
+                        with self.condition:
+                            self.size += len(buff)
+                            self.condition.notify_all()
+        except Exception as exc:
+            with self.condition:
+                self.exc = exc
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def cancel(self):
+        self.cancelled = True
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.filename)
+
+    def reader(self):
+        offset = 0
+        try:
+            with open(self.filename, "rb") as f_in:
+                while True:
+                    with self.condition:
+                        # Wake up regularly to let the timeouts fire
+                        while self.size == offset and not self.done:
+                            self.condition.wait(1)
+                        (size, done, exc) = (self.size, self.done, self.exc)
+                    if offset < size:
+                        buff = f_in.read(min(size - offset, HTTP_DOWNLOAD_CHUNK_SIZE))
+                        offset += len(buff)
+                        yield buff
+                    elif exc is not None:
+                        raise exc
+                    elif done:
+                        return
+        finally:
+            self.cancel()
+
 
 class DownloadHandler(Action):
     """
@@ -123,6 +279,8 @@ class DownloadHandler(Action):
     description = "download action"
     summary = "download-action"
     timeout_exception = InfrastructureError
+    # Remote resources can be downloaded in parallel
+    parallel = False
 
     # Supported decompression commands
     decompress_command_map = {
@@ -144,11 +302,63 @@ class DownloadHandler(Action):
             self.path = os.path.join(path, key)
         self.fname = None
         self.params = params
+        self.prefetch = None
 
     def reader(self):
         raise LAVABug("'reader' function unimplemented")
 
+    def open_reader(self):
+        """
+        Return the data of the resource, downloaded in the background when
+        the downloads are parallel. The background download is only used
+        once: retries download the resource again.
+        """
+        (prefetch, self.prefetch) = (self.prefetch, None)
+        if prefetch is not None:
+            return prefetch.reader()
+        return self.reader()
+
+    def cache_key(self):
+        """
+        Key of the resource in the download cache, None if the resource
+        should not be cached.
+        """
+        return None
+
+    def download_cache(self):
+        size = self.job.parameters.get("dispatcher", {}).get("download_cache_size")
+        if not size:
+            return None
+        try:
+            return DownloadCache(DISPATCHER_DOWNLOAD_CACHE_DIR, int(size) * 1024 * 1024)
+        except OSError as exc:
+            self.logger.warning("Download cache not available: %s", exc)
+            return None
+
+    def update_cache_stats(self, hit, size):
+        stats = self.get_namespace_data(
+            action="download-action", label="cache", key="stats"
+        ) or {"hits": 0, "misses": 0, "saved": 0}
+        if hit:
+            stats["hits"] += 1
+            stats["saved"] += size
+        else:
+            stats["misses"] += 1
+        self.set_namespace_data(
+            action="download-action", label="cache", key="stats", value=stats
+        )
+        self.logger.info(
+            "Download cache: %s, %d hit(s), %d miss(es), %d MB saved",
+            "hit" if hit else "miss",
+            stats["hits"],
+            stats["misses"],
+            stats["saved"] / (1024 * 1024),
+        )
+
     def cleanup(self, connection):
+        if self.prefetch is not None:
+            self.prefetch.cancel()
+            self.prefetch = None
         if os.path.exists(self.path):
             self.logger.debug("Cleaning up download directory: %s", self.path)
             shutil.rmtree(self.path)
@@ -269,9 +479,6 @@ class DownloadHandler(Action):
 
         connection = super().run(connection, max_end_time)
         # self.cookies = self.job.context.config.lava_cookies  # FIXME: work out how to restore
-        md5 = hashlib.md5()  # nosec - not being used for cryptography.
-        sha256 = hashlib.sha256()
-        sha512 = hashlib.sha512()
 
         # Create a fresh directory if the old one has been removed by a previous cleanup
         # (when retrying inside a RetryAction)
@@ -291,9 +498,7 @@ class DownloadHandler(Action):
             value=bool(compression),
         )
 
-        md5sum = self.params.get("md5sum")
         sha256sum = self.params.get("sha256sum")
-        sha512sum = self.params.get("sha512sum")
 
         if os.path.isdir(self.fname):
             raise JobError("Download '%s' is a directory, not a file" % self.fname)
@@ -322,7 +527,9 @@ class DownloadHandler(Action):
             if compression in self.decompress_command_map:
                 decompress_command = self.decompress_command_map[compression]
                 self.logger.info(
-                    "Using %s to decompress %s", decompress_command, compression
+                    "Using %s to decompress %s",
+                    " ".join(parallel_command([decompress_command])),
+                    compression,
                 )
             else:
                 self.logger.info(
@@ -333,33 +540,97 @@ class DownloadHandler(Action):
             self.logger.debug("No compression specified")
 
         def update_progress(buff):
-            nonlocal downloaded_size, last_value, md5, sha256, sha512
+            nonlocal downloaded_size, last_value
             downloaded_size += len(buff)
             (printing, new_value, msg) = progress(downloaded_size, last_value)
             if printing:
                 last_value = new_value
                 self.logger.debug(msg)
-            md5.update(buff)
-            sha256.update(buff)
-            sha512.update(buff)
+            checksums.update(buff)
 
-        if compression and decompress_command:
-            try:
+        def download(reader):
+            if compression and decompress_command:
+                try:
+                    with open(self.fname, "wb") as dwnld_file:
+                        self.run_download_decompression_subprocess(
+                            dwnld_file,
+                            update_progress,
+                            decompress_command,
+                            reader,
+                        )
+                except OSError as exc:
+                    msg = f"Unable to open {self.fname}: {exc.strerror}"
+                    self.logger.error(msg)
+                    raise InfrastructureError(msg)
+            else:
                 with open(self.fname, "wb") as dwnld_file:
-                    self.run_download_decompression_subprocess(
-                        dwnld_file,
-                        update_progress,
-                        decompress_command,
+                    for buff in reader():
+                        update_progress(buff)
+                        dwnld_file.write(buff)
+
+        # Concurrent jobs of the worker download each resource only once
+        cache = None
+        cache_key = self.cache_key()
+        cache_sha256 = sha256sum if is_sha256(sha256sum) else None
+        if cache_key is not None or cache_sha256 is not None:
+            cache = self.download_cache()
+        cache_lock = contextlib.nullcontext()
+        if cache is not None:
+            cache_lock = cache.lock(cache_key or cache_sha256)
+
+        # Only compute the checksums requested by the job
+        copied = False
+        with cache_lock, Checksums.from_params(self.params) as checksums:
+            entry = None
+            if cache is not None:
+                entry = cache.lookup(cache_key, cache_sha256)
+            if (
+                entry is not None
+                and not decompress_command
+                and all(name in entry for name in checksums.hashes)
+            ):
+                try:
+                    copy_file(entry["path"], self.fname)
+                    downloaded_size = entry["size"]
+                    copied = True
+                except FileNotFoundError:
+                    # Evicted in the meantime
+                    entry = None
+            elif entry is not None:
+
+                def cache_reader():
+                    with open(entry["path"], "rb") as f_in:
+                        while buff := f_in.read(FILE_DOWNLOAD_CHUNK_SIZE):
+                            yield buff
+
+                download(cache_reader)
+
+            if entry is None and cache is not None:
+                tmp = cache.tmp_file()
+                try:
+
+                    def tee_reader():
+                        for buff in self.open_reader():
+                            tmp.write(buff)
+                            yield buff
+
+                    download(tee_reader)
+                    tmp.close()
+                    self.check_size(downloaded_size)
+                    cache.add(
+                        tmp.name,
+                        cache_key,
+                        {"size": downloaded_size, **checksums.hexdigests()},
                     )
-            except OSError as exc:
-                msg = f"Unable to open {self.fname}: {exc.strerror}"
-                self.logger.error(msg)
-                raise InfrastructureError(msg)
-        else:
-            with open(self.fname, "wb") as dwnld_file:
-                for buff in self.reader():
-                    update_progress(buff)
-                    dwnld_file.write(buff)
+                finally:
+                    tmp.close()
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(tmp.name)
+            elif entry is None:
+                download(self.open_reader)
+
+        if cache is not None:
+            self.update_cache_stats(entry is not None, downloaded_size)
 
         # Log the download speed
         ending = time.monotonic()
@@ -370,14 +641,12 @@ class DownloadHandler(Action):
             round(downloaded_size / (1024 * 1024 * (ending - beginning)), 2),
         )
 
-        # If the remote server uses "Content-Encoding: gzip", this calculation will be wrong
-        # because requests will decompress the file on the fly, creating a larger file than
-        # LAVA expects.
-        if self.size > 0 and self.size != downloaded_size:
-            raise InfrastructureError(
-                "Download finished (%i bytes) but was not expected size (%i bytes), check your networking."
-                % (downloaded_size, self.size)
-            )
+        self.check_size(downloaded_size)
+
+        # The checksums of a file copied from the cache are not computed again
+        digests = checksums.hexdigests()
+        if copied:
+            digests = {name: entry[name] for name in digests}
 
         # set the dynamic data into the context
         self.set_namespace_data(
@@ -386,21 +655,10 @@ class DownloadHandler(Action):
         self.set_namespace_data(
             action="download-action", label="file", key=self.key, value=self.fname
         )
-        self.set_namespace_data(
-            action="download-action", label=self.key, key="md5", value=md5.hexdigest()
-        )
-        self.set_namespace_data(
-            action="download-action",
-            label=self.key,
-            key="sha256",
-            value=sha256.hexdigest(),
-        )
-        self.set_namespace_data(
-            action="download-action",
-            label=self.key,
-            key="sha512",
-            value=sha512.hexdigest(),
-        )
+        for name, value in digests.items():
+            self.set_namespace_data(
+                action="download-action", label=self.key, key=name, value=value
+            )
 
         # handle archive files
         archive = self.params.get("archive")
@@ -424,9 +682,9 @@ class DownloadHandler(Action):
                 value=target_fname_path,
             )
 
-        self._check_checksum("md5", md5.hexdigest(), md5sum)
-        self._check_checksum("sha256", sha256.hexdigest(), sha256sum)
-        self._check_checksum("sha512", sha512.hexdigest(), sha512sum)
+        for key, name in CHECKSUM_ALGORITHMS.items():
+            if name in digests:
+                self._check_checksum(name, digests[name], self.params.get(key))
 
         # certain deployments need prefixes set
         if self.parameters["to"] == "tftp" or self.parameters["to"] == "nbd":
@@ -457,37 +715,37 @@ class DownloadHandler(Action):
         if "lava-xnbd" in self.parameters and nbdroot:
             self.parameters["lava-xnbd"]["nbdroot"] = nbdroot
 
-        self.results = {
-            "label": self.key,
-            "size": downloaded_size,
-            "md5sum": str(
-                self.get_namespace_data(
-                    action="download-action", label=self.key, key="md5"
-                )
-            ),
-            "sha256sum": str(
-                self.get_namespace_data(
-                    action="download-action", label=self.key, key="sha256"
-                )
-            ),
-            "sha512sum": str(
-                self.get_namespace_data(
-                    action="download-action", label=self.key, key="sha512"
-                )
-            ),
-        }
+        self.results = {"label": self.key, "size": downloaded_size}
+        for key, name in CHECKSUM_ALGORITHMS.items():
+            if name in digests:
+                self.results = {key: digests[name]}
         return connection
 
+    def check_size(self, downloaded_size):
+        # If the remote server uses "Content-Encoding: gzip", this calculation will be wrong
+        # because requests will decompress the file on the fly, creating a larger file than
+        # LAVA expects.
+        if self.size > 0 and self.size != downloaded_size:
+            raise InfrastructureError(
+                "Download finished (%i bytes) but was not expected size (%i bytes), check your networking."
+                % (downloaded_size, self.size)
+            )
+
     def run_download_decompression_subprocess(
-        self, dwnld_file, update_progress, decompress_command
+        self, dwnld_file, update_progress, decompress_command, reader=None
     ) -> None:
+        if reader is None:
+            reader = self.reader
         with subprocess.Popen(
-            [decompress_command],
+            parallel_command([decompress_command]),
             stdin=subprocess.PIPE,
             stdout=dwnld_file,
             stderr=subprocess.PIPE,
         ) as proc:
-            for buff in self.reader():
+            # A larger pipe keeps the decoder busy while downloading
+            with contextlib.suppress(OSError):
+                fcntl.fcntl(proc.stdin.fileno(), F_SETPIPE_SZ, DECOMPRESS_PIPE_SIZE)
+            for buff in reader():
                 update_progress(buff)
                 try:
                     proc.stdin.write(buff)
@@ -554,6 +812,61 @@ class HttpDownloadAction(DownloadHandler):
     name = "http-download"
     description = "use http to download the file"
     summary = "http download"
+    parallel = True
+
+    def __init__(self, key, path, url, uniquify=True, params=None):
+        super().__init__(key, path, url, uniquify, params)
+        self.etag = None
+        self.last_modified = None
+        # (url, future) of the request started by validate_urls()
+        self.validation = None
+
+    def validation_request(self):
+        """
+        Return the url and the headers used to check that the resource exists.
+        """
+        url = self.url.geturl()
+        http_cache = self.job.parameters["dispatcher"].get("http_url_format_string", "")
+        if http_cache:
+            url = http_cache % quote_plus(url)
+        return (url, self.validation_headers())
+
+    def validation_headers(self):
+        headers = {"Accept-Encoding": ""}
+        if self.params and "headers" in self.params:
+            headers.update(self.params["headers"])
+        return headers
+
+    def validate_urls(self):
+        """
+        Start checking the resources of the other http download actions of the
+        job in a pool of threads, sharing the connections to each server.
+        The results are used when the actions are validated in turn.
+        """
+        actions = [
+            action
+            for action in iter_actions(self.job.pipeline)
+            if isinstance(action, HttpDownloadAction)
+            and action is not self
+            and action.validation is None
+        ]
+        if not actions:
+            return
+        session = requests_retry()
+        executor = ThreadPoolExecutor(
+            max_workers=min(len(actions), HTTP_VALIDATE_WORKERS)
+        )
+        for action in actions:
+            try:
+                (url, headers) = action.validation_request()
+            except TypeError:
+                # Reported by the validation of the action
+                continue
+            action.validation = (
+                url,
+                executor.submit(check_url, session, url, headers),
+            )
+        executor.shutdown(wait=False)
 
     def validate(self):
         super().validate()
@@ -571,37 +884,27 @@ class HttpDownloadAction(DownloadHandler):
                     self.errors = "Invalid http_url_format_string: '%s'" % str(exc)
                     return
 
-            headers = {"Accept-Encoding": ""}
-            if self.params and "headers" in self.params:
-                headers.update(self.params["headers"])
             self.logger.debug("Validating that %s exists", self.url.geturl())
-            # Force the non-use of Accept-Encoding: gzip, this will permit to know the final size
-            res = requests_retry().head(
-                self.url.geturl(),
-                allow_redirects=True,
-                headers=headers,
-                timeout=HTTP_DOWNLOAD_TIMEOUT,
-            )
-            if res.status_code != requests.codes.OK:
-                # try using (the slower) get for services with broken redirect support
+            (validation, self.validation) = (self.validation, None)
+            if validation is not None and validation[0] == self.url.geturl():
+                (res, head) = validation[1].result()
+            else:
+                self.validate_urls()
+                (res, head) = check_url(
+                    requests_retry(), self.url.geturl(), self.validation_headers()
+                )
+            if not head:
                 self.logger.debug("Using GET because HEAD is not supported properly")
-                res.close()
-                # Like for HEAD, we need get a size, so disable gzip
-                res = requests_retry().get(
+            if res.status_code != requests.codes.OK:
+                self.errors = "Resource unavailable at '%s' (%d)" % (
                     self.url.geturl(),
-                    allow_redirects=True,
-                    stream=True,
-                    headers=headers,
-                    timeout=HTTP_DOWNLOAD_TIMEOUT,
+                    res.status_code,
                 )
-                if res.status_code != requests.codes.OK:
-                    self.errors = "Resource unavailable at '%s' (%d)" % (
-                        self.url.geturl(),
-                        res.status_code,
-                    )
-                    return
+                return
 
             self.size = int(res.headers.get("content-length", -1))
+            self.etag = res.headers.get("etag")
+            self.last_modified = res.headers.get("last-modified")
         except requests.Timeout:
             self.logger.error("Request timed out")
             self.errors = "'%s' timed out" % (self.url.geturl())
@@ -612,6 +915,9 @@ class HttpDownloadAction(DownloadHandler):
             if res is not None:
                 res.close()
 
+    def cache_key(self):
+        return DownloadCache.url_key(self.url.geturl(), self.etag, self.last_modified)
+
     def reader(self):
         res = None
         try:
@@ -643,6 +949,33 @@ class HttpDownloadAction(DownloadHandler):
                 res.close()
 
 
+def check_url(session, url, headers):
+    """
+    Check that the url exists, using HEAD or, for the services with broken
+    redirect support, GET. Return the closed response and whether HEAD was
+    used.
+    """
+    # Force the non-use of Accept-Encoding: gzip, this will permit to know the final size
+    res = session.head(
+        url, allow_redirects=True, headers=headers, timeout=HTTP_DOWNLOAD_TIMEOUT
+    )
+    if res.status_code == requests.codes.OK:
+        res.close()
+        return (res, True)
+    # try using (the slower) get for services with broken redirect support
+    res.close()
+    # Like for HEAD, we need get a size, so disable gzip
+    res = session.get(
+        url,
+        allow_redirects=True,
+        stream=True,
+        headers=headers,
+        timeout=HTTP_DOWNLOAD_TIMEOUT,
+    )
+    res.close()
+    return (res, False)
+
+
 class ScpDownloadAction(DownloadHandler):
     """
     Download a resource over scp
@@ -651,6 +984,7 @@ class ScpDownloadAction(DownloadHandler):
     name = "scp-download"
     description = "Use scp to copy the file"
     summary = "scp download"
+    parallel = True
 
     def validate(self):
         super().validate()
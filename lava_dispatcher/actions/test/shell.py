@@ -37,6 +37,111 @@ def handle_testcase(params):
     return data
 
 
+class SignalSearcher:
+    """
+    pexpect searcher for the test shell patterns.
+
+    The patterns of the LAVA signal protocol all start with "<LAVA_". They are
+    combined in a single expression, anchored at each occurrence of this
+    prefix, and only the data received since the last search is scanned.
+    A candidate that does not match yet is scanned again with the next data
+    until it matches or leaves the search window.
+
+    The other patterns, like the test case result pattern of the test
+    definitions, are searched in the whole search window, like pexpect does.
+    """
+
+    PREFIX = "<LAVA_"
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.eof_index = -1
+        self.timeout_index = -1
+        for index, pattern in enumerate(patterns):
+            if pattern is pexpect.EOF:
+                self.eof_index = index
+            elif pattern is pexpect.TIMEOUT:
+                self.timeout_index = index
+        # The patterns are compiled by the first search, inside expect(), so
+        # that invalid expressions are reported like pexpect does.
+        self.signals = None
+        self.others = None
+        self.combined = None
+        # Number of characters, from the end of the last searched buffer,
+        # that should be scanned again
+        self.lookback = len(self.PREFIX) - 1
+        self.start = None
+        self.end = None
+        self.match = None
+
+    def compile(self):
+        self.signals = {}
+        self.others = []
+        for index, pattern in enumerate(self.patterns):
+            if index in [self.eof_index, self.timeout_index]:
+                continue
+            if isinstance(pattern, str) and pattern.startswith(self.PREFIX):
+                self.signals[f"lava{index}"] = (index, re.compile(pattern, re.DOTALL))
+            else:
+                if isinstance(pattern, str):
+                    pattern = re.compile(pattern, re.DOTALL)
+                self.others.append((index, pattern))
+        if self.signals:
+            self.combined = re.compile(
+                "|".join(
+                    f"(?P<{name}>{pattern.pattern})"
+                    for name, (_, pattern) in self.signals.items()
+                ),
+                re.DOTALL,
+            )
+
+    def search(self, buffer, freshlen, searchwindowsize=None):
+        if self.signals is None:
+            self.compile()
+        searchstart = 0
+        if searchwindowsize is not None:
+            searchstart = max(0, len(buffer) - searchwindowsize)
+        fresh = len(buffer) - freshlen
+        # Everything is new on the first search of each expect()
+        if fresh <= searchstart:
+            start = searchstart
+        else:
+            start = max(searchstart, fresh - self.lookback)
+
+        best = None
+        pending = None
+        if self.combined is not None:
+            pos = buffer.find(self.PREFIX, start)
+            while pos >= 0:
+                match = self.combined.match(buffer, pos)
+                if match is not None:
+                    (index, pattern) = self.signals[match.lastgroup]
+                    best = (pos, index, pattern.match(buffer, pos))
+                    break
+                # Whether more data can complete this candidate is not known:
+                # keep it until the search window drops it.
+                if pending is None:
+                    pending = pos
+                pos = buffer.find(self.PREFIX, pos + 1)
+
+        for index, pattern in self.others:
+            match = pattern.search(buffer, searchstart)
+            if match is None:
+                continue
+            if best is None or (match.start(), index) < best[:2]:
+                best = (match.start(), index, match)
+
+        if best is None:
+            if pending is None:
+                pending = len(buffer) - len(self.PREFIX) + 1
+            self.lookback = len(buffer) - max(pending, 0)
+            return -1
+        (self.start, index, self.match) = best
+        self.end = self.match.end()
+        self.lookback = len(self.PREFIX) - 1
+        return index
+
+
 class TestShell(LavaTest):
     """
     LavaTestShell Strategy object
@@ -161,6 +266,7 @@ class TestShellAction(Action):
         # noinspection PyTypeChecker
         self.pattern = PatternFixup(testdef=None, count=0)
         self.current_run = None
+        self.searcher = None
 
     def _reset_patterns(self):
         # Extend the list of patterns when creating subclasses.
@@ -670,7 +776,10 @@ class TestShellAction(Action):
             self.logger.info(
                 "Test case result pattern: %r" % self.patterns["test_case_results"]
             )
-        retval = test_connection.expect(list(self.patterns.values()), timeout=timeout)
+        patterns = list(self.patterns.values())
+        if self.searcher is None or self.searcher.patterns != patterns:
+            self.searcher = SignalSearcher(patterns)
+        retval = test_connection.expect_searcher(self.searcher, timeout=timeout)
         return self.check_patterns(
             list(self.patterns.keys())[retval], test_connection, check_char
         )
@@ -19,6 +19,7 @@ from lava_common.exceptions import (
     LAVABug,
     TestError,
 )
+from lava_common.log import YAMLLogger
 from lava_common.timeout import Timeout
 from lava_dispatcher.action import Action
 from lava_dispatcher.connection import Connection
@@ -31,38 +32,39 @@ class ShellLogger:
     using the logfile support built into pexpect.
     """
 
+    # Control characters removed from the output and double quotes escaped
+    # for YAML syntax
+    TRANSLATION = str.maketrans({"\r": None, '"': '\\"', "\x1b": None})
+
     def __init__(self, logger):
         self.line = ""
         self.logger = logger
         self.is_feedback = False
+        self.namespace = None
 
     def write(self, new_line):
-        replacements = {
-            "\n\n": "\n",  # double lines to single
-            "\r": "",
-            '"': '\\"',  # escape double quotes for YAML syntax
-            "\x1b": "",  # remove escape control characters
-        }
-        for key, value in replacements.items():
-            new_line = new_line.replace(key, value)
-        lines = self.line + new_line
-
-        # Print one full line at a time. A partial line is kept in memory.
-        if "\n" in lines:
-            last_ret = lines.rindex("\n")
-            self.line = lines[last_ret + 1 :]
-            lines = lines[:last_ret]
-            for line in lines.split("\n"):
-                if self.is_feedback:
-                    if self.namespace:
-                        self.logger.feedback(line, namespace=self.namespace)
-                    else:
-                        self.logger.feedback(line)
-                else:
-                    self.logger.target(line)
+        # double lines to single
+        new_line = new_line.replace("\n\n", "\n").translate(self.TRANSLATION)
+
+        # Print full lines only. A partial line is kept in memory.
+        lines = (self.line + new_line).split("\n")
+        self.line = lines.pop()
+        if not lines:
+            return
+
+        kwargs = {}
+        level_name = "target"
+        if self.is_feedback:
+            level_name = "feedback"
+            if self.namespace:
+                kwargs["namespace"] = self.namespace
+
+        if isinstance(self.logger, YAMLLogger):
+            # Coalesce the lines: each line is still a record of its own
+            self.logger.log_lines(logging.INFO, level_name, lines, **kwargs)
         else:
-            self.line = lines
-        return
+            for line in lines:
+                getattr(self.logger, level_name)(line, **kwargs)
 
     def flush(self, force=False):
         if force and self.line:
@@ -161,8 +163,18 @@ class ShellCommand(pexpect.spawn):
         No point doing explicit logging here, the SignalDirector can help
         the TestShellAction make much more useful reports of what was matched
         """
+        return self._expect(super().expect, *args, **kw)
+
+    def expect_searcher(self, searcher, timeout=-1):
+        """
+        Like expect() but with a pexpect searcher object, like the
+        SignalSearcher of the TestShellAction, instead of a list of patterns.
+        """
+        return self._expect(self.expect_loop, searcher, timeout=timeout)
+
+    def _expect(self, func, *args, **kw):
         try:
-            proc = super().expect(*args, **kw)
+            proc = func(*args, **kw)
         except re_error as exc:
             msg = f"Invalid regular expression '{exc.pattern}': {exc.msg}"
             raise TestError(msg)
@@ -0,0 +1,161 @@
+# Copyright (C) 2023 Linaro Limited
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+from pathlib import Path
+
+# ioctl cloning a file on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def is_sha256(value):
+    return isinstance(value, str) and re.fullmatch("[0-9a-f]{64}", value) is not None
+
+
+def copy_file(src, dst):
+    """
+    Copy src to dst, sharing the data blocks when the filesystem allows it.
+    """
+    with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        with contextlib.suppress(OSError):
+            fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+            return
+    shutil.copyfile(src, dst)
+
+
+class DownloadCache:
+    """
+    Cache of the downloaded files, shared by every lava-run process of the
+    worker.
+
+    The files are stored in "data/" under their sha256, with their checksums
+    in "data/<sha256>.json". Urls are mapped to the sha256 of their content
+    in "urls/", keyed by the url and the ETag and Last-Modified headers.
+    The least recently used files are removed when the cache is bigger than
+    max_size. The lock files, in "locks/", are removed at the same time when
+    they are not held.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = Path(path)
+        self.max_size = max_size
+        for name in ["data", "locks", "tmp", "urls"]:
+            (self.path / name).mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def url_key(cls, url, etag, last_modified):
+        """
+        Return the key of the given url, or None if the content of the url
+        cannot be identified.
+        """
+        if not etag and not last_modified:
+            return None
+        data = f"{url}\n{etag or ''}\n{last_modified or ''}"
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        """
+        Lock shared by every process using the cache.
+        """
+        path = self.path / "locks" / name
+        while True:
+            with open(path, "a") as f_lock:
+                fcntl.flock(f_lock, fcntl.LOCK_EX)
+                # The lock file was removed by evict() in the meantime: lock
+                # the new one instead.
+                try:
+                    locked = os.stat(path).st_ino == os.fstat(f_lock.fileno()).st_ino
+                except FileNotFoundError:
+                    locked = False
+                if not locked:
+                    continue
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f_lock, fcntl.LOCK_UN)
+                return
+
+    def _remove_locks(self):
+        """
+        Remove the lock files that are not held by any process.
+        """
+        for path in (self.path / "locks").iterdir():
+            if path.name == "evict":
+                continue
+            with contextlib.suppress(OSError), open(path, "a") as f_lock:
+                fcntl.flock(f_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                path.unlink()
+
+    def lookup(self, key=None, sha256=None):
+        """
+        Return the metadata of the cached file or None. The metadata
+        contains the path, the size and the checksums of the file.
+        """
+        if sha256 is None and key is not None:
+            with contextlib.suppress(OSError):
+                sha256 = (self.path / "urls" / key).read_text(encoding="utf-8")
+        if not sha256 or len(Path(sha256).parts) != 1:
+            return None
+        data = self.path / "data" / sha256
+        try:
+            meta = json.loads((self.path / "data" / f"{sha256}.json").read_text())
+            if data.stat().st_size != meta["size"]:
+                return None
+            # Mark the file as recently used
+            os.utime(data)
+        except (OSError, KeyError, ValueError):
+            return None
+        meta["path"] = str(data)
+        return meta
+
+    def tmp_file(self):
+        """
+        Return a new temporary file, in the cache filesystem.
+        """
+        return tempfile.NamedTemporaryFile(dir=self.path / "tmp", delete=False)
+
+    def add(self, filename, key, meta):
+        """
+        Move the given file into the cache and evict the least recently used
+        files if needed.
+        """
+        sha256 = meta["sha256"]
+        os.replace(filename, self.path / "data" / sha256)
+        self._write(self.path / "data" / f"{sha256}.json", json.dumps(meta))
+        if key is not None:
+            self._write(self.path / "urls" / key, sha256)
+        self.evict()
+
+    def evict(self):
+        with self.lock("evict"):
+            files = []
+            for path in (self.path / "data").iterdir():
+                if path.suffix == ".json":
+                    continue
+                with contextlib.suppress(OSError):
+                    stat = path.stat()
+                    files.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for (_, size, _) in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_size:
+                    break
+                with contextlib.suppress(OSError):
+                    path.with_suffix(".json").unlink()
+                    path.unlink()
+                total -= size
+            self._remove_locks()
+
+    def _write(self, path, data):
+        tmp = self.tmp_file()
+        with tmp:
+            tmp.write(data.encode("utf-8"))
+        os.replace(tmp.name, path)
@@ -0,0 +1,69 @@
+# Copyright (C) 2023 Linaro Limited
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import hashlib
+import queue
+import threading
+
+# Checksums that a job can request, by name of the job parameter
+ALGORITHMS = {"md5sum": "md5", "sha256sum": "sha256", "sha512sum": "sha512"}
+
+# Checksum always computed: downloaded files are cached by sha256
+DEFAULT_ALGORITHM = "sha256"
+
+
+class Checksums:
+    """
+    Compute the checksums of a stream of data in a background thread.
+
+    hashlib releases the GIL while hashing large buffers, so the data is
+    hashed while the caller keeps downloading.
+    """
+
+    def __init__(self, algorithms):
+        self.hashes = {
+            # md5 is not being used for cryptography
+            name: hashlib.new(name)  # nosec - see above.
+            for name in algorithms
+        }
+        # Bound the memory used when hashing is slower than downloading
+        self.queue = queue.Queue(maxsize=64)
+        self.thread = threading.Thread(target=self._update, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_params(cls, params):
+        """
+        Only compute the checksums requested in the job parameters and the
+        default one.
+        """
+        algorithms = [DEFAULT_ALGORITHM] + [
+            name
+            for (key, name) in ALGORITHMS.items()
+            if params.get(key) and name != DEFAULT_ALGORITHM
+        ]
+        return cls(algorithms)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _update(self):
+        while (buff := self.queue.get()) is not None:
+            for value in self.hashes.values():
+                value.update(buff)
+
+    def update(self, buff):
+        self.queue.put(buff)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def hexdigests(self):
+        self.close()
+        return {name: value.hexdigest() for (name, value) in self.hashes.items()}
@@ -10,7 +10,9 @@
 # android images: tar + xz,bz2,gz, or just gz,xz,bzip2
 # vexpress recovery images: any compression though usually zip
 
+import functools
 import os
+import shutil
 import subprocess  # nosec - internal use.
 import tarfile
 from pathlib import Path
@@ -28,6 +30,31 @@ decompress_command_map = {
     "zip": ["unzip"],
 }
 
+# Multi-threaded replacements of the commands, used when installed. The
+# output of the compression commands is kept compatible with the kernel and
+# bootloaders decoders: xz and bzip2 are not replaced.
+parallel_command_map = {
+    "bunzip2": [["lbzip2", "-d"], ["pbzip2", "-d"]],
+    "gunzip": [["pigz", "-d"]],
+    "gzip": [["pigz"]],
+    "unxz": [["xz", "-d", "-T0"]],
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _parallel_command(name):
+    for command in parallel_command_map.get(name, []):
+        if shutil.which(command[0]):
+            return command
+    return [name]
+
+
+def parallel_command(command):
+    """
+    Return the multi-threaded equivalent of the command, if any.
+    """
+    return _parallel_command(command[0]) + command[1:]
+
 
 def compress_file(infile, compression):
     if not compression:
@@ -40,7 +67,7 @@ def compress_file(infile, compression):
 
     with chdir(os.path.dirname(infile)):
         # local copy for idempotency
-        cmd = compress_command_map[compression][:]
+        cmd = parallel_command(compress_command_map[compression])
         cmd.append(infile)
         try:
             subprocess.check_output(cmd)  # nosec - internal use.
@@ -60,7 +87,7 @@ def decompress_file(infile, compression):
 
     with chdir(os.path.dirname(infile)):
         # local copy for idempotency
-        cmd = decompress_command_map[compression][:]
+        cmd = parallel_command(decompress_command_map[compression])
         cmd.append(infile)
         outfile = infile
         if infile.endswith(compression):
@@ -35,6 +35,7 @@ import yaml
 
 from lava_common.constants import DISPATCHER_DOWNLOAD_DIR, WORKER_DIR
 from lava_common.exceptions import LAVABug
+from lava_common.log import flush_spool
 from lava_common.version import __version__
 from lava_common.worker import get_parser, init_sentry_sdk
 from lava_common.yaml import yaml_safe_load
@@ -441,6 +442,16 @@ def check(url: str, jobs: JobsDB) -> None:
 
     # Loop on finished jobs
     for job in jobs.finished():
+        # Send the log records left by lava-run before removing the spool
+        if not flush_spool(
+            f"{url}{URL_JOBS}{job.job_id}/logs/",
+            job.token,
+            job.base_dir / "logs.spool",
+            timeout=TIMEOUT,
+        ):
+            LOG.warning("[%d] -> unable to send the remaining logs", job.job_id)
+            continue
+
         LOG.info("[%d] FINISHED => server", job.job_id)
         result = job.result()
         # Default error values
@@ -5,10 +5,11 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import io
+import re
 
 import junit_xml
 import tap
-from django.http.response import FileResponse, HttpResponse
+from django.http.response import FileResponse, HttpResponse, HttpResponseNotModified
 from rest_framework import status, viewsets
 from rest_framework.permissions import BasePermission
 
@@ -54,6 +55,30 @@ def safe_str2int(in_value):
     return out_value
 
 
+def parse_range(header, length):
+    """
+    Parse a single byte range header.
+    Return (first, last) or None if the header should be ignored. Raise
+    ValueError when the range is not satisfiable.
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())
+    if match is None or match.groups() == ("", ""):
+        return None
+    (first, last) = match.groups()
+    if first == "":
+        suffix = int(last)
+        if suffix == 0:
+            raise ValueError("Empty suffix range")
+        return (max(length - suffix, 0), length - 1)
+    first = int(first)
+    if last != "" and int(last) < first:
+        return None
+    if first >= length:
+        raise ValueError("Range outside of the content")
+    last = length - 1 if last == "" else min(int(last), length - 1)
+    return (first, last)
+
+
 class LavaObtainAuthToken(ObtainAuthToken):
     def post(self, request, *args, **kwargs):
         serializer = self.serializer_class(
@@ -199,24 +224,82 @@ class TestJobViewSet(viewsets.ModelViewSet):
         start = safe_str2int(request.query_params.get("start", 0))
         end = safe_str2int(request.query_params.get("end", None))
         try:
+            # Serve the uncompressed logs directly from the file
+            job = self.get_object()
+            log_range = logs_instance.open_range(job, start, end)
+            if log_range is not None:
+                return self._logs_range(request, job, log_range)
+
             if start == 0 and end is None:
-                job = self.get_object()
                 data = logs_instance.open(job)
                 size = logs_instance.size(job)
                 response = FileResponse(data, content_type="application/yaml")
                 response["Content-Length"] = size
             else:
-                data = logs_instance.read(self.get_object(), start, end)
+                data = logs_instance.read(job, start, end)
                 response = HttpResponse(data, content_type="application/yaml")
             if not data:
                 raise NotFound()
             response["Content-Disposition"] = (
-                "attachment; filename=job_%d.yaml" % self.get_object().id
+                "attachment; filename=job_%d.yaml" % job.id
             )
             return response
         except FileNotFoundError:
             raise NotFound()
 
+    def _logs_range(self, request, job, log_range):
+        if log_range.length == 0:
+            log_range.close()
+            raise NotFound()
+
+        # The logs are only appended to: a given range of the file never
+        # changes.
+        etag = '"%x-%x-%x"' % (
+            log_range.stat.st_ino,
+            log_range.offset,
+            log_range.length,
+        )
+        if_none_match = request.headers.get("If-None-Match", "")
+        if if_none_match.strip() == "*" or etag in [
+            e.strip() for e in if_none_match.split(",")
+        ]:
+            log_range.close()
+            response = HttpResponseNotModified()
+            response["ETag"] = etag
+            return response
+
+        content_range = None
+        byte_range = request.headers.get("Range")
+        if_range = request.headers.get("If-Range")
+        if byte_range and (if_range is None or if_range == etag):
+            try:
+                selected = parse_range(byte_range, log_range.length)
+            except ValueError:
+                response = HttpResponse(
+                    status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+                )
+                response["Content-Range"] = "bytes */%d" % log_range.length
+                log_range.close()
+                return response
+            if selected is not None:
+                content_range = "bytes %d-%d/%d" % (*selected, log_range.length)
+                log_range.narrow(selected[0], selected[1] + 1)
+
+        response = FileResponse(
+            log_range,
+            content_type="application/yaml",
+            status=status.HTTP_200_OK
+            if content_range is None
+            else status.HTTP_206_PARTIAL_CONTENT,
+        )
+        response["Content-Length"] = log_range.length
+        response["Accept-Ranges"] = "bytes"
+        response["ETag"] = etag
+        if content_range is not None:
+            response["Content-Range"] = content_range
+        response["Content-Disposition"] = "attachment; filename=job_%d.yaml" % job.id
+        return response
+
     @detail_route(methods=["get"], suffix="suites")
     def suites(self, request, **kwargs):
         suites = self.get_object().testsuite_set.all().order_by("id")
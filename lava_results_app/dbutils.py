@@ -10,18 +10,21 @@ import logging
 import os
 from urllib.parse import quote
 
+from django.db.models import Q
+
 from lava_common.version import __version__
 from lava_common.yaml import yaml_safe_dump, yaml_safe_load
 from lava_results_app.models import TestCase, TestSet, TestSuite
 
 
-def _check_for_testset(result_dict, suite):
+def _check_for_testset(result_dict, suite, cache=None):
     """
     The presence of the test_set key indicates the start and usage of a TestSet.
     Get or create and populate the definition based on that set.
     # {date: pass, test_definition: install-ssh, test_set: first_set}
     :param result_dict: lava-test-shell results
     :param suite: current test suite
+    :param cache: dictionary of the already known suites and sets
     """
     logger = logging.getLogger("lava-master")
     testset = None
@@ -32,7 +35,12 @@ def _check_for_testset(result_dict, suite):
             suite.job.set_failure_comment(msg)
             logger.warning(msg)
             return None
-        testset, _ = TestSet.objects.get_or_create(name=set_name, suite=suite)
+        if cache is None:
+            cache = {}
+        testset = cache.get(("set", suite.id, set_name))
+        if testset is None:
+            testset, _ = TestSet.objects.get_or_create(name=set_name, suite=suite)
+            cache[("set", suite.id, set_name)] = testset
         logger.debug("%s", testset)
     return testset
 
@@ -49,41 +57,66 @@ def create_metadata_store(results, job):
     Uses the OrderedDict import to correctly handle
     the yaml.load
     """
-    if "extra" not in results:
-        return None
-    level = results.get("level")
-    if level is None:
-        return None
+    return create_metadata_stores([results], job)[0]
+
 
+def create_metadata_stores(results_list, job):
+    """
+    Batched version of create_metadata_store: each store is read and written
+    only once.
+    :return: the list of metadata stores, one for each results.
+    """
     logger = logging.getLogger("lava-master")
-    stub = "%s-%s-%s.yaml" % (results["definition"], results["case"], level)
-    meta_filename = os.path.join(job.output_dir, "metadata", stub)
-    os.makedirs(os.path.dirname(meta_filename), mode=0o755, exist_ok=True)
-    if os.path.exists(meta_filename):
-        with open(meta_filename) as existing_store:
-            data = yaml_safe_load(existing_store)
-        if data is None:
-            data = {}
-        data.update(results["extra"])
-    else:
-        data = results["extra"]
-    try:
-        with open(meta_filename, "w") as extra_store:
-            yaml_safe_dump(data, extra_store)
-    except OSError as exc:  # LAVA-847
-        msg = "[%d] Unable to create metadata store: %s" % (job.id, exc)
-        logger.error(msg)
-        append_failure_comment(job, msg)
-        return None
-    return meta_filename
+    stores = {}
+    filenames = []
+    for results in results_list:
+        if not isinstance(results, dict) or "extra" not in results:
+            filenames.append(None)
+            continue
+        level = results.get("level")
+        if level is None:
+            filenames.append(None)
+            continue
 
+        stub = "%s-%s-%s.yaml" % (results["definition"], results["case"], level)
+        meta_filename = os.path.join(job.output_dir, "metadata", stub)
+        if meta_filename in stores:
+            stores[meta_filename].update(results["extra"])
+        elif os.path.exists(meta_filename):
+            with open(meta_filename) as existing_store:
+                data = yaml_safe_load(existing_store)
+            if data is None:
+                data = {}
+            data.update(results["extra"])
+            stores[meta_filename] = data
+        else:
+            data = results["extra"]
+            stores[meta_filename] = dict(data) if isinstance(data, dict) else data
+        filenames.append(meta_filename)
 
-def map_scanned_results(results, job, starttc, endtc, meta_filename):
+    if stores:
+        os.makedirs(os.path.join(job.output_dir, "metadata"), mode=0o755, exist_ok=True)
+    failed = set()
+    for meta_filename, data in stores.items():
+        try:
+            with open(meta_filename, "w") as extra_store:
+                yaml_safe_dump(data, extra_store)
+        except OSError as exc:  # LAVA-847
+            msg = "[%d] Unable to create metadata store: %s" % (job.id, exc)
+            logger.error(msg)
+            append_failure_comment(job, msg)
+            failed.add(meta_filename)
+    return [None if f in failed else f for f in filenames]
+
+
+def map_scanned_results(results, job, starttc, endtc, meta_filename, cache=None):
     """
     Sanity checker on the logged results dictionary
     :param results: results logged via the slave
     :param job: the current test job
     :param meta_filename: YAML store for results metadata
+    :param cache: dictionary of the already known suites and sets, shared
+                  between calls for the same job
     :return: the TestCase object that should be saved to the database.
              None on error.
     """
@@ -119,8 +152,13 @@ def map_scanned_results(results, job, starttc, endtc, meta_filename):
         if len(metadata) > 4096:
             metadata = ""
 
-    suite, _ = TestSuite.objects.get_or_create(name=results["definition"], job=job)
-    testset = _check_for_testset(results, suite)
+    if cache is None:
+        cache = {}
+    suite = cache.get(("suite", results["definition"]))
+    if suite is None:
+        suite, _ = TestSuite.objects.get_or_create(name=results["definition"], job=job)
+        cache[("suite", results["definition"])] = suite
+    testset = _check_for_testset(results, suite, cache)
 
     name = results["case"].strip()
 
@@ -185,6 +223,69 @@ def map_scanned_results(results, job, starttc, endtc, meta_filename):
     return test_case
 
 
+def new_test_cases(job, test_cases):
+    """
+    Filter out the test cases that are already saved in the database. Used
+    when some log lines are resent.
+    Test cases are matched on their log lines, so a single query is needed.
+    """
+    if not test_cases:
+        return []
+
+    def key(tc):
+        return (
+            tc.suite_id,
+            tc.test_set_id,
+            tc.name,
+            tc.result,
+            tc.start_log_line,
+            tc.end_log_line,
+        )
+
+    lines = {tc.start_log_line for tc in test_cases} - {None}
+    names = {tc.name for tc in test_cases if tc.start_log_line is None}
+    known = {
+        key(tc)
+        for tc in TestCase.objects.filter(suite__job=job)
+        .filter(
+            Q(start_log_line__in=lines) | Q(start_log_line__isnull=True, name__in=names)
+        )
+        .only(
+            "suite_id",
+            "test_set_id",
+            "name",
+            "result",
+            "start_log_line",
+            "end_log_line",
+        )
+    }
+    return [tc for tc in test_cases if key(tc) not in known]
+
+
+def map_log_results(job, lines):
+    """
+    Add the test case id to the results log lines, using a single query.
+    """
+    results = [
+        line["msg"]
+        for line in lines
+        if line["lvl"] == "results" and isinstance(line["msg"], dict)
+    ]
+    cases = {r.get("case") for r in results if r.get("definition") and r.get("case")}
+    if not cases:
+        return
+    ids = {
+        (suite, name): pk
+        for (suite, name, pk) in TestCase.objects.filter(
+            suite__job=job, name__in=cases
+        ).values_list("suite__name", "name", "id")
+    }
+    for result in results:
+        key = (result.get("definition"), result.get("case"))
+        if key in ids:
+            result["case_id"] = ids[key]
+
+
 def testsuite_export_fields():
     """
     Keep this list in sync with the keys in export_testsuite
@@ -341,8 +341,8 @@ class SchedulerJobsAPI(ExposedV2API):
         job_finished = job.state == TestJob.STATE_FINISHED
 
         try:
-            data = logs_instance.read(job, start, end)
-            return (job_finished, xmlrpc.client.Binary(data.encode("utf-8")))
+            data = logs_instance.read_bytes(job, start, end)
+            return (job_finished, xmlrpc.client.Binary(data))
         except OSError:
             return (job_finished, xmlrpc.client.Binary(b"[]"))
 
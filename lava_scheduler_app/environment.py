@@ -5,8 +5,11 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 from __future__ import annotations
 
+import os
 from contextvars import ContextVar
 
+from jinja2 import TemplateError as JinjaTemplateError
+from jinja2 import meta as jinja_meta
 from jinja2.sandbox import SandboxedEnvironment as JinjaSandboxEnv
 
 from lava_server.files import File
@@ -45,3 +48,31 @@ def device_types():
         )
         device_types_jinja_env.set(device_types_env)
         return device_types_env
+
+
+def device_template_files(hostname):
+    """
+    Return the files that the rendering of the given device depends on: the
+    device dictionary and every template that it extends or includes, in all
+    the search paths.
+    """
+    env = devices()
+    searchpath = env.loader.searchpath
+    files = []
+    seen = set()
+    pending = ["%s.jinja2" % hostname]
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        files.extend(os.path.join(path, name) for path in searchpath)
+        try:
+            source, _, _ = env.loader.get_source(env, name)
+            ast = env.parse(source)
+        except JinjaTemplateError:
+            continue
+        pending.extend(
+            ref for ref in jinja_meta.find_referenced_templates(ast) if ref is not None
+        )
+    return files
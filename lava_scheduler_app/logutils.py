@@ -4,6 +4,7 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import bisect
 import contextlib
 import datetime
 import io
@@ -11,7 +12,9 @@ import json
 import lzma
 import os
 import pathlib
+import re
 import struct
+from collections import OrderedDict
 from importlib import import_module
 from json import dumps as json_dumps
 from json import loads as json_loads
@@ -20,10 +23,14 @@ import requests
 from django.conf import settings
 
 from lava_common.exceptions import ConfigurationError
+from lava_common.log import dump, load
 from lava_common.yaml import yaml_safe_dump, yaml_safe_load
 
 
 class Logs:
+    # Lines returned by each chunk of iter_lines()
+    CHUNK_LINES = 1000
+
     def line_count(self, job):
         raise NotImplementedError("Should implement this method")
 
@@ -33,22 +40,228 @@ class Logs:
     def read(self, job, start=0, end=None):
         raise NotImplementedError("Should implement this method")
 
+    def read_bytes(self, job, start=0, end=None):
+        """
+        Return the lines between start and end, encoded in utf-8.
+        """
+        return self.read(job, start, end).encode("utf-8")
+
+    def read_lines(self, job, start=0, end=None):
+        """
+        Return the parsed lines between start and end.
+        """
+        return yaml_safe_load(self.read(job, start, end)) or []
+
+    def iter_lines(self, job, start=0, end=None):
+        """
+        Yield the parsed lines between start and end by chunks, so the whole
+        logs are never loaded at once.
+        """
+        while end is None or start < end:
+            stop = start + self.CHUNK_LINES
+            if end is not None:
+                stop = min(stop, end)
+            lines = self.read_lines(job, start, stop)
+            if not lines:
+                return
+            yield lines
+            # Less lines than requested: this was the last chunk
+            if len(lines) < stop - start:
+                return
+            start += len(lines)
+
+    def iter_bytes(self, job, start=0, end=None):
+        """
+        Yield the lines between start and end, encoded in utf-8, by chunks of
+        complete lines.
+        """
+        for lines in self.iter_lines(job, start, end):
+            yield "".join("- %s\n" % dump(line) for line in lines).encode("utf-8")
+
+    def open_range(self, job, start=0, end=None):
+        """
+        Return a LogsRange of the raw lines between start and end, or None if
+        the backend can't serve the file directly.
+        """
+        return None
+
+    def read_levels(self, job, levels, start=0, end=None):
+        """
+        Return the lines, between start and end, with one of the given levels.
+        """
+        data = self.read(job, start, end)
+        return "".join(
+            line
+            for line in data.splitlines(keepends=True)
+            if line.strip() and load(line[2:])["lvl"] in levels
+        )
+
     def size(self, job, start=0, end=None):
         raise NotImplementedError("Should implement this method")
 
     def write(self, job, line, output=None, idx=None):
         raise NotImplementedError("Should implement this method")
 
+    def write_lines(self, job, lines):
+        """
+        Write a batch of log lines. Each line is a tuple of (line, level, dt)
+        with the line encoded in utf-8.
+        """
+        for line, _, _ in lines:
+            self.write(job, line)
+
+    def close(self, job):
+        pass
+
+
+class LogsRange:
+    """
+    A range of bytes of an opened file. The file descriptor is exposed, and
+    positioned at the beginning of the range, so wsgi servers can use
+    sendfile().
+    """
+
+    def __init__(self, f_in, offset, length):
+        self.f_in = f_in
+        self.offset = offset
+        self.length = length
+        self.remaining = length
+        self.stat = os.fstat(f_in.fileno())
+        f_in.seek(offset)
+
+    def fileno(self):
+        return self.f_in.fileno()
+
+    def narrow(self, start, end):
+        """
+        Only keep the bytes between start and end of the current range.
+        """
+        self.offset += start
+        self.length = end - start
+        self.remaining = self.length
+        self.f_in.seek(self.offset)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f_in.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f_in.close()
+
+
+class LogsStream(io.RawIOBase):
+    """
+    Read only file object over the chunks returned by Logs.iter_bytes().
+    """
+
+    def __init__(self, chunks):
+        super().__init__()
+        self.chunks = iter(chunks)
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            try:
+                self.pending = next(self.chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+class CompressedBlocks:
+    """
+    Random access to the logs compressed by LogsFilesystem.compress(): only
+    the blocks covering the requested range are decompressed.
+    """
+
+    def __init__(self, filename, blocks):
+        self.offsets = []
+        self.positions = []
+        for offset, position in struct.iter_unpack(
+            LogsFilesystem.BLOCK_FORMAT, pathlib.Path(blocks).read_bytes()
+        ):
+            self.offsets.append(offset)
+            self.positions.append(position)
+        self.f_in = open(filename, "rb")
+        self.cache = (None, b"")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.f_in.close()
+
+    def _block(self, index):
+        if self.cache[0] != index:
+            self.f_in.seek(self.positions[index])
+            if index + 1 < len(self.positions):
+                raw = self.f_in.read(self.positions[index + 1] - self.positions[index])
+            else:
+                raw = self.f_in.read()
+            self.cache = (index, lzma.decompress(raw))
+        return self.cache[1]
+
+    def read(self, start, end=None):
+        index = max(bisect.bisect_right(self.offsets, start) - 1, 0)
+        chunks = []
+        while index < len(self.offsets):
+            base = self.offsets[index]
+            if end is not None and base >= end:
+                break
+            block = self._block(index)
+            chunks.append(
+                block[max(start - base, 0) : None if end is None else end - base]
+            )
+            index += 1
+        return b"".join(chunks)
+
 
 class LogsFilesystem(Logs):
     PACK_FORMAT = "=Q"
     PACK_SIZE = struct.calcsize(PACK_FORMAT)
+    # Metadata of each line: timestamp and level
+    META_FORMAT = "=dB"
+    META_SIZE = struct.calcsize(META_FORMAT)
+    # Only append new levels to keep the metadata valid
+    LEVELS = (
+        "",
+        "debug",
+        "info",
+        "warning",
+        "error",
+        "exception",
+        "results",
+        "target",
+        "input",
+        "feedback",
+        "event",
+    )
+    # Number of jobs with opened files in each process
+    MAX_HANDLES = 32
+    # Compressed logs: size of the uncompressed blocks and offsets of each
+    # block (uncompressed, compressed)
+    BLOCK_SIZE = 1024 * 1024
+    BLOCK_FORMAT = "=QQ"
+    # Maximum size of the raw data read at once by iter_bytes()
+    CHUNK_SIZE = 1024 * 1024
 
     def __init__(self):
         self.index_filename = "output.idx"
         self.log_filename = "output.yaml"
         self.log_size_filename = "output.yaml.size"
         self.compressed_log_filename = "output.yaml.xz"
+        self.compressed_blocks_filename = "output.yaml.xz.blocks"
+        self.metadata_filename = "output.meta"
+        self.handles = OrderedDict()
         super().__init__()
 
     def _build_index(self, job):
@@ -69,9 +282,59 @@ class LogsFilesystem(Logs):
         else:
             return None
 
+    def _get_handles(self, job):
+        directory = pathlib.Path(job.output_dir)
+        key = str(directory)
+        handles = self.handles.get(key)
+        # Reopen the files if they were removed
+        if handles is not None and os.fstat(handles[0].fileno()).st_nlink == 0:
+            self._close_handles(key)
+            handles = None
+
+        if handles is None:
+            directory.mkdir(mode=0o755, parents=True, exist_ok=True)
+            handles = (
+                open(str(directory / self.log_filename), "ab"),
+                open(str(directory / self.index_filename), "ab"),
+                open(str(directory / self.metadata_filename), "ab"),
+            )
+            self.handles[key] = handles
+            while len(self.handles) > self.MAX_HANDLES:
+                self._close_handles(next(iter(self.handles)))
+        self.handles.move_to_end(key)
+        return handles
+
+    def _close_handles(self, key):
+        for handle in self.handles.pop(key, ()):
+            handle.close()
+
     def line_count(self, job):
-        st = (pathlib.Path(job.output_dir) / self.index_filename).stat()
-        return int(st.st_size / self.PACK_SIZE)
+        with contextlib.suppress(FileNotFoundError):
+            st = (pathlib.Path(job.output_dir) / self.index_filename).stat()
+            return int(st.st_size / self.PACK_SIZE)
+        return 0
+
+    def line_metadata(self, job, start=0, end=None):
+        """
+        Return the (level, timestamp) of the lines between start and end or
+        None if the metadata are missing or incomplete.
+        """
+        directory = pathlib.Path(job.output_dir)
+        try:
+            meta = (directory / self.metadata_filename).read_bytes()
+        except FileNotFoundError:
+            return None
+        count = len(meta) // self.META_SIZE
+        if count != self.line_count(job):
+            return None
+        end = count if end is None else min(end, count)
+        return [
+            (self.LEVELS[level] if level < len(self.LEVELS) else "", timestamp)
+            for (timestamp, level) in struct.iter_unpack(
+                self.META_FORMAT,
+                meta[start * self.META_SIZE : max(start, end) * self.META_SIZE],
+            )
+        ]
 
     def open(self, job):
         directory = pathlib.Path(job.output_dir)
@@ -79,32 +342,205 @@ class LogsFilesystem(Logs):
             return open(str(directory / self.log_filename), "rb")
         return lzma.open(str(directory / self.compressed_log_filename), "rb")
 
-    def read(self, job, start=0, end=None):
+    def _read_offsets(self, job, ranges):
         directory = pathlib.Path(job.output_dir)
+        if (
+            not (directory / self.log_filename).exists()
+            and (directory / self.compressed_blocks_filename).exists()
+        ):
+            f_log = CompressedBlocks(
+                str(directory / self.compressed_log_filename),
+                str(directory / self.compressed_blocks_filename),
+            )
+            with f_log:
+                data = [f_log.read(start, end) for (start, end) in ranges]
+        else:
+            data = []
+            with self.open(job) as f_log:
+                for start, end in ranges:
+                    f_log.seek(start)
+                    if end is None:
+                        data.append(f_log.read())
+                    else:
+                        data.append(f_log.read(end - start))
+        return b"".join(data)
 
+    def read(self, job, start=0, end=None):
+        return self.read_bytes(job, start, end).decode("utf-8")
+
+    def _line_offsets(self, job, start, end):
         # Only create the index if needed
         if start == 0 and end is None:
-            with self.open(job) as f_log:
-                return f_log.read().decode("utf-8")
+            return (0, None)
 
         # Create the index
+        directory = pathlib.Path(job.output_dir)
         if not (directory / self.index_filename).exists():
             self._build_index(job)
         # use it now
         with open(str(directory / self.index_filename), "rb") as f_idx:
             start_offset = self._get_line_offset(f_idx, start)
             if start_offset is None:
-                return ""
-            with self.open(job) as f_log:
-                f_log.seek(start_offset)
-                if end is None:
-                    return f_log.read().decode("utf-8")
+                return None
+            end_offset = None
+            if end is not None:
                 end_offset = self._get_line_offset(f_idx, end)
-                if end_offset is None:
-                    return f_log.read().decode("utf-8")
-                if end_offset <= start_offset:
-                    return ""
-                return f_log.read(end_offset - start_offset).decode("utf-8")
+                if end_offset is not None and end_offset <= start_offset:
+                    return None
+        return (start_offset, end_offset)
+
+    def _iter_offsets(self, job, start, end):
+        directory = pathlib.Path(job.output_dir)
+        if (
+            not (directory / self.log_filename).exists()
+            and (directory / self.compressed_blocks_filename).exists()
+        ):
+            f_log = CompressedBlocks(
+                str(directory / self.compressed_log_filename),
+                str(directory / self.compressed_blocks_filename),
+            )
+            with f_log:
+                while end is None or start < end:
+                    stop = start + self.CHUNK_SIZE
+                    if end is not None:
+                        stop = min(stop, end)
+                    data = f_log.read(start, stop)
+                    if not data:
+                        return
+                    yield data
+                    start += len(data)
+        else:
+            with self.open(job) as f_log:
+                f_log.seek(start)
+                while end is None or start < end:
+                    size = self.CHUNK_SIZE
+                    if end is not None:
+                        size = min(size, end - start)
+                    data = f_log.read(size)
+                    if not data:
+                        return
+                    yield data
+                    start += len(data)
+
+    def read_bytes(self, job, start=0, end=None):
+        offsets = self._line_offsets(job, start, end)
+        if offsets is None:
+            return b""
+        if offsets == (0, None):
+            with self.open(job) as f_log:
+                return f_log.read()
+        return self._read_offsets(job, [offsets])
+
+    def iter_bytes(self, job, start=0, end=None):
+        offsets = self._line_offsets(job, start, end)
+        if offsets is None:
+            return
+        # Only yield complete lines
+        pending = b""
+        for data in self._iter_offsets(job, *offsets):
+            data = pending + data
+            cut = data.rfind(b"\n") + 1
+            if cut:
+                yield data[:cut]
+            pending = data[cut:]
+        if pending:
+            yield pending
+
+    def iter_lines(self, job, start=0, end=None):
+        # Each line is a yaml list item on its own line: parse them one by one
+        # to use the faster json parser.
+        for data in self.iter_bytes(job, start, end):
+            yield [
+                load(line[2:])
+                for line in data.decode("utf-8").split("\n")
+                if line.startswith("- ")
+            ]
+
+    def read_lines(self, job, start=0, end=None):
+        return [line for lines in self.iter_lines(job, start, end) for line in lines]
+
+    def read_levels(self, job, levels, start=0, end=None):
+        metadata = self.line_metadata(job, start, end)
+        if metadata is None:
+            return super().read_levels(job, levels, start, end)
+
+        # Group the consecutive lines to read them at once
+        ranges = []
+        for line, (level, _) in enumerate(metadata, start=start):
+            if level not in levels:
+                continue
+            if ranges and ranges[-1][1] == line:
+                ranges[-1][1] = line + 1
+            else:
+                ranges.append([line, line + 1])
+        if not ranges:
+            return ""
+
+        directory = pathlib.Path(job.output_dir)
+        with open(str(directory / self.index_filename), "rb") as f_idx:
+            offsets = [
+                (
+                    self._get_line_offset(f_idx, first),
+                    self._get_line_offset(f_idx, last),
+                )
+                for (first, last) in ranges
+            ]
+        return self._read_offsets(job, offsets).decode("utf-8")
+
+    def open_range(self, job, start=0, end=None):
+        directory = pathlib.Path(job.output_dir)
+        try:
+            f_log = open(str(directory / self.log_filename), "rb")
+        except FileNotFoundError:
+            return None
+
+        # Lines appended from now on are not part of the range
+        size = os.fstat(f_log.fileno()).st_size
+        start_offset = 0
+        end_offset = size
+        if start != 0 or end is not None:
+            if not (directory / self.index_filename).exists():
+                self._build_index(job)
+            with open(str(directory / self.index_filename), "rb") as f_idx:
+                start_offset = self._get_line_offset(f_idx, start)
+                if end is not None:
+                    end_offset = self._get_line_offset(f_idx, end)
+            if start_offset is None:
+                start_offset = size
+            if end_offset is None:
+                end_offset = size
+        start_offset = min(start_offset, size)
+        end_offset = max(min(end_offset, size), start_offset)
+        return LogsRange(f_log, start_offset, end_offset - start_offset)
+
+    def compress(self, job, data):
+        """
+        Compress the logs by blocks of about BLOCK_SIZE bytes, cut at line
+        boundaries. Each block is an independent xz stream, so the result is
+        still a valid xz file.
+        """
+        directory = pathlib.Path(job.output_dir)
+        compressed = directory / self.compressed_log_filename
+        blocks = directory / self.compressed_blocks_filename
+        tmp_compressed = directory / (self.compressed_log_filename + ".tmp")
+        tmp_blocks = directory / (self.compressed_blocks_filename + ".tmp")
+
+        index = []
+        offset = 0
+        with open(str(tmp_compressed), "wb") as f_out:
+            while offset < len(data) or not index:
+                end = data.find(b"\n", offset + self.BLOCK_SIZE - 1)
+                end = len(data) if end == -1 else end + 1
+                index.append(struct.pack(self.BLOCK_FORMAT, offset, f_out.tell()))
+                f_out.write(lzma.compress(data[offset:end]))
+                offset = end
+        tmp_blocks.write_bytes(b"".join(index))
+
+        # Replace the compressed logs before the blocks: the blocks should
+        # never describe another file.
+        blocks.unlink(missing_ok=True)
+        tmp_compressed.replace(compressed)
+        tmp_blocks.replace(blocks)
 
     def size(self, job):
         directory = pathlib.Path(job.output_dir)
@@ -120,6 +556,40 @@ class LogsFilesystem(Logs):
         output.write(line)
         output.flush()
 
+    def write_lines(self, job, lines):
+        if not lines:
+            return
+        (output, idx, meta) = self._get_handles(job)
+        # The files are only written by this process for the given job but
+        # they can be reopened: use the real size.
+        offset = os.fstat(output.fileno()).st_size
+        offsets = []
+        metadata = []
+        for line, level, dt in lines:
+            offsets.append(struct.pack(self.PACK_FORMAT, offset))
+            offset += len(line)
+            try:
+                timestamp = (
+                    datetime.datetime.fromisoformat(dt)
+                    .replace(tzinfo=datetime.timezone.utc)
+                    .timestamp()
+                )
+            except (TypeError, ValueError):
+                timestamp = 0.0
+            level = self.LEVELS.index(level) if level in self.LEVELS else 0
+            metadata.append(struct.pack(self.META_FORMAT, timestamp, level))
+
+        # One write per file
+        meta.write(b"".join(metadata))
+        meta.flush()
+        idx.write(b"".join(offsets))
+        idx.flush()
+        output.write(b"".join(line for (line, _, _) in lines))
+        output.flush()
+
+    def close(self, job):
+        self._close_handles(str(pathlib.Path(job.output_dir)))
+
 
 class LogsMongo(Logs):
     def __init__(self):
@@ -160,9 +630,7 @@ class LogsMongo(Logs):
         return self.db.logs.count_documents({"job_id": job.id})
 
     def open(self, job):
-        stream = io.BytesIO(yaml_safe_dump(list(self._get_docs(job))).encode("utf-8"))
-        stream.seek(0)
-        return stream
+        return LogsStream(self.iter_bytes(job))
 
     def read(self, job, start=0, end=None):
         docs = self._get_docs(job, start, end)
@@ -171,12 +639,14 @@ class LogsMongo(Logs):
 
         return yaml_safe_dump(list(docs))
 
+    def read_lines(self, job, start=0, end=None):
+        return list(self._get_docs(job, start, end))
+
     def size(self, job, start=0, end=None):
-        docs = self._get_docs(job, start, end)
-        return len(yaml_safe_dump(list(docs)).encode("utf-8"))
+        return sum(len(data) for data in self.iter_bytes(job, start, end))
 
     def write(self, job, line, output=None, idx=None):
-        line = yaml_safe_load(line)[0]
+        line = load(line[2:])
 
         self.db.logs.insert_one(
             {"job_id": job.id, "dt": line["dt"], "lvl": line["lvl"], "msg": line["msg"]}
@@ -248,9 +718,7 @@ class LogsElasticsearch(Logs):
         return 0
 
     def open(self, job):
-        stream = io.BytesIO(yaml_safe_dump(self._get_docs(job)).encode("utf-8"))
-        stream.seek(0)
-        return stream
+        return LogsStream(self.iter_bytes(job))
 
     def read(self, job, start=0, end=None):
         docs = self._get_docs(job, start, end)
@@ -259,12 +727,14 @@ class LogsElasticsearch(Logs):
 
         return yaml_safe_dump(docs)
 
+    def read_lines(self, job, start=0, end=None):
+        return self._get_docs(job, start, end)
+
     def size(self, job, start=0, end=None):
-        docs = self._get_docs(job, start, end)
-        return len(yaml_safe_dump(docs).encode("utf-8"))
+        return sum(len(data) for data in self.iter_bytes(job, start, end))
 
     def write(self, job, line, output=None, idx=None):
-        line = yaml_safe_load(line)[0]
+        line = load(line[2:])
         dt = datetime.datetime.strptime(line["dt"], "%Y-%m-%dT%H:%M:%S.%f")
         line.update({"job_id": job.id, "dt": int(dt.timestamp() * 1000)})
         if line["lvl"] == "results":
@@ -322,12 +792,18 @@ class LogsFirestore(Logs):
             )
         return "\n".join(["- %s" % x for x in result])
 
+    def iter_lines(self, job, start=0, end=None):
+        # read() does not handle the ranges yet: return everything at once
+        lines = self.read_lines(job, start, end)
+        if lines:
+            yield lines
+
     def size(self, job, start=0, end=None):
         # TODO: should be implemented.
         return None
 
     def write(self, job, line, output=None, idx=None):
-        line = yaml_safe_load(line)[0]
+        line = load(line[2:])
         doc_ref = (
             self.db.collection(self.root_collection)
             .document(
@@ -340,9 +816,87 @@ class LogsFirestore(Logs):
         doc_ref.set({"lvl": line["lvl"], "msg": line["msg"]})
 
 
+class LogsTiming:
+    """
+    Start and end markers of the job actions, extracted while the logs are
+    ingested and stored next to the logs whatever the logs backend.
+    Each marker is saved as "<kind> <level> <action> <seconds>".
+    """
+
+    PATTERN_START = re.compile(
+        r"^start: (?P<level>[\d.]+) (?P<action>[\w_-]+) "
+        r"\(timeout (?P<seconds>\d+:\d+:\d+)\)"
+    )
+    PATTERN_END = re.compile(
+        r"^end: (?P<level>[\d.]+) (?P<action>[\w_-]+) "
+        r"\(duration (?P<seconds>\d+:\d+:\d+)\)"
+    )
+
+    def __init__(self):
+        self.filename = "output.timing"
+
+    @classmethod
+    def candidate(cls, string):
+        # Cheap test on the raw log line before parsing it
+        return '"msg": "start: ' in string or '"msg": "end: ' in string
+
+    @classmethod
+    def marker(cls, line):
+        # Only debug and info levels are parsed
+        if line.get("lvl") not in ["debug", "info"]:
+            return None
+        msg = line.get("msg")
+        if not isinstance(msg, str):
+            return None
+        for kind, pattern in (("start", cls.PATTERN_START), ("end", cls.PATTERN_END)):
+            match = pattern.match(msg)
+            if match is not None:
+                parts = match["seconds"].split(":")
+                seconds = (
+                    float(parts[0]) * 3600 + float(parts[1]) * 60 + float(parts[2])
+                )
+                return (kind, match["level"], match["action"], seconds)
+        return None
+
+    def markers(self, lines):
+        return [m for m in (self.marker(line) for line in lines) if m is not None]
+
+    def read(self, job):
+        """
+        Return the markers or None when they were not recorded during the
+        ingestion.
+        """
+        try:
+            data = (pathlib.Path(job.output_dir) / self.filename).read_text(
+                encoding="utf-8"
+            )
+        except FileNotFoundError:
+            return None
+        markers = []
+        for line in data.splitlines():
+            with contextlib.suppress(ValueError):
+                (kind, level, action, seconds) = line.split(" ")
+                markers.append((kind, level, action, float(seconds)))
+        return markers
+
+    def write(self, job, markers, append=True):
+        """
+        Save the markers. When appending, the markers are only saved if the
+        file was created with the first log lines of the job: otherwise the
+        recorded markers would be incomplete.
+        """
+        filename = pathlib.Path(job.output_dir) / self.filename
+        if append and not filename.exists():
+            return
+        filename.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        with open(str(filename), "a" if append else "w", encoding="utf-8") as f_out:
+            f_out.write("".join("%s %s %s %s\n" % m for m in markers))
+
+
 logs_backend_str = settings.LAVA_LOG_BACKEND.rsplit(".", 1)
 try:
     logs_class = getattr(import_module(logs_backend_str[0]), logs_backend_str[1])
 except (AttributeError, ModuleNotFoundError) as exc:
     raise ConfigurationError(str(exc))
 logs_instance = logs_class()
+timing_instance = LogsTiming()
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:26
+
+from json import dumps as json_dumps
+
+import yaml
+from django.db import migrations, models
+
+from lava_common.yaml import yaml_safe_load
+from lava_scheduler_app.models import _job_requirements
+
+
+def forwards_func(apps, schema_editor):
+    # Only the jobs that are not finished will be looked at by the scheduler
+    TestJob = apps.get_model("lava_scheduler_app", "TestJob")
+    jobs = TestJob.objects.exclude(state=5)  # TestJob.STATE_FINISHED
+    for job in jobs.exclude(definition=""):
+        try:
+            job_data = yaml_safe_load(job.definition)
+        except yaml.YAMLError:
+            continue
+        if not isinstance(job_data, dict):
+            continue
+        job.requirements = json_dumps(_job_requirements(job_data))
+        job.save(update_fields=["requirements"])
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("lava_scheduler_app", "0058_add_testjob_view_performance_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="testjob",
+            name="requirements",
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.RunPython(forwards_func, noop, elidable=True),
+    ]
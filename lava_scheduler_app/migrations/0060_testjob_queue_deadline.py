@@ -0,0 +1,43 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:33
+
+import datetime
+
+from django.db import migrations, models
+
+
+def forwards_func(apps, schema_editor):
+    # Only the jobs still in the queue can be canceled by the scheduler
+    TestJob = apps.get_model("lava_scheduler_app", "TestJob")
+    jobs = TestJob.objects.filter(state=0)  # TestJob.STATE_SUBMITTED
+    for job in jobs.filter(queue_timeout__isnull=False):
+        job.queue_deadline = job.submit_time + datetime.timedelta(
+            seconds=job.queue_timeout
+        )
+        job.save(update_fields=["queue_deadline"])
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("lava_scheduler_app", "0059_testjob_requirements"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="testjob",
+            name="queue_deadline",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="testjob",
+            index=models.Index(
+                condition=models.Q(("state", 0)),
+                fields=["queue_deadline"],
+                name="job_queue_deadline_idx",
+            ),
+        ),
+        migrations.RunPython(forwards_func, noop, elidable=True),
+    ]
@@ -10,8 +10,11 @@ import datetime
 import gzip
 import logging
 import os
+import shutil
+import tempfile
 import uuid
-from json import dump as json_dump
+from json import dumps as json_dumps
+from json import loads as json_loads
 
 import requests
 import yaml
@@ -59,6 +62,40 @@ def auth_token():
     return get_random_string(32)
 
 
+# Cache for the device checks that are costly to compute (rendering and
+# validating the configuration, looking for the health-check). Each value is
+# stored with the files it was computed from and is invalidated as soon as one
+# of these files is modified.
+_device_cache = {}
+
+
+def _files_signature(files):
+    signature = []
+    for filename in files:
+        try:
+            st = os.stat(filename)
+            signature.append((st.st_ino, st.st_size, st.st_mtime_ns))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def _device_cached(key, compute):
+    """
+    Return the value computed by compute() for this key, calling it again
+    only when one of the files returned by compute() has been modified.
+    compute() should return a tuple (files, value).
+    """
+    entry = _device_cache.get(key)
+    if entry is not None:
+        files, signature, value = entry
+        if _files_signature(files) == signature:
+            return value
+    files, value = compute()
+    _device_cache[key] = (files, _files_signature(files), value)
+    return value
+
+
 class DevicesUnavailableException(UserWarning):
     """Error raised when required number of devices are unavailable."""
 
@@ -694,19 +731,32 @@ class Device(RestrictedObject):
 
         return False
 
+    def _cache_key(self, check):
+        # The paths are part of the key as they can be changed in the settings
+        return (
+            check,
+            self.hostname,
+            tuple(File("device").loader().searchpath),
+            settings.HEALTH_CHECKS_PATH,
+        )
+
     def is_valid(self):
-        try:
-            rendered = self.load_configuration()
-            validate_device(rendered)
-        except (SubmissionException, yaml.YAMLError) as exc:
-            logger = logging.getLogger("lava-scheduler")
-            logger.error(
-                "Error validating device configuration for %s: %s",
-                self.hostname,
-                str(exc),
-            )
-            return False
-        return True
+        def compute():
+            files = environment.device_template_files(self.hostname)
+            try:
+                rendered = self.load_configuration()
+                validate_device(rendered)
+            except (SubmissionException, yaml.YAMLError) as exc:
+                logger = logging.getLogger("lava-scheduler")
+                logger.error(
+                    "Error validating device configuration for %s: %s",
+                    self.hostname,
+                    str(exc),
+                )
+                return (files, False)
+            return (files, True)
+
+        return _device_cached(self._cache_key("valid"), compute)
 
     def log_admin_entry(self, user, reason):
         if user is None:
@@ -891,6 +941,13 @@ class Device(RestrictedObject):
             return False
 
     def get_extends(self):
+        def compute():
+            files = File("device", self.hostname).files
+            return (files, self._get_extends())
+
+        return _device_cached(self._cache_key("extends"), compute)
+
+    def _get_extends(self):
         jinja_config = self.load_configuration(output_format="raw")
         if not jinja_config:
             return None
@@ -916,15 +973,22 @@ class Device(RestrictedObject):
         if not extends:
             return None
 
-        filename = os.path.join(settings.HEALTH_CHECKS_PATH, "%s.yaml" % extends)
-        # Try if health check file is having a .yml extension
-        if not os.path.exists(filename):
-            filename = os.path.join(settings.HEALTH_CHECKS_PATH, "%s.yml" % extends)
-        try:
-            with open(filename) as f_in:
-                return f_in.read()
-        except OSError:
-            return None
+        def compute():
+            files = [
+                os.path.join(settings.HEALTH_CHECKS_PATH, "%s.yaml" % extends),
+                os.path.join(settings.HEALTH_CHECKS_PATH, "%s.yml" % extends),
+            ]
+            filename = files[0]
+            # Try if health check file is having a .yml extension
+            if not os.path.exists(filename):
+                filename = files[1]
+            try:
+                with open(filename) as f_in:
+                    return (files, f_in.read())
+            except OSError:
+                return (files, None)
+
+        return _device_cached(self._cache_key("health-check:%s" % extends), compute)
 
 
 class JobFailureTag(models.Model):
@@ -1076,6 +1140,21 @@ def _get_device_type(user, name):
     return device_type
 
 
+def _job_requirements(job_data):
+    """
+    Extract from the job definition the facts needed by the scheduler.
+    """
+    requirements = {}
+    if "connection" in job_data:
+        requirements["connection"] = True
+    protocols = job_data.get("protocols") or {}
+    if "role" in protocols.get("lava-multinode", {}):
+        requirements["role"] = protocols["lava-multinode"]["role"]
+    if "lava-vland" in protocols:
+        requirements["vland"] = protocols["lava-vland"]
+    return requirements
+
+
 def _create_pipeline_job(
     job_data,
     user,
@@ -1139,8 +1218,10 @@ def _create_pipeline_job(
 
     # handle queue timeout.
     queue_timeout = None
+    queue_deadline = None
     if "timeouts" in job_data and "queue" in job_data["timeouts"]:
         queue_timeout = Timeout.parse(job_data["timeouts"]["queue"])
+        queue_deadline = timezone.now() + datetime.timedelta(seconds=queue_timeout)
 
     with transaction.atomic():
         job = TestJob(
@@ -1154,6 +1235,8 @@ def _create_pipeline_job(
             priority=priority,
             is_public=is_public,
             queue_timeout=queue_timeout,
+            queue_deadline=queue_deadline,
+            requirements=json_dumps(_job_requirements(job_data)),
         )
         job.save()
 
@@ -1332,6 +1415,11 @@ class TestJob(models.Model):
                 fields=("requested_device_type", "-submit_time", "id", "health"),
                 condition=Q(health_check=True),
             ),
+            models.Index(
+                fields=("queue_deadline",),
+                name="job_queue_deadline_idx",
+                condition=Q(state=0),  # HACK: refers to TestJob.STATE_SUBMITTED
+            ),
         )
 
     # Permission strings. Not real permissions.
@@ -1414,8 +1502,7 @@ class TestJob(models.Model):
         """
         if not self.is_multinode or not self.definition:
             return False
-        job_data = yaml_safe_load(self.definition)
-        return "connection" in job_data
+        return self.get_requirements().get("connection", False)
 
     tags = models.ManyToManyField(Tag, blank=True)
 
@@ -1689,6 +1776,14 @@ class TestJob(models.Model):
         verbose_name=_("Queue timeout"), null=True, blank=True, editable=False
     )
 
+    # submit time + queue timeout: the job is canceled if it's still in the
+    # queue after this deadline
+    queue_deadline = models.DateTimeField(null=True, blank=True, editable=False)
+
+    # Scheduling requirements extracted from the definition at submission time
+    # and stored as json, see _job_requirements()
+    requirements = models.TextField(editable=False, blank=True)
+
     @property
     def size_limit(self):
         return settings.LOG_SIZE_LIMIT * 1024 * 1024
@@ -1953,6 +2048,41 @@ class TestJob(models.Model):
 
         return data
 
+    def iter_job_data(self, token=None, output=False, results=False):
+        """
+        Yield the json encoding of create_job_data() by chunks. The logs are
+        streamed so they are never loaded at once.
+        Errors while reading the logs are raised as OSError.
+        """
+        data = self.create_job_data(token=token, results=results)
+        if not output:
+            yield json_dumps(data)
+            return
+
+        yield json_dumps(data)[:-1] + ', "log": "'
+        for chunk in logs_instance.iter_bytes(self):
+            # Chunks are made of complete lines: they can be decoded one by one
+            yield json_dumps(chunk.decode("utf-8"))[1:-1]
+        yield '"}'
+
+    def write_job_data(self, f_out, token=None, output=False, results=False):
+        """
+        Write the json encoding of create_job_data(), in utf-8, to the
+        seekable binary file f_out. If the logs cannot be read, they are left
+        out, like create_job_data() does.
+        """
+        start = f_out.tell()
+        try:
+            for chunk in self.iter_job_data(
+                token=token, output=output, results=results
+            ):
+                f_out.write(chunk.encode("utf-8"))
+        except OSError:
+            f_out.seek(start)
+            f_out.truncate()
+            data = self.create_job_data(token=token, results=results)
+            f_out.write(json_dumps(data).encode("utf-8"))
+
     def set_failure_comment(self, message):
         if not self.failure_comment:
             self.failure_comment = message
@@ -2109,6 +2239,17 @@ class TestJob(models.Model):
             data = self.testdata.attributes.filter(name=xaxis_attribute)
             return data.values_list("value", flat=True)[0]
 
+    def get_requirements(self):
+        """
+        Return the scheduling requirements without parsing the definition,
+        unless the job was submitted before the requirements were stored.
+        """
+        if self.requirements:
+            return json_loads(self.requirements)
+        if not self.definition:
+            return {}
+        return _job_requirements(yaml_safe_load(self.definition))
+
     def get_metadata_dict(self):
         retval = []
         if hasattr(self, "testdata"):
@@ -2370,6 +2511,7 @@ class NotificationCallback(models.Model):
     def invoke_callback(self):
         logger = logging.getLogger("lava-scheduler")
         data = None
+        body = None
 
         if self.method != NotificationCallback.GET:
             output = self.dataset in [
@@ -2380,20 +2522,34 @@ class NotificationCallback(models.Model):
                 NotificationCallback.RESULTS,
                 NotificationCallback.ALL,
             ]
-            data = self.notification.test_job.create_job_data(
-                token=self.token, output=output, results=results
-            )
+            job = self.notification.test_job
+            # allow for jobs cancelled in submitted state
+            utils.mkdir(job.output_dir)
+
+            # Only form encoded requests need the data at once. The json body
+            # is written to a file to avoid loading the logs at once, while
+            # still sending a Content-Length.
+            if self.content_type != NotificationCallback.JSON:
+                data = job.create_job_data(
+                    token=self.token, output=output, results=results
+                )
+            else:
+                body = tempfile.TemporaryFile(dir=job.output_dir)
+                job.write_job_data(
+                    body, token=self.token, output=output, results=results
+                )
+                body.seek(0)
+
             # store callback_data for later retrieval & triage
-            job_data_file = os.path.join(
-                self.notification.test_job.output_dir, "job_data.gz"
-            )
-            if data:
-                # allow for jobs cancelled in submitted state
-                utils.mkdir(self.notification.test_job.output_dir)
-                # only write the file once
-                if not os.path.exists(job_data_file):
-                    with gzip.open(job_data_file, "wt") as output:
-                        json_dump(data, output)
+            job_data_file = os.path.join(job.output_dir, "job_data.gz")
+            # only write the file once
+            if not os.path.exists(job_data_file):
+                with gzip.open(job_data_file, "wb") as f_out:
+                    if body is None:
+                        f_out.write(json_dumps(data).encode("utf-8"))
+                    else:
+                        shutil.copyfileobj(body, f_out)
+                        body.seek(0)
         try:
             logger.info("Sending request to callback url %s" % self.url)
             headers = {}
@@ -2405,9 +2561,10 @@ class NotificationCallback(models.Model):
                     self.url, headers=headers, timeout=settings.CALLBACK_TIMEOUT
                 )
             elif self.content_type == NotificationCallback.JSON:
+                headers["Content-Type"] = "application/json"
                 ret = requests.post(
                     self.url,
-                    json=data,
+                    data=body,
                     headers=headers,
                     timeout=settings.CALLBACK_TIMEOUT,
                 )
@@ -2422,6 +2579,9 @@ class NotificationCallback(models.Model):
 
         except Exception as ex:
             logger.warning("Problem sending request to %s: %s" % (self.url, ex))
+        finally:
+            if body is not None:
+                body.close()
 
 
 @nottest
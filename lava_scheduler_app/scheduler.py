@@ -4,12 +4,16 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import contextlib
 import datetime
-from dataclasses import dataclass
+import time
+from collections import Counter
+from dataclasses import dataclass, field
 
 from django.contrib.auth.models import User
-from django.db import transaction
+from django.db import connection, transaction
 from django.db.models import Count, Q
+from django.db.models.signals import post_save
 from django.utils import timezone
 
 from lava_common.yaml import yaml_safe_dump, yaml_safe_load
@@ -23,6 +27,30 @@ from lava_scheduler_app.models import (
 )
 
 
+@dataclass
+class SchedulingStats:
+    jobs: int = 0
+    devices: int = 0
+    scheduled: int = 0
+    queries: int = 0
+    duration: float = 0.0
+    # phase name => (duration, queries)
+    phases: dict = field(default_factory=dict)
+
+    def count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        begin = time.monotonic()
+        queries = self.queries
+        try:
+            yield
+        finally:
+            self.phases[name] = (time.monotonic() - begin, self.queries - queries)
+
+
 @dataclass
 class WorkerSummary:
     limit: int
@@ -51,37 +79,137 @@ def worker_summary():
     return ret
 
 
+class WorkersView:
+    """
+    In memory view of the workers and of their load.
+
+    The view is rebuilt from the database by reconcile() and kept up to date in
+    between by the device and worker events. Device updates are idempotent so
+    the events generated by the scheduler itself are harmless.
+    """
+
+    BUSY_STATES = ("Reserved", "Running")
+
+    def __init__(self):
+        self.limits = {}
+        # hostname => (worker, device type, busy)
+        self.devices = {}
+
+    def reconcile(self):
+        self.limits = dict(Worker.objects.values_list("hostname", "job_limit"))
+        query = Device.objects.filter(worker_host__isnull=False)
+        query = query.values_list("hostname", "worker_host", "device_type", "state")
+        self.devices = {
+            hostname: (
+                worker,
+                dt,
+                state in (Device.STATE_RESERVED, Device.STATE_RUNNING),
+            )
+            for (hostname, worker, dt, state) in query
+        }
+
+    def update_device(self, hostname, worker, dt, state):
+        if worker is None:
+            self.devices.pop(hostname, None)
+        else:
+            self.devices[hostname] = (worker, dt, state in self.BUSY_STATES)
+
+    def device_types(self, worker):
+        return {dt for (w, dt, _) in self.devices.values() if w == worker}
+
+    def is_known(self, workers):
+        return all(worker in self.limits for worker in workers)
+
+    def summary(self):
+        busy = Counter(w for (w, _, b) in self.devices.values() if b)
+        return {
+            hostname: WorkerSummary(limit, busy[hostname])
+            for (hostname, limit) in self.limits.items()
+        }
+
+
+def send_post_save(model, instances):
+    """
+    bulk_update does not send the signals used for the events and the
+    notifications: send them for each instance.
+    """
+    for instance in instances:
+        post_save.send(
+            sender=model,
+            instance=instance,
+            created=False,
+            update_fields=None,
+            raw=False,
+            using=instance._state.db,
+        )
+
+
 def check_queue_timeout(logger):
     logger.info("Check queue timeouts:")
-    jobs = TestJob.objects.filter(
-        state=TestJob.STATE_SUBMITTED, queue_timeout__isnull=False
-    )
-    for testjob in jobs:
-        now = timezone.now()
-        queue_timeout_delta = datetime.timedelta(seconds=testjob.queue_timeout)
-        canceling = testjob.submit_time + queue_timeout_delta < now
-        if canceling:
-            logger.debug("  |--> [%d] canceling", testjob.id)
-            if testjob.is_multinode:
-                for job in testjob.sub_jobs_list:
-                    job.go_state_canceling()
-                    job.save()
-            else:
-                testjob.go_state_canceling()
-                testjob.save()
+    with transaction.atomic():
+        jobs = TestJob.objects.select_for_update()
+        jobs = jobs.filter(
+            state=TestJob.STATE_SUBMITTED, queue_deadline__lt=timezone.now()
+        )
+        expired = list(jobs.values_list("id", "target_group"))
+        if not expired:
+            logger.info("done")
+            return
+
+        # Multinode groups are canceled as a whole
+        groups = {group for (_, group) in expired if group}
+        jobs = TestJob.objects.select_for_update()
+        jobs = jobs.filter(
+            Q(id__in=[pk for (pk, _) in expired]) | Q(target_group__in=groups)
+        )
+        jobs = list(jobs.filter(state__lt=TestJob.STATE_CANCELING).order_by("id"))
+        for job in jobs:
+            logger.debug("  |--> [%d] canceling", job.id)
+            job.go_state_canceling(sub_cancel=True)
+        TestJob.objects.bulk_update(jobs, ["state", "health", "start_time", "end_time"])
+        send_post_save(TestJob, jobs)
     logger.info("done")
 
 
-def schedule(logger, available_dt, workers):
-    available_devices = schedule_health_checks(logger, available_dt, workers)
-    schedule_jobs(logger, available_devices, workers)
-    check_queue_timeout(logger)
+def schedule(logger, available_dt, workers, workers_limit=None):
+    """
+    Schedule the given device types or every device type when available_dt is
+    empty. Queue timeouts are only checked on such full passes.
+    """
+    stats = SchedulingStats()
+    begin = time.monotonic()
+    with connection.execute_wrapper(stats.count_query):
+        # Compute the workers load once for the whole pass
+        if workers_limit is None:
+            with stats.phase("workers"):
+                workers_limit = worker_summary()
+        with stats.phase("health-checks"):
+            available_devices = schedule_health_checks(
+                logger, available_dt, workers, workers_limit
+            )
+        with stats.phase("jobs"):
+            schedule_jobs(logger, available_devices, workers, stats, workers_limit)
+        if not available_dt:
+            with stats.phase("queue-timeout"):
+                check_queue_timeout(logger)
+    stats.duration = time.monotonic() - begin
+    logger.info(
+        "stats: %d jobs considered, %d devices matched on %d, %d queries in %.3fs",
+        stats.jobs,
+        stats.scheduled,
+        stats.devices,
+        stats.queries,
+        stats.duration,
+    )
+    return stats
 
 
-def schedule_health_checks(logger, available_dt, workers):
+def schedule_health_checks(logger, available_dt, workers, workers_limit=None):
     logger.info("scheduling health checks:")
     available_devices = {}
     hc_disabled = []
+    if workers_limit is None:
+        workers_limit = worker_summary()
 
     query = DeviceType.objects.filter(display=True)
     if available_dt:
@@ -103,7 +231,7 @@ def schedule_health_checks(logger, available_dt, workers):
         else:
             with transaction.atomic():
                 available_devices[dt.name] = schedule_health_checks_for_device_type(
-                    logger, dt, workers
+                    logger, dt, workers, workers_limit
                 )
 
     # Print disabled device types
@@ -114,7 +242,7 @@ def schedule_health_checks(logger, available_dt, workers):
     return available_devices
 
 
-def schedule_health_checks_for_device_type(logger, dt, workers):
+def schedule_health_checks_for_device_type(logger, dt, workers, workers_limit=None):
     devices = dt.device_set.select_for_update()
     devices = filter_devices(devices, workers)
     devices = devices.filter(
@@ -122,7 +250,8 @@ def schedule_health_checks_for_device_type(logger, dt, workers):
     )
     devices = devices.order_by("hostname")
 
-    workers_limit = worker_summary()
+    if workers_limit is None:
+        workers_limit = worker_summary()
 
     print_header = True
     available_devices = []
@@ -228,13 +357,15 @@ def schedule_health_check(device, definition):
     job.save()
 
 
-def schedule_jobs(logger, available_devices, workers):
+def schedule_jobs(logger, available_devices, workers, stats=None, workers_limit=None):
     logger.info("scheduling jobs:")
+    if workers_limit is None:
+        workers_limit = worker_summary()
     dts = list(available_devices.keys())
     for dt in DeviceType.objects.filter(name__in=dts).order_by("name"):
         with transaction.atomic():
             schedule_jobs_for_device_type(
-                logger, dt, available_devices[dt.name], workers
+                logger, dt, available_devices[dt.name], workers, stats, workers_limit
             )
 
     with transaction.atomic():
@@ -244,19 +375,42 @@ def schedule_jobs(logger, available_devices, workers):
     logger.info("done")
 
 
-def schedule_jobs_for_device_type(logger, dt, available_devices, workers):
-    devices = dt.device_set.select_for_update()
+def schedule_jobs_for_device_type(
+    logger, dt, available_devices, workers, stats=None, workers_limit=None
+):
+    if stats is None:
+        stats = SchedulingStats()
+
+    # Load the queue once: tags and submitters are fetched along with the
+    # jobs so that the matching below is done in memory.
+    jobs = TestJob.objects.filter(state=TestJob.STATE_SUBMITTED)
+    jobs = jobs.filter(actual_device__isnull=True)
+    jobs = jobs.filter(requested_device_type__pk=dt.pk)
+    jobs = jobs.select_related("submitter")
+    jobs = jobs.prefetch_related("tags")
+    jobs = jobs.order_by("-priority", "submit_time", "sub_id", "id")
+    queue = [QueuedJob(job) for job in jobs]
+    stats.jobs += len(queue)
+    if not queue:
+        return 0
+
+    devices = dt.device_set.select_for_update(of=("self",))
     devices = filter_devices(devices, workers)
     devices = devices.filter(health__in=[Device.HEALTH_GOOD, Device.HEALTH_UNKNOWN])
+    devices = devices.select_related("worker_host")
+    devices = devices.prefetch_related("tags")
     # Add a random sort: with N devices and num(jobs) < N, if we don't sort
     # randomly, the same devices will always be used while the others will
     # never be used.
     devices = devices.order_by("?")
 
-    workers_limit = worker_summary()
+    if workers_limit is None:
+        workers_limit = worker_summary()
 
-    print_header = True
+    assignments = []
     for device in devices:
+        if not queue:
+            break
         # Check that the device had been marked available by
         # schedule_health_checks. In fact, it's possible that a device is made
         # IDLE between the two functions.
@@ -277,6 +431,7 @@ def schedule_jobs_for_device_type(logger, dt, available_devices, workers):
             )
             continue
 
+        stats.devices += 1
         if not device.is_valid():
             prev_health_display = device.get_health_display()
             device.health = Device.HEALTH_BAD
@@ -292,35 +447,15 @@ def schedule_jobs_for_device_type(logger, dt, available_devices, workers):
             )
             continue
 
-        if schedule_jobs_for_device(logger, device, print_header) is not None:
-            print_header = False
+        index = match_job_for_device(device, queue)
+        if index is not None:
+            assignments.append((device, queue.pop(index).job))
             workers_limit[device.worker_host.hostname].busy += 1
 
-
-def schedule_jobs_for_device(logger, device, print_header):
-    jobs = TestJob.objects.filter(state=TestJob.STATE_SUBMITTED)
-    jobs = jobs.filter(actual_device__isnull=True)
-    jobs = jobs.filter(requested_device_type__pk=device.device_type.pk)
-    jobs = jobs.select_related("submitter")
-    jobs = jobs.order_by("-priority", "submit_time", "sub_id", "id")
-
-    device_tags = set(device.tags.all())
-    for job in jobs:
-        if not device.can_submit(job.submitter):
-            continue
-
-        job_tags = set(job.tags.all())
-        if not job_tags.issubset(device_tags):
-            continue
-
-        job_dict = yaml_safe_load(job.definition)
-        if "protocols" in job_dict and "lava-vland" in job_dict["protocols"]:
-            if not match_vlan_interface(device, job_dict):
-                continue
-
-        if print_header:
-            logger.debug("- %s", device.device_type.name)
-
+    # Write all the assignments at once, in the caller transaction
+    if assignments:
+        logger.debug("- %s", dt.name)
+    for device, job in assignments:
         logger.debug(
             " -> %s (%s, %s)",
             device.hostname,
@@ -334,7 +469,47 @@ def schedule_jobs_for_device(logger, device, print_header):
         else:
             job.go_state_scheduled(device)
         job.save()
-        return job.id
+    stats.scheduled += len(assignments)
+    return len(assignments)
+
+
+class QueuedJob:
+    """
+    In memory view of a submitted job with the requirements needed to match it
+    against a device.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        # Use the prefetched tags
+        self.tags = {tag.pk for tag in job.tags.all()}
+        self.requirements = job.get_requirements()
+
+
+def match_job_for_device(device, queue):
+    """
+    Return the index of the first job in the queue that can run on the given
+    device or None.
+    """
+    device_tags = {tag.pk for tag in device.tags.all()}
+    can_submit = {}
+    for index, queued in enumerate(queue):
+        submitter = queued.job.submitter
+        if submitter.pk not in can_submit:
+            can_submit[submitter.pk] = device.can_submit(submitter)
+        if not can_submit[submitter.pk]:
+            continue
+
+        if not queued.tags.issubset(device_tags):
+            continue
+
+        vland = queued.requirements.get("vland")
+        if vland is not None:
+            job_dict = {"protocols": {"lava-vland": vland}}
+            if not match_vlan_interface(device, job_dict):
+                continue
+
+        return index
     return None
 
 
@@ -343,13 +518,18 @@ def transition_multinode_jobs(logger):
     Transition multinode jobs that are ready to be scheduled.
     A multinode is ready when all sub jobs are in STATE_SCHEDULING.
     """
-    jobs = TestJob.objects.filter(state=TestJob.STATE_SCHEDULING)
-    # Ordering by target_group is mandatory for distinct to work
+    # Load the sub jobs of every group being scheduled at once
+    groups = TestJob.objects.filter(state=TestJob.STATE_SCHEDULING)
+    jobs = TestJob.objects.filter(target_group__in=groups.values("target_group"))
+    jobs = jobs.select_related("actual_device")
     jobs = jobs.order_by("target_group", "id")
-    jobs = jobs.distinct("target_group")
-
+    sub_jobs_per_group = {}
     for job in jobs:
-        sub_jobs = job.sub_jobs_list
+        sub_jobs_per_group.setdefault(job.target_group, []).append(job)
+
+    updated_jobs = []
+    updated_devices = []
+    for sub_jobs in sub_jobs_per_group.values():
         if not all(
             [
                 j.state == TestJob.STATE_SCHEDULING or j.dynamic_connection
@@ -358,6 +538,7 @@ def transition_multinode_jobs(logger):
         ):
             continue
 
+        job = next(j for j in sub_jobs if j.state == TestJob.STATE_SCHEDULING)
         logger.debug("-> multinode [%d] scheduled", job.id)
         # Inject the actual group hostnames into the roles for the dispatcher
         # to populate in the overlay.
@@ -366,15 +547,30 @@ def transition_multinode_jobs(logger):
             # build a list of all devices in this group
             if sub_job.dynamic_connection:
                 continue
-            definition = yaml_safe_load(sub_job.definition)
-            devices[str(sub_job.id)] = definition["protocols"]["lava-multinode"]["role"]
+            devices[str(sub_job.id)] = sub_job.get_requirements()["role"]
 
         for sub_job in sub_jobs:
             # apply the complete list to all jobs in this group
             definition = yaml_safe_load(sub_job.definition)
             definition["protocols"]["lava-multinode"]["roles"] = devices
             sub_job.definition = yaml_safe_dump(definition)
-            # transition the job and device
-            sub_job.go_state_scheduled()
-            sub_job.save()
+            updated_jobs.append(sub_job)
             logger.debug("--> %d", sub_job.id)
+            # transition the job and device, like go_state_scheduled() but
+            # the devices are saved in bulk
+            if sub_job.state >= TestJob.STATE_SCHEDULED:
+                continue
+            sub_job.state = TestJob.STATE_SCHEDULED
+            # dynamic connection does not have any device
+            if not sub_job.dynamic_connection:
+                if sub_job.actual_device is None:
+                    raise Exception("actual_device is not set")
+                sub_job.actual_device.testjob_signal("go_state_scheduled", sub_job)
+                updated_devices.append(sub_job.actual_device)
+
+    if updated_devices:
+        Device.objects.bulk_update(updated_devices, ["state"])
+        send_post_save(Device, updated_devices)
+    if updated_jobs:
+        TestJob.objects.bulk_update(updated_jobs, ["state", "definition"])
+        send_post_save(TestJob, updated_jobs)
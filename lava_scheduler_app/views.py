@@ -9,10 +9,11 @@
 import contextlib
 import datetime
 import io
+import itertools
 import logging
 import os
-import re
 import tarfile
+import zlib
 from json import dumps as json_dumps
 from pathlib import Path
 
@@ -26,6 +27,7 @@ from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.humanize.templatetags.humanize import naturaltime
 from django.core.exceptions import FieldDoesNotExist, PermissionDenied
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import transaction
 from django.db.models import Count, IntegerField, OuterRef, Prefetch, Q, Subquery
 from django.db.utils import DatabaseError
@@ -37,6 +39,8 @@ from django.http import (
     HttpResponseForbidden,
     HttpResponseRedirect,
     JsonResponse,
+    QueryDict,
+    StreamingHttpResponse,
 )
 from django.shortcuts import get_object_or_404, redirect, render
 from django.template.loader import render_to_string
@@ -49,11 +53,16 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods, require_POST
 from django_tables2 import RequestConfig
 
-from lava_common.log import dump
+from lava_common.log import dump, load
 from lava_common.schemas import validate
 from lava_common.version import __version__
 from lava_common.yaml import yaml_safe_dump, yaml_safe_load
-from lava_results_app.dbutils import create_metadata_store, map_scanned_results
+from lava_results_app.dbutils import (
+    create_metadata_stores,
+    map_log_results,
+    map_scanned_results,
+    new_test_cases,
+)
 from lava_results_app.models import (
     NamedTestAttribute,
     Query,
@@ -74,7 +83,7 @@ from lava_scheduler_app.dbutils import (
     testjob_submission,
     validate_job,
 )
-from lava_scheduler_app.logutils import logs_instance
+from lava_scheduler_app.logutils import logs_instance, timing_instance
 from lava_scheduler_app.models import (
     Device,
     DeviceType,
@@ -1272,6 +1281,7 @@ def internal_v1_jobs(request, pk):
                     "Infrastructure",
                 ]
                 job.go_state_finished(health, infrastructure_error)
+                logs_instance.close(job)
                 if errors:
                     job.failure_comment = errors
                 Path(job.output_dir).mkdir(mode=0o755, parents=True, exist_ok=True)
@@ -1302,11 +1312,37 @@ def internal_v1_jobs_logs(request, pk):
     if not constant_time_compare(token, job.token):
         return JsonResponse({"error": "Invalid 'token'"}, status=400)
 
+    # Recent dispatchers compress the request body
+    encoding = request.META.get("HTTP_CONTENT_ENCODING")
+    if encoding:
+        if encoding != "gzip":
+            return JsonResponse(
+                {"error": f"Unsupported encoding '{encoding}'"}, status=415
+            )
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            # Apply the same limit to the uncompressed data
+            body = decompressor.decompress(
+                request.body, settings.DATA_UPLOAD_MAX_MEMORY_SIZE or 0
+            )
+        except zlib.error:
+            return JsonResponse({"error": "Invalid body"}, status=400)
+        if decompressor.unconsumed_tail:
+            return JsonResponse({"error": "Request too large"}, status=413)
+        if not decompressor.eof:
+            return JsonResponse({"error": "Invalid body"}, status=400)
+        post = QueryDict(body, encoding=request.encoding)
+    else:
+        post = request.POST
+
     # check data
-    lines = request.POST.get("lines")
-    if not lines:
+    # "records" are sent by recent dispatchers, one "<lvl> <dt> <line>" by
+    # line. "lines" is the previous format: a yaml list of log lines.
+    records_data = post.get("records")
+    lines = post.get("lines")
+    if not records_data and not lines:
         return JsonResponse({"error": "Missing 'lines'"}, status=400)
-    line_idx = request.POST.get("index")
+    line_idx = post.get("index")
     if line_idx is None:
         return JsonResponse({"error": "Missing 'index'"}, status=400)
     try:
@@ -1315,19 +1351,35 @@ def internal_v1_jobs_logs(request, pk):
     except ValueError:
         return JsonResponse({"error": "Invalid 'index'"}, status=400)
 
-    # TODO: leaky logutils abstraction
-    path = Path(job.output_dir)
-    path.mkdir(mode=0o755, parents=True, exist_ok=True)
-    output = (path / "output.yaml").open("ab")
-    index = (path / "output.idx").open("ab")
-    line_skip = logs_instance.line_count(job) - line_idx
+    # Only the results and events are parsed: the other lines are stored
+    # verbatim.
+    if records_data:
+        entries = []
+        for record in records_data.split("\n"):
+            try:
+                (lvl, dt, data) = record.split(" ", 2)
+            except ValueError:
+                return JsonResponse({"error": "Invalid 'records'"}, status=400)
+            entries.append((lvl, dt, "- " + data, None))
+    else:
+        entries = [
+            (line["lvl"], line.get("dt"), string, line)
+            for line, string in zip(yaml_safe_load(lines), lines.split("\n"))
+        ]
+
+    previous_count = logs_instance.line_count(job)
+    line_skip = previous_count - line_idx
 
     # TODO: use a database transaction so all or none objects are saved
     # TODO: except exceptions and return the number
     #       of lines that where actually parsed !!
-    test_cases = []
+    results = []
+    records = []
+    markers = []
     line_count = 0
-    for line, string in zip(yaml_safe_load(lines), lines.split("\n")):
+    for lvl, dt, string, line in entries:
+        if line is None and lvl in ["event", "results"]:
+            line = load(string[2:])
         # skip lines that where already saved to disk
         duplicated = False
         if line_skip > 0:
@@ -1335,18 +1387,27 @@ def internal_v1_jobs_logs(request, pk):
             line_skip -= 1
         else:
             # Handle lava-event
-            if line["lvl"] == "event":
+            if lvl == "event":
                 send_event(
                     ".event", "lavaserver", {"message": line["msg"], "job": job.id}
                 )
-                line["lvl"] = "debug"
+                lvl = line["lvl"] = "debug"
                 string = "- " + dump(line)
 
-            # Save the log line
-            logs_instance.write(job, (string + "\n").encode("utf-8"), output, index)
+            records.append(((string + "\n").encode("utf-8"), lvl, dt))
+
+            # Record the start and end of the actions for job_timing
+            if lvl in ["debug", "info"] and (
+                line is not None or timing_instance.candidate(string)
+            ):
+                if line is None:
+                    line = load(string[2:])
+                marker = timing_instance.marker(line)
+                if marker is not None:
+                    markers.append(marker)
 
         # handle test case results
-        if line["lvl"] == "results":
+        if lvl == "results":
             starttc = endtc = None
             with contextlib.suppress(KeyError):
                 starttc = line["msg"]["starttc"]
@@ -1354,37 +1415,48 @@ def internal_v1_jobs_logs(request, pk):
             with contextlib.suppress(KeyError):
                 endtc = line["msg"]["endtc"]
                 del line["msg"]["endtc"]
-            meta_filename = create_metadata_store(line["msg"], job)
-            new_test_case = map_scanned_results(
-                results=line["msg"],
-                job=job,
-                starttc=starttc,
-                endtc=endtc,
-                meta_filename=meta_filename,
-            )
-
-            if new_test_case is not None:
-                # If the log lines are a resubmission of a previous failed
-                # submission, count the number of TestCase that are identical
-                # to the new one. This will avoid saving multiple time the same
-                # TestCase
-                count = 0
-                if duplicated:
-                    count = TestCase.objects.filter(
-                        name=new_test_case.name,
-                        units=new_test_case.units,
-                        result=new_test_case.result,
-                        measurement=new_test_case.measurement,
-                        metadata=new_test_case.metadata,
-                        suite=new_test_case.suite,
-                        start_log_line=new_test_case.start_log_line,
-                        end_log_line=new_test_case.end_log_line,
-                        test_set=new_test_case.test_set,
-                    ).count()
-                if count == 0:
-                    test_cases.append(new_test_case)
+            results.append((line["msg"], starttc, endtc, duplicated))
         line_count += 1
 
+    # Save the log lines at once
+    logs_instance.write_lines(job, records)
+    # The timing markers are only recorded when the first lines are received
+    if records and (markers or not previous_count):
+        timing_instance.write(job, markers, append=bool(previous_count))
+    # Notify lava-publisher so the lines are pushed to the log viewers
+    if records and settings.EVENT_NOTIFICATION:
+        send_event(
+            ".logs", "lavaserver", {"job": job.id, "line_count": line_idx + line_count}
+        )
+
+    # Map the results to test cases: the metadata stores are written once,
+    # and the suites and sets are only looked up once per request.
+    meta_filenames = create_metadata_stores([r[0] for r in results], job)
+    cache = {}
+    test_cases = []
+    duplicates = []
+    for (msg, starttc, endtc, duplicated), meta_filename in zip(
+        results, meta_filenames
+    ):
+        new_test_case = map_scanned_results(
+            results=msg,
+            job=job,
+            starttc=starttc,
+            endtc=endtc,
+            meta_filename=meta_filename,
+            cache=cache,
+        )
+        if new_test_case is None:
+            continue
+        # If the log lines are a resubmission of a previous failed
+        # submission, skip the TestCase that are already saved.
+        if duplicated:
+            duplicates.append(new_test_case)
+        else:
+            test_cases.append(new_test_case)
+    # Duplicated lines are always at the beginning of the request
+    test_cases = new_test_cases(job, duplicates) + test_cases
+
     # Save the new test cases
     try:
         TestCase.objects.bulk_create(test_cases)
@@ -1765,6 +1837,7 @@ def job_detail(request, pk):
         "job_tags": job.tags.all(),
         "size_limit": job.size_limit,
         "validation_errors": validation_errors,
+        "log_streaming": settings.EVENT_NOTIFICATION,
     }
 
     try:
@@ -2074,62 +2147,41 @@ def job_status(request, pk):
 
 def job_timing(request, pk):
     job = get_restricted_job(request.user, pk, request=request)
-    try:
-        data = logs_instance.read(job)
-        logs = yaml_safe_load(data)
-    except OSError:
-        raise Http404
-
-    # start and end patterns
-    pattern_start = re.compile(
-        "^start: (?P<level>[\\d.]+) (?P<action>[\\w_-]+) "
-        "\\(timeout (?P<timeout>\\d+:\\d+:\\d+)\\)"
-    )
-    pattern_end = re.compile(
-        "^end: (?P<level>[\\d.]+) (?P<action>[\\w_-]+) "
-        "\\(duration (?P<duration>\\d+:\\d+:\\d+)\\)"
-    )
+    # The markers are recorded while the logs are ingested. For older jobs,
+    # parse the logs and keep the markers once the job is finished.
+    markers = timing_instance.read(job)
+    if markers is None:
+        markers = []
+        try:
+            for lines in logs_instance.iter_lines(job):
+                markers.extend(timing_instance.markers(lines))
+        except OSError:
+            raise Http404
+        if job.state == TestJob.STATE_FINISHED:
+            with contextlib.suppress(OSError):
+                timing_instance.write(job, markers, append=False)
 
     timings = {}
     total_duration = 0
     max_duration = 0
     summary = []
-    for line in logs:
-        # Only parse debug and info levels
-        if line["lvl"] not in ["debug", "info"]:
+    for kind, level, action, seconds in markers:
+        if kind == "start":
+            timings[level] = {"name": action, "timeout": seconds}
             continue
 
-        # Will raise if the log message is a python object
-        try:
-            match = pattern_start.match(line["msg"])
-        except TypeError:
+        # TODO: validate does not have a proper start line
+        if action == "validate":
             continue
+        duration = seconds
+        # We create the entry because with some timeout, the start line
+        # might be missing.
+        timings.setdefault(level, {})["duration"] = duration
 
-        if match is not None:
-            d = match.groupdict()
-            parts = d["timeout"].split(":")
-            timeout = float(parts[0]) * 3600 + float(parts[1]) * 60 + float(parts[2])
-            timings[d["level"]] = {"name": d["action"], "timeout": float(timeout)}
-            continue
-
-        # No need to catch TypeError here as we know it's a string
-        match = pattern_end.match(line["msg"])
-        if match is not None:
-            d = match.groupdict()
-            # TODO: validate does not have a proper start line
-            if d["action"] == "validate":
-                continue
-            level = d["level"]
-            parts = d["duration"].split(":")
-            duration = float(parts[0]) * 3600 + float(parts[1]) * 60 + float(parts[2])
-            # We create the entry because with some timeout, the start line
-            # might be missing.
-            timings.setdefault(level, {})["duration"] = duration
-
-            max_duration = max(max_duration, duration)
-            if "." not in level:
-                total_duration += duration
-                summary.append([d["action"], duration, 0])
+        max_duration = max(max_duration, duration)
+        if "." not in level:
+            total_duration += duration
+            summary.append([action, duration, 0])
 
     levels = sorted(timings.keys())
 
@@ -2223,29 +2275,30 @@ def job_log_incremental(request, pk):
         response["X-Size-Warning"] = "1"
         return response
 
-    try:
-        data = logs_instance.read(job, first_line)
-        data = yaml_safe_load(data)
-        # When reaching EOF, yaml.load does return None instead of []
-        if not data:
-            data = []
-        else:
-            for line in data:
-                line["msg"] = udecode(line["msg"])
-                if line["lvl"] == "results":
-                    definition = line["msg"].get("definition")
-                    case = line["msg"].get("case")
-                    if definition and case:
-                        case_id = TestCase.objects.filter(
-                            suite__job=job, suite__name=definition, name=case
-                        ).values_list("id", flat=True)
-                        if case_id:
-                            line["msg"]["case_id"] = case_id[0]
+    def prepare(lines):
+        for line in lines:
+            line["msg"] = udecode(line["msg"])
+        map_log_results(job, lines)
+        return lines
 
+    # Stream the lines by chunks
+    try:
+        chunks = logs_instance.iter_lines(job, first_line)
+        first = prepare(next(chunks, []))
     except (OSError, StopIteration, yaml.YAMLError):
-        data = []
-
-    response = JsonResponse(data, safe=False)
+        chunks = iter(())
+        first = []
+
+    def stream():
+        separator = "["
+        with contextlib.suppress(OSError, StopIteration, yaml.YAMLError):
+            for lines in itertools.chain([first], map(prepare, chunks)):
+                for line in lines:
+                    yield separator + json_dumps(line, cls=DjangoJSONEncoder)
+                    separator = ", "
+        yield "[]" if separator == "[" else "]"
+
+    response = StreamingHttpResponse(stream(), content_type="application/json")
 
     if job.state == TestJob.STATE_FINISHED:
         response["X-Is-Finished"] = "1"
@@ -23,6 +23,7 @@ from django.utils import timezone
 
 from lava_common.schemas import validate
 from lava_common.yaml import yaml_safe_load
+from lava_scheduler_app.logutils import LogsFilesystem
 from lava_scheduler_app.models import TestJob
 
 
@@ -32,6 +33,13 @@ def _create_output_size(base, size):
         chown(str(base / "output.yaml.size"), "lavaserver", "lavaserver")
 
 
+def _compress_logs(job, base, data):
+    LogsFilesystem().compress(job, data)
+    with contextlib.suppress(PermissionError):
+        chown(str(base / "output.yaml.xz"), "lavaserver", "lavaserver")
+        chown(str(base / "output.yaml.xz.blocks"), "lavaserver", "lavaserver")
+
+
 class Command(BaseCommand):
     help = "Manage jobs"
 
@@ -187,6 +195,40 @@ class Command(BaseCommand):
             help="Be nice with the system by sleeping regularly",
         )
 
+        recomp = sub.add_parser(
+            "recompress",
+            help="Convert the compressed job logs to the seekable block format",
+        )
+        recomp.add_argument(
+            "--newer-than",
+            default=None,
+            type=str,
+            help="Convert jobs newer than this. The time is of the "
+            "form: 1h (one hour) or 2d (two days).",
+        )
+        recomp.add_argument(
+            "--older-than",
+            default=None,
+            type=str,
+            help="Convert jobs older than this. The time is of the "
+            "form: 1h (one hour) or 2d (two days).",
+        )
+        recomp.add_argument(
+            "--submitter", default=None, type=str, help="Filter jobs by submitter"
+        )
+        recomp.add_argument(
+            "--dry-run",
+            default=False,
+            action="store_true",
+            help="Do not convert any logs, simulate the output",
+        )
+        recomp.add_argument(
+            "--slow",
+            default=False,
+            action="store_true",
+            help="Be nice with the system by sleeping regularly",
+        )
+
     def handle(self, *_, **options):
         """forward to the right sub-handler"""
         if options["sub_command"] == "list":
@@ -221,6 +263,14 @@ class Command(BaseCommand):
                 options["dry_run"],
                 options["slow"],
             )
+        elif options["sub_command"] == "recompress":
+            self.handle_recompress(
+                options["older_than"],
+                options["newer_than"],
+                options["submitter"],
+                options["dry_run"],
+                options["slow"],
+            )
 
     def handle_fail(self, job_id):
         try:
@@ -399,10 +449,7 @@ class Command(BaseCommand):
                 mail_admins("Invalid jobs", body)
             raise CommandError("Some jobs are invalid")
 
-    def handle_compress(self, older_than, newer_than, submitter, simulate, slow):
-        if not older_than and not newer_than and not submitter:
-            raise CommandError("You should specify at least one filtering option")
-
+    def _finished_jobs(self, older_than, newer_than, submitter):
         jobs = TestJob.objects.all().order_by("id").filter(state=TestJob.STATE_FINISHED)
         if older_than is not None:
             pattern = re.compile(r"^(?P<time>\d+)(?P<unit>(h|d))$")
@@ -434,6 +481,13 @@ class Command(BaseCommand):
             except User.DoesNotExist:
                 raise CommandError("Unable to find submitter '%s'" % submitter)
             jobs = jobs.filter(submitter=user)
+        return jobs
+
+    def handle_compress(self, older_than, newer_than, submitter, simulate, slow):
+        if not older_than and not newer_than and not submitter:
+            raise CommandError("You should specify at least one filtering option")
+
+        jobs = self._finished_jobs(older_than, newer_than, submitter)
 
         # Only job.id, job.end_time, job.output_dir are used
         # job.output_dir uses job.submit_time
@@ -466,10 +520,7 @@ class Command(BaseCommand):
                     # Save the uncompressed size for later use
                     _create_output_size(base, len(data))
                     # Compresse the logs
-                    with lzma.open(str(base / "output.yaml.xz"), "wb") as f_out:
-                        f_out.write(data)
-                    with contextlib.suppress(PermissionError):
-                        chown(str(base / "output.yaml.xz"), "lavaserver", "lavaserver")
+                    _compress_logs(job, base, data)
                     # Remove the original file
                     (base / "output.yaml").unlink()
             except OSError as exc:
@@ -480,3 +531,41 @@ class Command(BaseCommand):
                 time.sleep(2)
 
         self.stdout.write(f"Compressed {index+1} jobs.")
+
+    def handle_recompress(self, older_than, newer_than, submitter, simulate, slow):
+        if not older_than and not newer_than and not submitter:
+            raise CommandError("You should specify at least one filtering option")
+
+        jobs = self._finished_jobs(older_than, newer_than, submitter)
+        jobs = jobs.values("pk", "end_time", "submit_time")
+        count = 0
+        for index, job_data in enumerate(jobs.iterator(chunk_size=100)):
+            job = TestJob(**job_data)
+            base = pathlib.Path(job.output_dir)
+            if (base / "output.yaml").exists() or not (
+                base / "output.yaml.xz"
+            ).exists():
+                continue
+            if (base / "output.yaml.xz.blocks").exists():
+                self.stdout.write(
+                    "* %d (%s): %s [SKIP]" % (job.id, job.end_time, job.output_dir)
+                )
+                continue
+
+            self.stdout.write("* %d (%s): %s" % (job.id, job.end_time, job.output_dir))
+            count += 1
+            try:
+                if not simulate:
+                    with lzma.open(str(base / "output.yaml.xz"), "rb") as f_in:
+                        data = f_in.read()
+                    _compress_logs(job, base, data)
+                    if not (base / "output.yaml.size").exists():
+                        _create_output_size(base, len(data))
+            except (OSError, lzma.LZMAError) as exc:
+                self.stderr.write("  -> Unable to convert the logs: %s" % str(exc))
+
+            if slow and index % 100 == 99:
+                self.stdout.write("sleeping 2s...")
+                time.sleep(2)
+
+        self.stdout.write(f"Converted {count} jobs.")
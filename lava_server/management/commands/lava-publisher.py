@@ -7,27 +7,37 @@
 import asyncio
 import base64
 import contextlib
+import datetime
 import json
 import signal
+import uuid
 import weakref
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from importlib import import_module
 from typing import Any
+from urllib.parse import urlparse
 
 import aiohttp
+import yaml
 import zmq
 import zmq.asyncio
 from aiohttp import web
 from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.contrib.auth import SESSION_KEY
 from django.contrib.auth.models import AnonymousUser, User
 from django.utils.crypto import constant_time_compare
 
 from lava_common.version import __version__
+from lava_results_app.dbutils import map_log_results
+from lava_scheduler_app.logutils import logs_instance
 from lava_scheduler_app.models import Device, TestJob, Worker
 from lava_server.cmdutils import LAVADaemonCommand
 from linaro_django_xmlrpc.models import AuthToken
 
 TIMEOUT = 5
+# Maximum number of log lines sent in each message
+LOGS_CHUNK_LINES = 1000
 FORMAT = "%(asctime)-15s %(levelname)7s %(message)s"
 
 
@@ -41,6 +51,142 @@ class Websocket:
         return hash((self.kind, self.name, id(self.socket)))
 
 
+@dataclass
+class LogsSubscription:
+    job: TestJob
+    # Next line to send to each websocket
+    sockets: dict = field(default_factory=dict)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+async def get_user(name):
+    user = AnonymousUser()
+    if name:
+        with contextlib.suppress(User.DoesNotExist):
+            user = await sync_to_async(User.objects.get)(username=name)
+    return user
+
+
+def get_session_user(session_key):
+    session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    with contextlib.suppress(KeyError, ValueError, User.DoesNotExist):
+        return User.objects.get(pk=session[SESSION_KEY])
+    return None
+
+
+def read_log_lines(job, start, end):
+    try:
+        lines = logs_instance.read_lines(job, start, end)
+    except (OSError, ValueError, yaml.YAMLError):
+        return []
+    map_log_results(job, lines)
+    return lines
+
+
+def logs_event(job_id, data):
+    # Same format as the events: [topic, uuid, datetime, username, data]
+    return [
+        settings.EVENT_TOPIC + ".logs",
+        str(uuid.uuid1()),
+        datetime.datetime.utcnow().isoformat(),
+        "lavaserver",
+        json.dumps({"job": job_id, **data}),
+    ]
+
+
+async def push_logs(app, job_id):
+    subscription = app["logs"].get(job_id)
+    if subscription is None:
+        return
+
+    async with subscription.lock:
+        job = subscription.job
+        size = await sync_to_async(logs_instance.size)(job)
+        if size is not None and size >= job.size_limit:
+            msg = logs_event(job_id, {"size_warning": True})
+            futures = [ws.socket.send_json(msg) for ws in subscription.sockets]
+            app["logs"].pop(job_id, None)
+            await asyncio.gather(*futures, return_exceptions=True)
+            return
+
+    # The lines are sent by chunks and the lock is only held for one chunk at
+    # a time, so late joiners do not get the whole logs in one message.
+    more = True
+    while more:
+        more = False
+        async with subscription.lock:
+            futures = []
+            # Sockets are usually at the same position: read the lines once
+            for start in sorted(set(subscription.sockets.values())):
+                lines = await sync_to_async(read_log_lines)(
+                    job, start, start + LOGS_CHUNK_LINES
+                )
+                if not lines:
+                    continue
+                more = more or len(lines) >= LOGS_CHUNK_LINES
+                msg = logs_event(job_id, {"line": start, "logs": lines})
+                for ws, line in list(subscription.sockets.items()):
+                    if line == start:
+                        subscription.sockets[ws] = start + len(lines)
+                        futures.append(ws.socket.send_json(msg))
+            await asyncio.gather(*futures, return_exceptions=True)
+
+
+async def finish_logs(app, job_id):
+    await push_logs(app, job_id)
+    subscription = app["logs"].pop(job_id, None)
+    if subscription is None:
+        return
+    msg = logs_event(job_id, {"finished": True})
+    await asyncio.gather(
+        *[ws.socket.send_json(msg) for ws in subscription.sockets],
+        return_exceptions=True,
+    )
+
+
+def unsubscribe(app, ws, job_id=None):
+    for key in [job_id] if job_id is not None else list(app["logs"]):
+        subscription = app["logs"].get(key)
+        if subscription is None:
+            continue
+        subscription.sockets.pop(ws, None)
+        if not subscription.sockets:
+            del app["logs"][key]
+
+
+async def handle_request(app, ws, text):
+    try:
+        data = json.loads(text)
+        action = data["action"]
+        job_id = int(data["job"])
+        start = max(int(data.get("line", 0)), 0)
+    except (KeyError, TypeError, ValueError):
+        await ws.socket.send_json({"error": "Invalid request"})
+        return
+
+    if action == "subscribe":
+        try:
+            job = await sync_to_async(TestJob.objects.get)(id=job_id)
+        except TestJob.DoesNotExist:
+            await ws.socket.send_json({"error": f"Unknown job '{job_id}'"})
+            return
+        user = await get_user(ws.name)
+        if not await sync_to_async(job.can_view)(user):
+            await ws.socket.send_json({"error": f"Unknown job '{job_id}'"})
+            return
+        subscription = app["logs"].setdefault(job_id, LogsSubscription(job=job))
+        subscription.sockets[ws] = start
+        # Send the lines already available
+        if job.state == TestJob.STATE_FINISHED:
+            await finish_logs(app, job_id)
+        else:
+            await push_logs(app, job_id)
+    elif action == "unsubscribe":
+        unsubscribe(app, ws, job_id)
+    else:
+        await ws.socket.send_json({"error": f"Unknown action '{action}'"})
+
+
 async def zmq_proxy(app):
     logger = app["logger"]
 
@@ -75,8 +221,13 @@ async def zmq_proxy(app):
         additional_sockets.append(sock)
 
     async def forward_event(msg):
-        logger.debug("[PROXY] Forwarding: %s", msg)
         data = [s.decode("utf-8") for s in msg]
+        # New log lines are only sent to the subscribed websockets
+        if data[0].endswith(".logs"):
+            await push_logs(app, json.loads(data[4])["job"])
+            return
+
+        logger.debug("[PROXY] Forwarding: %s", msg)
         futures = [
             pub.send_multipart(msg),
             *[s.send_multipart(msg, flags=zmq.DONTWAIT) for s in additional_sockets],
@@ -90,12 +241,7 @@ async def zmq_proxy(app):
             for ws in set(app["websockets"]):
                 # Only forward to users as workers will discard it
                 if ws.kind == "user":
-                    user = AnonymousUser()
-                    if ws.name:
-                        with contextlib.suppress(User.DoesNotExist):
-                            user = await sync_to_async(User.objects.get)(
-                                username=ws.name
-                            )
+                    user = await get_user(ws.name)
                     if await sync_to_async(device.can_view)(user):
                         futures.append(ws.socket.send_json(data))
 
@@ -108,12 +254,7 @@ async def zmq_proxy(app):
                     await asyncio.sleep(1)
             for ws in set(app["websockets"]):
                 if ws.kind == "user":
-                    user = AnonymousUser()
-                    if ws.name:
-                        with contextlib.suppress(User.DoesNotExist):
-                            user = await sync_to_async(User.objects.get)(
-                                username=ws.name
-                            )
+                    user = await get_user(ws.name)
                     if await sync_to_async(job.can_view)(user):
                         futures.append(ws.socket.send_json(data))
                 elif ws.kind == "worker":
@@ -134,6 +275,9 @@ async def zmq_proxy(app):
 
         await asyncio.gather(*futures)
 
+        if topic.endswith(".testjob") and content.get("state") == "Finished":
+            await finish_logs(app, content["job"])
+
     with contextlib.suppress(asyncio.CancelledError):
         logger.info("[PROXY] waiting for events")
         while True:
@@ -226,6 +370,18 @@ async def websocket_handler(request):
             await ws.close()
             return ws
 
+    elif request.cookies.get(settings.SESSION_COOKIE_NAME):
+        # Browsers are authenticated with their session, only when connecting
+        # from the same site.
+        host = request.headers.get("X-Forwarded-Host", request.host).split(",")[0]
+        origin = request.headers.get("Origin")
+        if origin is None or urlparse(origin).netloc == host.strip():
+            user = await sync_to_async(get_session_user)(
+                request.cookies[settings.SESSION_COOKIE_NAME]
+            )
+            if user is not None:
+                name = user.username
+
     if name:
         logger.info("[WS] connection from %s %s@%s", kind, name, request.remote)
     else:
@@ -238,8 +394,11 @@ async def websocket_handler(request):
         async for msg in ws:
             if msg.type == aiohttp.WSMsgType.ERROR:
                 logger.exception(ws.exception())
+            elif msg.type == aiohttp.WSMsgType.TEXT and obj.kind == "user":
+                await handle_request(request.app, obj, msg.data)
     finally:
         request.app["websockets"].discard(obj)
+        unsubscribe(request.app, obj)
 
     if obj.name:
         logger.info(
@@ -304,6 +463,7 @@ class Command(LAVADaemonCommand):
         # Variables
         app["logger"] = self.logger
         app["websockets"] = weakref.WeakSet()
+        app["logs"] = {}
         app["zmq_proxy"] = None
 
         # Routes
@@ -19,7 +19,7 @@ from django.utils import timezone
 
 from lava_common.version import __version__
 from lava_scheduler_app.models import Worker
-from lava_scheduler_app.scheduler import schedule
+from lava_scheduler_app.scheduler import WorkersView, schedule
 from lava_server.cmdutils import LAVADaemonCommand
 
 #############
@@ -38,6 +38,13 @@ class Command(LAVADaemonCommand):
     help = "LAVA scheduler"
     default_logfile = "/var/log/lava-server/lava-scheduler.log"
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Online workers and their load, kept up to date by the event stream
+        # between two full passes.
+        self.workers = []
+        self.view = WorkersView()
+
     def add_arguments(self, parser):
         super().add_arguments(parser)
         net = parser.add_argument_group("network")
@@ -123,7 +130,11 @@ class Command(LAVADaemonCommand):
                 msg_part_list = self.sub.recv_multipart(zmq.NOBLOCK, copy=True)
                 try:
                     topic = msg_part_list[0].decode("utf-8")
-                    if not (topic.endswith(".testjob") or topic.endswith(".device")):
+                    if not (
+                        topic.endswith(".testjob")
+                        or topic.endswith(".device")
+                        or topic.endswith(".worker")
+                    ):
                         continue
 
                     data = json_loads(msg_part_list[4])
@@ -138,31 +149,57 @@ class Command(LAVADaemonCommand):
                     if data["state"] == "Submitted":
                         device_types.add(data["device_type"])
                 elif topic.endswith(".device"):
+                    if "device" in data:
+                        self.view.update_device(
+                            data["device"],
+                            data.get("worker"),
+                            data["device_type"],
+                            data["state"],
+                        )
                     if data["state"] == "Idle" and data["health"] in (
                         "Good",
                         "Unknown",
                         "Looping",
                     ):
                         device_types.add(data["device_type"])
+                elif topic.endswith(".worker"):
+                    hostname = data["hostname"]
+                    self.workers = [w for w in self.workers if w != hostname]
+                    if data["state"] == "Online" and data["health"] == "Active":
+                        self.workers.append(hostname)
+                        device_types |= self.view.device_types(hostname)
 
         return device_types
 
     def main_loop(self) -> None:
         dts: set[str] = set()
+        last_full = None
         while True:
             begin = time.monotonic()
             try:
-                # Check remote worker connectivity
-                with transaction.atomic():
-                    workers = self.check_workers()
+                # Run a full pass when no events were received or at least
+                # every INTERVAL. Otherwise only look at the device types that
+                # changed, using the in memory view of the workers.
+                if (
+                    not dts
+                    or last_full is None
+                    or begin - last_full >= INTERVAL
+                    or not self.view.is_known(self.workers)
+                ):
+                    # Check remote worker connectivity
+                    with transaction.atomic():
+                        self.workers = self.check_workers()
+                    self.view.reconcile()
+                    dts = set()
+                    last_full = begin
 
                 # Schedule jobs
-                schedule(self.logger, dts, workers)
+                schedule(self.logger, dts, self.workers, self.view.summary())
                 dts = set()
 
                 # Wait for events
-                while not dts and (time.monotonic() - begin) < INTERVAL:
-                    timeout = max(INTERVAL - (time.monotonic() - begin), 0)
+                while not dts and (time.monotonic() - last_full) < INTERVAL:
+                    timeout = max(INTERVAL - (time.monotonic() - last_full), 0)
                     with contextlib.suppress(zmq.ZMQError):
                         self.poller.poll(max(timeout * 1000, 1))
                     dts = self.get_available_dts()
@@ -172,4 +209,5 @@ class Command(LAVADaemonCommand):
                 # Closing the database connection will force Django to reopen
                 # the connection
                 connection.close()
+                last_full = None
                 time.sleep(2)
@@ -0,0 +1,493 @@
+# Copyright (C) 2026 Linaro Limited
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import contextlib
+import datetime
+import json
+import logging
+import random
+import statistics
+import tempfile
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.test.utils import setup_databases, teardown_databases
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from jinja2.sandbox import SandboxedEnvironment as JinjaSandboxEnv
+
+from lava_common.yaml import yaml_safe_dump
+from lava_scheduler_app import environment, signals
+from lava_scheduler_app.models import Device, DeviceType, Tag, TestJob, Worker
+from lava_scheduler_app.scheduler import schedule
+from lava_server.files import File
+
+SNAPSHOT_VERSION = 1
+
+# Signal handlers sending events and notifications. They are disconnected
+# while running the benchmark.
+HANDLERS = [
+    (TestJob, signals.testjob_notifications, "testjob_notifications"),
+    (TestJob, signals.testjob_post_handler, "testjob_post_handler"),
+    (Device, signals.device_post_handler, "device_post_handler"),
+    (Worker, signals.worker_post_handler, "worker_post_handler"),
+]
+
+
+@contextlib.contextmanager
+def no_events():
+    disconnected = [
+        (sender, receiver, uid)
+        for (sender, receiver, uid) in HANDLERS
+        if post_save.disconnect(sender=sender, dispatch_uid=uid)
+    ]
+    try:
+        yield
+    finally:
+        for sender, receiver, uid in disconnected:
+            post_save.connect(receiver, sender=sender, weak=False, dispatch_uid=uid)
+
+
+@contextlib.contextmanager
+def device_dictionaries(hostnames, template):
+    """
+    Create a device dictionary for every device that does not have one and add
+    them to the device search path.
+    """
+    paths = File.KINDS["device"][0]
+    with tempfile.TemporaryDirectory(prefix="lava-scheduler-benchmark-") as tmp:
+        for hostname in hostnames:
+            if not File("device", hostname).exists():
+                (Path(tmp) / f"{hostname}.jinja2").write_text(
+                    "{%% extends '%s.jinja2' %%}\n" % template, encoding="utf-8"
+                )
+        paths.append(tmp)
+        # The jinja environment keeps the loader and the templates
+        token = environment.devices_jinja_env.set(
+            JinjaSandboxEnv(
+                loader=File("device").loader(),
+                autoescape=False,
+                trim_blocks=True,
+                cache_size=-1,
+            )
+        )
+        try:
+            yield
+        finally:
+            environment.devices_jinja_env.reset(token)
+            paths.remove(tmp)
+
+
+def take_snapshot():
+    """
+    Record the devices and the queue of the current instance.
+    """
+    jobs = TestJob.objects.filter(
+        state__in=[TestJob.STATE_SUBMITTED, TestJob.STATE_SCHEDULING]
+    )
+    jobs = jobs.select_related("submitter", "requested_device_type", "actual_device")
+    jobs = jobs.prefetch_related("tags")
+    devices = Device.objects.exclude(health=Device.HEALTH_RETIRED)
+    devices = devices.prefetch_related("tags")
+
+    return {
+        "version": SNAPSHOT_VERSION,
+        "workers": [
+            {
+                "hostname": w.hostname,
+                "state": w.state,
+                "health": w.health,
+                "job_limit": w.job_limit,
+            }
+            for w in Worker.objects.order_by("hostname")
+        ],
+        "device_types": [
+            {
+                "name": dt.name,
+                "display": dt.display,
+                "disable_health_check": dt.disable_health_check,
+                "health_frequency": dt.health_frequency,
+                "health_denominator": dt.health_denominator,
+            }
+            for dt in DeviceType.objects.order_by("name")
+        ],
+        "devices": [
+            {
+                "hostname": d.hostname,
+                "device_type": d.device_type_id,
+                "worker": d.worker_host_id,
+                "state": d.state,
+                "health": d.health,
+                "tags": sorted(t.name for t in d.tags.all()),
+            }
+            for d in devices.order_by("hostname")
+        ],
+        "jobs": [
+            {
+                "id": j.id,
+                "device_type": j.requested_device_type_id,
+                "submitter": j.submitter.username,
+                "priority": j.priority,
+                "submit_time": j.submit_time.isoformat(),
+                "tags": sorted(t.name for t in j.tags.all()),
+                "state": j.state,
+                "device": j.actual_device_id,
+                "target_group": j.target_group,
+                "sub_id": j.sub_id,
+                "requirements": j.get_requirements(),
+                # Only multinode definitions are used by the scheduler
+                "definition": j.definition if j.is_multinode else "",
+            }
+            for j in jobs.order_by("id")
+        ],
+    }
+
+
+def synthetic_snapshot(
+    seed, workers, device_types, devices, jobs, tags, multinode, vland
+):
+    """
+    Generate the snapshot of a synthetic lab.
+    """
+    rand = random.Random(seed)
+    now = timezone.now()
+    tag_names = [f"tag-{i:02d}" for i in range(0, tags)]
+    dt_names = [f"dt-{i:03d}" for i in range(0, device_types)]
+
+    data = {
+        "version": SNAPSHOT_VERSION,
+        "workers": [
+            {
+                "hostname": f"worker-{i:03d}",
+                "state": Worker.STATE_ONLINE,
+                "health": Worker.HEALTH_ACTIVE,
+                "job_limit": 0,
+            }
+            for i in range(0, workers)
+        ],
+        "device_types": [
+            {
+                "name": name,
+                "display": True,
+                "disable_health_check": True,
+                "health_frequency": 24,
+                "health_denominator": DeviceType.HEALTH_PER_HOUR,
+            }
+            for name in dt_names
+        ],
+        "devices": [],
+        "jobs": [],
+    }
+
+    for i in range(0, devices):
+        state = rand.choices([Device.STATE_IDLE, Device.STATE_RUNNING], weights=[8, 2])[
+            0
+        ]
+        health = rand.choices(
+            [Device.HEALTH_GOOD, Device.HEALTH_MAINTENANCE], weights=[19, 1]
+        )[0]
+        data["devices"].append(
+            {
+                "hostname": f"device-{i:04d}",
+                "device_type": dt_names[i % device_types],
+                "worker": f"worker-{i % workers:03d}",
+                "state": state,
+                "health": health,
+                "tags": sorted(rand.sample(tag_names, rand.randint(0, len(tag_names)))),
+            }
+        )
+
+    def job(dt, submit_time, **kwargs):
+        requested = []
+        if tag_names and rand.random() < 0.2:
+            requested = [rand.choice(tag_names)]
+        ret = {
+            "id": len(data["jobs"]) + 1,
+            "device_type": dt,
+            "submitter": f"user-{rand.randint(0, 9):02d}",
+            "priority": rand.randint(0, 100),
+            "submit_time": submit_time.isoformat(),
+            "tags": requested,
+            "state": TestJob.STATE_SUBMITTED,
+            "device": None,
+            "target_group": "",
+            "sub_id": "",
+            "requirements": {},
+            "definition": "",
+        }
+        ret.update(kwargs)
+        data["jobs"].append(ret)
+
+    for i in range(0, jobs):
+        submit_time = now - datetime.timedelta(seconds=jobs - i)
+        requirements = {}
+        if i < vland:
+            requirements = {"vland": {"vlan_one": {"tags": ["10G"]}}}
+        job(rand.choice(dt_names), submit_time, requirements=requirements)
+
+    for group in range(0, multinode):
+        submit_time = now - datetime.timedelta(seconds=rand.randint(0, jobs))
+        target_group = f"group-{group:03d}"
+        for role in ["server"] + ["client"] * rand.randint(1, 3):
+            definition = {"protocols": {"lava-multinode": {"role": role}}}
+            job(
+                rand.choice(dt_names),
+                submit_time,
+                target_group=target_group,
+                sub_id=f"{group}.{len(data['jobs'])}",
+                requirements={"role": role},
+                definition=yaml_safe_dump(definition),
+            )
+
+    return data
+
+
+def load_snapshot(data):
+    """
+    Create the objects recorded in the snapshot and return the list of workers
+    that can run jobs.
+    """
+    if data.get("version") != SNAPSHOT_VERSION:
+        raise CommandError("Unsupported snapshot version")
+
+    for w in data["workers"]:
+        Worker.objects.create(
+            hostname=w["hostname"],
+            state=w["state"],
+            health=w["health"],
+            job_limit=w["job_limit"],
+            last_ping=timezone.now(),
+        )
+    for dt in data["device_types"]:
+        DeviceType.objects.create(
+            name=dt["name"],
+            display=dt["display"],
+            disable_health_check=dt["disable_health_check"],
+            health_frequency=dt["health_frequency"],
+            health_denominator=dt["health_denominator"],
+        )
+    names = {t for d in data["devices"] for t in d["tags"]}
+    names |= {t for j in data["jobs"] for t in j["tags"]}
+    tags = {name: Tag.objects.create(name=name) for name in sorted(names)}
+    users = {
+        username: User.objects.get_or_create(username=username)[0]
+        for username in sorted({j["submitter"] for j in data["jobs"]})
+    }
+
+    devices = Device.objects.bulk_create(
+        [
+            Device(
+                hostname=d["hostname"],
+                device_type_id=d["device_type"],
+                worker_host_id=d["worker"],
+                state=d["state"],
+                health=d["health"],
+            )
+            for d in data["devices"]
+        ]
+    )
+    Device.tags.through.objects.bulk_create(
+        [
+            Device.tags.through(device_id=device.hostname, tag_id=tags[name].pk)
+            for (device, d) in zip(devices, data["devices"])
+            for name in d["tags"]
+        ]
+    )
+
+    jobs = TestJob.objects.bulk_create(
+        [
+            TestJob(
+                requested_device_type_id=j["device_type"],
+                submitter=users[j["submitter"]],
+                priority=j["priority"],
+                state=j["state"],
+                actual_device_id=j["device"],
+                target_group=j["target_group"],
+                sub_id=j["sub_id"],
+                requirements=json.dumps(j["requirements"]),
+                definition=j["definition"],
+                is_public=True,
+            )
+            for j in data["jobs"]
+        ]
+    )
+    # submit_time is set by auto_now_add
+    for job, j in zip(jobs, data["jobs"]):
+        job.submit_time = parse_datetime(j["submit_time"])
+    TestJob.objects.bulk_update(jobs, ["submit_time"])
+    TestJob.tags.through.objects.bulk_create(
+        [
+            TestJob.tags.through(testjob_id=job.id, tag_id=tags[name].pk)
+            for (job, j) in zip(jobs, data["jobs"])
+            for name in j["tags"]
+        ]
+    )
+
+    return [
+        w["hostname"]
+        for w in data["workers"]
+        if w["state"] == Worker.STATE_ONLINE and w["health"] == Worker.HEALTH_ACTIVE
+    ]
+
+
+class Command(BaseCommand):
+    help = "Benchmark the scheduler on a synthetic lab or on a recorded queue"
+
+    def add_arguments(self, parser):
+        sub = parser.add_subparsers(dest="sub_command", help="Sub commands")
+        sub.required = True
+
+        snapshot = sub.add_parser(
+            "snapshot", help="Record the devices and the queue of this instance"
+        )
+        snapshot.add_argument("output", type=str, help="Path to the snapshot")
+
+        synthetic = sub.add_parser("synthetic", help="Benchmark a synthetic lab")
+        synthetic.add_argument(
+            "--seed", type=int, default=0, help="Seed of the random generator"
+        )
+        synthetic.add_argument(
+            "--workers", type=int, default=5, help="Number of workers"
+        )
+        synthetic.add_argument(
+            "--device-types", type=int, default=10, help="Number of device types"
+        )
+        synthetic.add_argument(
+            "--devices", type=int, default=100, help="Number of devices"
+        )
+        synthetic.add_argument(
+            "--jobs", type=int, default=1000, help="Number of queued jobs"
+        )
+        synthetic.add_argument("--tags", type=int, default=5, help="Number of tags")
+        synthetic.add_argument(
+            "--multinode", type=int, default=10, help="Number of multinode groups"
+        )
+        synthetic.add_argument(
+            "--vland", type=int, default=10, help="Number of jobs requesting vlans"
+        )
+        synthetic.add_argument(
+            "--output", type=str, default=None, help="Save the generated snapshot"
+        )
+
+        replay = sub.add_parser("replay", help="Benchmark a recorded snapshot")
+        replay.add_argument("input", type=str, help="Path to the snapshot")
+
+        for p in [synthetic, replay]:
+            p.add_argument(
+                "--iterations",
+                type=int,
+                default=5,
+                help="Number of scheduling passes",
+            )
+            p.add_argument(
+                "--template",
+                type=str,
+                default="qemu",
+                help="Device-type template used for devices without dictionary",
+            )
+            p.add_argument(
+                "--keepdb",
+                action="store_true",
+                default=False,
+                help="Preserve the test database between runs",
+            )
+
+    def handle(self, *_, **options):
+        self.verbosity = options["verbosity"]
+        if options["sub_command"] == "snapshot":
+            data = take_snapshot()
+            Path(options["output"]).write_text(json.dumps(data), encoding="utf-8")
+            self.stdout.write(
+                f"{len(data['devices'])} devices and {len(data['jobs'])} jobs recorded"
+            )
+            return
+
+        if options["sub_command"] == "synthetic":
+            data = synthetic_snapshot(
+                options["seed"],
+                options["workers"],
+                options["device_types"],
+                options["devices"],
+                options["jobs"],
+                options["tags"],
+                options["multinode"],
+                options["vland"],
+            )
+            if options["output"]:
+                Path(options["output"]).write_text(json.dumps(data), encoding="utf-8")
+        else:
+            try:
+                data = json.loads(Path(options["input"]).read_text(encoding="utf-8"))
+            except (OSError, ValueError) as exc:
+                raise CommandError(f"Unable to load the snapshot: {exc}")
+
+        # Never run on the real database
+        old_config = setup_databases(
+            verbosity=0, interactive=False, keepdb=options["keepdb"]
+        )
+        try:
+            with no_events():
+                self.benchmark(data, options["iterations"], options["template"])
+        finally:
+            teardown_databases(old_config, verbosity=0, keepdb=options["keepdb"])
+
+    def benchmark(self, data, iterations, template):
+        logger = logging.getLogger("lava-scheduler-benchmark")
+        hostnames = [d["hostname"] for d in data["devices"]]
+        with device_dictionaries(hostnames, template), transaction.atomic():
+            workers = load_snapshot(data)
+            self.stdout.write(
+                f"Lab: {len(data['devices'])} devices, {len(data['jobs'])} jobs"
+            )
+
+            results = []
+            for iteration in range(1, iterations + 1):
+                # Dry-run: every pass starts from the same state
+                with transaction.atomic():
+                    stats = schedule(logger, [], workers)
+                    assignments = list(
+                        TestJob.objects.filter(
+                            state__in=[
+                                TestJob.STATE_SCHEDULING,
+                                TestJob.STATE_SCHEDULED,
+                            ],
+                            actual_device__isnull=False,
+                        )
+                        .order_by("id")
+                        .values_list("id", "actual_device")
+                    )
+                    transaction.set_rollback(True)
+                results.append(stats)
+                self.report(iteration, stats, assignments)
+
+            durations = [stats.duration for stats in results]
+            self.stdout.write(
+                "Duration: min %.3fs, mean %.3fs, max %.3fs"
+                % (min(durations), statistics.mean(durations), max(durations))
+            )
+            transaction.set_rollback(True)
+
+    def report(self, iteration, stats, assignments):
+        self.stdout.write(
+            "[%d] %d jobs considered, %d devices matched on %d, %d queries in %.3fs"
+            % (
+                iteration,
+                stats.jobs,
+                stats.scheduled,
+                stats.devices,
+                stats.queries,
+                stats.duration,
+            )
+        )
+        for name, (duration, queries) in stats.phases.items():
+            self.stdout.write(
+                "  * %-14s %5d queries in %.3fs" % (name, queries, duration)
+            )
+        self.stdout.write(f"  * {len(assignments)} assignments")
+        if self.verbosity > 1:
+            for job_id, hostname in assignments:
+                self.stdout.write(f"    - {job_id} => {hostname}")
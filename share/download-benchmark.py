@@ -0,0 +1,152 @@
+#! /usr/bin/python3
+
+"""
+Measure the throughput of the stages of the download action: reading the
+data, computing the checksums and decompressing.
+
+Without a file to download, a partly compressible file is generated.
+
+(This script will go into the lava-dev binary package.)
+"""
+
+#  Copyright 2023 Linaro Limited
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess  # nosec - internal use.
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from lava_dispatcher.actions.deploy.download import (
+    DownloadHandler,
+    FileDownloadAction,
+)
+from lava_dispatcher.utils.checksums import Checksums
+from lava_dispatcher.utils.compression import compress_command_map
+
+ALGORITHMS = [["sha256"], ["sha256", "md5"], ["sha256", "md5", "sha512"]]
+
+
+def generate(filename, size):
+    chunk = 1024 * 1024
+    with open(filename, "wb") as f_out:
+        for index in range(0, size):
+            # Half random, half repeated data
+            f_out.write(os.urandom(chunk // 2))
+            f_out.write(b"%08d" % index * (chunk // 16))
+
+
+def measure(func, size):
+    begin = time.perf_counter()
+    func()
+    return size / (1024 * 1024) / (time.perf_counter() - begin)
+
+
+def read(filename):
+    action = FileDownloadAction("file", "/", urlparse(f"file://{filename}"))
+    for _ in action.reader():
+        pass
+
+
+def chunks(filename):
+    action = FileDownloadAction("file", "/", urlparse(f"file://{filename}"))
+    return action.reader()
+
+
+def hashing(data, algorithms):
+    hashes = [hashlib.new(name) for name in algorithms]  # nosec - benchmark.
+    for buff in data:
+        for value in hashes:
+            value.update(buff)
+
+
+def download(filename, output, algorithms, background):
+    """
+    Read, hash and write the file like the download action.
+    """
+    hashes = [hashlib.new(name) for name in algorithms]  # nosec - benchmark.
+    with Checksums(algorithms) as checksums, open(output, "wb") as f_out:
+        for buff in chunks(filename):
+            if background:
+                checksums.update(buff)
+            else:
+                for value in hashes:
+                    value.update(buff)
+            f_out.write(buff)
+        checksums.hexdigests()
+
+
+def decompress(command, filename):
+    with open(filename, "rb") as f_in:
+        subprocess.run(  # nosec - internal use.
+            [command], stdin=f_in, stdout=subprocess.DEVNULL, check=True
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LAVA download benchmark")
+    parser.add_argument(
+        "filename", nargs="?", default=None, help="File to download, if any"
+    )
+    parser.add_argument(
+        "--size", default=256, type=int, help="Size of the generated file in MB"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = args.filename
+        if filename is None:
+            filename = str(Path(tmp_dir) / "image")
+            generate(filename, args.size)
+        filename = str(Path(filename).resolve())
+        size = os.stat(filename).st_size
+
+        print("%-40s %10s" % ("stage", "MB/s"))
+        print("%-40s %10.1f" % ("reader", measure(lambda: read(filename), size)))
+
+        # The data is kept in memory to only measure the hashing
+        data = list(chunks(filename))
+        for algorithms in ALGORITHMS:
+            speed = measure(lambda: hashing(data, algorithms), size)
+            print("%-40s %10.1f" % ("hashing " + "+".join(algorithms), speed))
+        del data
+
+        output = str(Path(tmp_dir) / "output")
+        for algorithms in ALGORITHMS:
+            for background in [False, True]:
+                speed = measure(
+                    lambda: download(filename, output, algorithms, background), size
+                )
+                name = "download " + "+".join(algorithms)
+                if background:
+                    name += " (background)"
+                print("%-40s %10.1f" % (name, speed))
+        os.unlink(output)
+
+        for compression, command in DownloadHandler.decompress_command_map.items():
+            if compression not in compress_command_map or not shutil.which(command):
+                continue
+            compressed = str(Path(tmp_dir) / f"image.{compression}")
+            with open(filename, "rb") as f_in, open(compressed, "wb") as f_out:
+                subprocess.run(  # nosec - internal use.
+                    compress_command_map[compression] + ["-c"],
+                    stdin=f_in,
+                    stdout=f_out,
+                    check=True,
+                )
+            speed = measure(lambda: decompress(command, compressed), size)
+            print("%-40s %10.1f" % (f"decompression {compression}", speed))
+            os.unlink(compressed)
+
+
+if __name__ == "__main__":
+    main()
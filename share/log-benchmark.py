@@ -0,0 +1,85 @@
+#! /usr/bin/python3
+
+"""
+Measure the number of log lines per second encoded by lava_common.log.dump()
+compared to the yaml emitter that it replaces for the usual log records.
+
+(This script will go into the lava-dev binary package.)
+"""
+
+#  Copyright 2023 Linaro Limited
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import argparse
+import datetime
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from lava_common.log import dump
+from lava_common.yaml import yaml_safe_dump
+
+# Name, level and message of the measured log records
+MESSAGES = [
+    ("info", "info", "start: 1.2.3 uboot-commands (timeout 00:04:59) [common]"),
+    (
+        "target",
+        "target",
+        "[    1.234567] usbcore: registered new interface driver \x1b[0;32musbhid\x1b[0m\r",
+    ),
+    ("unicode", "target", "\u2554\u2550 Welcome to the target \u2550\u2557 caf\xe9"),
+    (
+        "results",
+        "results",
+        {"case": "job", "definition": "lava", "result": "pass", "level": 1},
+    ),
+]
+
+
+def reference(data):
+    return yaml_safe_dump(
+        data, default_flow_style=True, default_style='"', width=10**6
+    )[:-1]
+
+
+def measure(func, records, duration):
+    count = 0
+    begin = time.perf_counter()
+    while True:
+        for data in records:
+            func(data)
+        count += len(records)
+        elapsed = time.perf_counter() - begin
+        if elapsed >= duration:
+            return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LAVA log encoder benchmark")
+    parser.add_argument(
+        "--duration",
+        default=2.0,
+        type=float,
+        help="Duration of each measure in seconds",
+    )
+    args = parser.parse_args()
+
+    print(
+        "%-10s %15s %15s %8s" % ("message", "yaml (lines/s)", "dump (lines/s)", "ratio")
+    )
+    for name, lvl, msg in MESSAGES:
+        records = [
+            {"dt": datetime.datetime.utcnow().isoformat(), "lvl": lvl, "msg": msg}
+            for _ in range(1000)
+        ]
+        assert dump(dict(records[0])) == reference(records[0])  # nosec
+        before = measure(reference, records, args.duration)
+        after = measure(dump, records, args.duration)
+        print("%-10s %15d %15d %7.1fx" % (name, before, after, after / before))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#! /usr/bin/python3
+
+"""
+Measure the number of test results parsed per second by the lava-test-shell
+action when replaying a recorded console, compared to the list of patterns
+given to pexpect that the signal searcher replaces.
+
+Without a recorded console, an LTP like console is generated.
+
+(This script will go into the lava-dev binary package.)
+"""
+
+#  Copyright 2023 Linaro Limited
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import argparse
+import logging
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from lava_common.exceptions import ConnectionClosedError
+from lava_common.log import YAMLLogger
+from lava_common.timeout import Timeout
+from lava_dispatcher.actions.test.shell import TestShellAction
+from lava_dispatcher.shell import ShellCommand
+
+
+class BenchmarkAction(TestShellAction):
+    def __init__(self, logger, pattern):
+        super().__init__()
+        self.logger = logger
+        self.signal_director.test_uuid = "benchmark"
+        self.definition = "0_benchmark"
+        self._reset_patterns()
+        if pattern is not None:
+            self.patterns["test_case_result"] = re.compile(pattern, re.M)
+            self.pattern.update(pattern, {})
+
+    # Test runs are not bound to a job
+    def signal_start_run(self, params):
+        self.definition = params[0]
+
+    def signal_end_run(self, params):
+        self._reset_patterns()
+
+
+class ReferenceAction(BenchmarkAction):
+    def _keep_running(self, test_connection, timeout, check_char):
+        retval = test_connection.expect(list(self.patterns.values()), timeout=timeout)
+        return self.check_patterns(
+            list(self.patterns.keys())[retval], test_connection, check_char
+        )
+
+
+class CountingLogger(YAMLLogger):
+    def __init__(self, name):
+        super().__init__(name)
+        self.propagate = False
+        self.addHandler(logging.NullHandler())
+        self.count = 0
+
+    def results(self, results, *args, **kwargs):
+        self.count += 1
+        super().results(results, *args, **kwargs)
+
+
+def generate(filename, results):
+    with open(filename, "w") as f_out:
+        f_out.write("<LAVA_SIGNAL_STARTRUN 0_ltp benchmark>\n")
+        for index in range(0, results):
+            name = f"syscall{index:05}"
+            f_out.write(f"<LAVA_SIGNAL_STARTTC {name}>\n")
+            f_out.write(f"{name}    1  TINFO  :  Using /tmp/ltp-{index} as tmpdir\n")
+            f_out.write(f"{name}    1  TPASS  :  {name} passed\n")
+            f_out.write(f"<LAVA_SIGNAL_ENDTC {name}>\n")
+            f_out.write(f"<LAVA_SIGNAL_TESTCASE TEST_CASE_ID={name} RESULT=pass>\n")
+        f_out.write("<LAVA_SIGNAL_ENDRUN 0_ltp benchmark>\n")
+        f_out.write("<LAVA_TEST_RUNNER EXIT>\n")
+
+
+def measure(cls, console, pattern):
+    logger = CountingLogger("benchmark")
+    action = cls(logger, pattern)
+    shell = ShellCommand(f"cat {console}", Timeout("benchmark", 60), logger)
+    begin = time.perf_counter()
+    try:
+        while action._keep_running(shell, 60, "#"):
+            pass
+    except ConnectionClosedError:
+        pass
+    elapsed = time.perf_counter() - begin
+    shell.close()
+    return (logger.count, logger.count / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LAVA test shell benchmark")
+    parser.add_argument(
+        "console", nargs="?", default=None, help="Recorded console to replay"
+    )
+    parser.add_argument(
+        "--results",
+        default=20000,
+        type=int,
+        help="Number of results in the generated console",
+    )
+    parser.add_argument(
+        "--pattern", default=None, help="Test case result pattern, if any"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        console = args.console
+        if console is None:
+            console = str(Path(tmp_dir) / "console.txt")
+            generate(console, args.results)
+
+        print("%-10s %10s %15s" % ("searcher", "results", "results/s"))
+        for name, cls in [("pexpect", ReferenceAction), ("signals", BenchmarkAction)]:
+            (count, speed) = measure(cls, console, args.pattern)
+            print("%-10s %10d %15d" % (name, count, speed))
+
+
+if __name__ == "__main__":
+    main()
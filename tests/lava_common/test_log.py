@@ -4,10 +4,26 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import datetime
+import gzip
 import logging
+from urllib.parse import parse_qsl
 
-from lava_common.log import HTTPHandler, YAMLLogger, sender
-from lava_common.yaml import yaml_safe_load
+from lava_common.log import (
+    HTTPHandler,
+    Spool,
+    YAMLLogger,
+    dump,
+    flush_spool,
+    load,
+    sender,
+)
+from lava_common.yaml import yaml_safe_dump, yaml_safe_load
+
+
+def posted(call):
+    assert call[2]["headers"]["Content-Encoding"] == "gzip"
+    return dict(parse_qsl(gzip.decompress(call[2]["data"]).decode()))
 
 
 def test_sender(mocker):
@@ -31,11 +47,11 @@ def test_sender(mocker):
     assert len(post.mock_calls) == 2
     assert post.mock_calls[0][1] == ("http://localhost",)
     assert post.mock_calls[1][1] == ("http://localhost",)
-    assert post.mock_calls[0][2]["data"] == {
-        "lines": "- " + "\n- ".join([f"{i:04}" for i in range(0, 1000)]),
-        "index": 0,
+    assert posted(post.mock_calls[0]) == {
+        "records": "\n".join([f"{i:04}" for i in range(0, 1000)]),
+        "index": "0",
     }
-    assert post.mock_calls[1][2]["data"] == {"lines": "- 1000", "index": 1000}
+    assert posted(post.mock_calls[1]) == {"records": "1000", "index": "1000"}
     assert post.mock_calls[0][2]["headers"]["LAVA-Token"] == "my-token"
     assert post.mock_calls[1][2]["headers"]["LAVA-Token"] == "my-token"
 
@@ -60,7 +76,208 @@ def test_sender_exceptions(mocker):
     assert len(post.mock_calls) == 3
     for c in post.mock_calls:
         assert c[1] == ("http://localhost",)
-        assert c[2]["data"] == {"lines": "- hello world", "index": 0}
+        assert posted(c) == {"records": "hello world", "index": "0"}
+
+
+def test_sender_batches(mocker):
+    batches = []
+    timeouts = []
+
+    def post(url, data, headers, timeout=None):
+        timeouts.append(timeout)
+        records = dict(parse_qsl(gzip.decompress(data).decode()))["records"]
+        batches.append(len(records.split("\n")))
+        return mocker.Mock(
+            status_code=200, json=mocker.Mock(return_value={"line_count": batches[-1]})
+        )
+
+    enter = mocker.MagicMock()
+    enter.__enter__ = mocker.Mock(return_value=mocker.Mock(post=post))
+    mocker.patch("requests.Session", mocker.MagicMock(return_value=enter))
+    conn = mocker.MagicMock()
+    conn.recv_bytes.side_effect = (
+        [b"a"] * 3500 + [b"b" * 1024 * 1024] * 3 + [b"c"] * 10 + [b""]
+    )
+    stats = [0.0, 0.0]
+
+    sender(conn, "http://localhost", "my-token", 1, stats)
+    # The batches grow when they are full. The size of each request is also
+    # limited.
+    assert batches == [1000, 2000, 501, 1, 11]
+    assert stats[0] == 0
+    # The background sender waits forever for the server
+    assert set(timeouts) == {None}
+
+
+def test_sender_failures(mocker):
+    responses = [
+        mocker.Mock(status_code=415),
+        mocker.Mock(status_code=502),
+        mocker.Mock(status_code=502),
+        mocker.Mock(status_code=200, json=mocker.Mock(return_value={"line_count": 1})),
+    ]
+    post = mocker.Mock(side_effect=responses)
+    enter = mocker.MagicMock()
+    enter.__enter__ = mocker.Mock(return_value=mocker.Mock(post=post))
+    mocker.patch("requests.Session", mocker.MagicMock(return_value=enter))
+    sleep = mocker.patch("time.sleep")
+    uniform = mocker.patch("random.uniform", side_effect=lambda a, b: b)
+    conn = mocker.MagicMock()
+    conn.recv_bytes.side_effect = [b"hello world", b""]
+
+    sender(conn, "http://localhost", "my-token", 1)
+    assert len(post.mock_calls) == 4
+    # The server does not support compression
+    assert posted(post.mock_calls[0]) == {"records": "hello world", "index": "0"}
+    for c in post.mock_calls[1:]:
+        assert "Content-Encoding" not in c[2]["headers"]
+        assert c[2]["data"] == b"records=hello+world&index=0"
+    # Exponential backoff with jitter
+    assert uniform.mock_calls == [mocker.call(0.5, 1), mocker.call(1, 2)]
+    assert sleep.mock_calls == [mocker.call(1), mocker.call(2)]
+
+
+def test_sender_uncompressed(mocker):
+    responses = [
+        mocker.Mock(status_code=400),
+        mocker.Mock(status_code=415),
+        mocker.Mock(status_code=200, json=mocker.Mock(return_value={"line_count": 1})),
+    ]
+    post = mocker.Mock(side_effect=responses)
+    enter = mocker.MagicMock()
+    enter.__enter__ = mocker.Mock(return_value=mocker.Mock(post=post))
+    mocker.patch("requests.Session", mocker.MagicMock(return_value=enter))
+    sleep = mocker.patch("time.sleep")
+    conn = mocker.MagicMock()
+    conn.recv_bytes.side_effect = [b"hello world", b""]
+
+    sender(conn, "http://localhost", "my-token", 1)
+    assert len(post.mock_calls) == 3
+    # A bad request is retried, still compressed
+    assert posted(post.mock_calls[0]) == {"records": "hello world", "index": "0"}
+    assert posted(post.mock_calls[1]) == {"records": "hello world", "index": "0"}
+    assert len(sleep.mock_calls) == 1
+    # Compression is only disabled for an unsupported encoding
+    assert "Content-Encoding" not in post.mock_calls[2][2]["headers"]
+    assert post.mock_calls[2][2]["data"] == b"records=hello+world&index=0"
+
+
+def test_spool(tmp_path):
+    spool = Spool(tmp_path / "logs.spool")
+    assert len(spool) == 0
+    for i in range(0, 5):
+        spool.append(f"record {i}")
+    assert len(spool) == 5
+    assert spool.peek(3, 1000) == ["record 0", "record 1", "record 2"]
+    # At least one record is returned
+    assert spool.peek(3, 1) == ["record 0"]
+    assert spool.peek(3, 18) == ["record 0", "record 1"]
+    spool.ack(1)
+    assert len(spool) == 4
+    assert spool.index == 1
+    assert (tmp_path / "logs.spool.ack").read_text() == "9 1"
+    spool.close()
+
+    # Resume from the last acknowledged record
+    (tmp_path / "logs.spool").open("ab").write(b"incomplete")
+    spool = Spool(tmp_path / "logs.spool")
+    assert len(spool) == 5
+    assert spool.index == 1
+    assert spool.peek(10, 1000) == [f"record {i}" for i in range(1, 5)]
+    spool.ack(4)
+    assert spool.index == 5
+    assert spool.peek(10, 1000) == []
+    spool.close()
+
+    # The file is emptied when every record was acknowledged
+    (tmp_path / "logs.spool").open("ab").write(b"\n")
+    spool = Spool(tmp_path / "logs.spool")
+    assert len(spool) == 1
+    assert spool.peek(10, 1000) == ["incomplete"]
+    spool.ack(1)
+    assert (tmp_path / "logs.spool").read_bytes() == b""
+    assert (tmp_path / "logs.spool.ack").read_text() == "0 6"
+    spool.close()
+
+    # Crash after emptying the file but before saving the offset
+    (tmp_path / "logs.spool.ack").write_text("11 6")
+    (tmp_path / "logs.spool").open("ab").write(b"new\n")
+    spool = Spool(tmp_path / "logs.spool")
+    assert len(spool) == 1
+    assert spool.index == 6
+    assert spool.peek(10, 1000) == ["new"]
+    spool.close()
+
+
+def test_sender_coalesced(mocker):
+    response = mocker.Mock(status_code=200)
+    response.json = mocker.Mock(return_value={"line_count": 3})
+    post = mocker.Mock(return_value=response)
+    enter = mocker.MagicMock()
+    enter.__enter__ = mocker.Mock(return_value=mocker.Mock(post=post))
+    mocker.patch("requests.Session", mocker.MagicMock(return_value=enter))
+    conn = mocker.MagicMock()
+    conn.recv_bytes.side_effect = [b"hello\nworld", b"!", b""]
+
+    sender(conn, "http://localhost", "my-token", 1)
+    assert len(post.mock_calls) == 1
+    assert posted(post.mock_calls[0]) == {"records": "hello\nworld\n!", "index": "0"}
+
+
+def test_sender_spool(mocker, tmp_path):
+    response = mocker.Mock(status_code=200)
+    response.json = mocker.Mock(side_effect=[{"line_count": 2}, {"line_count": 1}])
+    post = mocker.Mock(return_value=response)
+    enter = mocker.MagicMock()
+    enter.__enter__ = mocker.Mock(return_value=mocker.Mock(post=post))
+    mocker.patch("requests.Session", mocker.MagicMock(return_value=enter))
+    conn = mocker.MagicMock()
+    conn.recv_bytes.side_effect = [b"hello", b"world", EOFError()]
+
+    sender(conn, "http://localhost", "my-token", 1, spool=tmp_path / "logs.spool")
+    assert len(post.mock_calls) == 1
+    assert posted(post.mock_calls[0]) == {"records": "hello\nworld", "index": "0"}
+    assert (tmp_path / "logs.spool").read_bytes() == b""
+    assert (tmp_path / "logs.spool.ack").read_text() == "0 2"
+
+
+def test_flush_spool(mocker, tmp_path):
+    filename = tmp_path / "logs.spool"
+    post = mocker.Mock()
+    enter = mocker.MagicMock()
+    enter.__enter__ = mocker.Mock(return_value=mocker.Mock(post=post))
+    mocker.patch("requests.Session", mocker.MagicMock(return_value=enter))
+    mocker.patch("time.sleep")
+
+    # Nothing to send
+    assert flush_spool("http://localhost", "my-token", filename) is True
+    assert post.mock_calls == []
+
+    filename.write_text("hello\nworld\n")
+    (tmp_path / "logs.spool.ack").write_text("6 3")
+
+    # The server is not available
+    post.return_value = mocker.Mock(status_code=502)
+    assert flush_spool("http://localhost", "my-token", filename, timeout=5) is False
+    assert posted(post.mock_calls[0]) == {"records": "world", "index": "3"}
+    assert post.mock_calls[0][2]["timeout"] == 5
+
+    # The server accepts the records
+    post.reset_mock()
+    post.return_value = mocker.Mock(
+        status_code=200, json=mocker.Mock(return_value={"line_count": 1})
+    )
+    assert flush_spool("http://localhost", "my-token", filename) is True
+    assert post.call_count == 1
+    assert filename.read_bytes() == b""
+    assert (tmp_path / "logs.spool.ack").read_text() == "0 4"
+
+    # The records are rejected
+    filename.write_text("hello\n")
+    post.reset_mock()
+    post.return_value = mocker.Mock(status_code=404)
+    assert flush_spool("http://localhost", "my-token", filename) is True
+    assert post.call_count == 1
 
 
 def test_http_handler(mocker):
@@ -82,6 +299,7 @@ def test_http_handler(mocker):
         exc_info=None,
     )
     handler.emit(record)
+    dt = datetime.datetime.utcfromtimestamp(record.created).isoformat()
     record = logging.LogRecord(
         name="lava",
         level=logging.ERROR,
@@ -94,11 +312,30 @@ def test_http_handler(mocker):
     handler.emit(record)
 
     assert len(handler.writer.send_bytes.mock_calls) == 1
-    assert handler.writer.send_bytes.mock_calls[0][1] == (b"Hello world",)
+    assert handler.writer.send_bytes.mock_calls[0][1] == (
+        f"error {dt} Hello world".encode(),
+    )
+
+    # The level and the date given by the YAMLLogger are used
+    record.msg = "Hello"
+    record.lvl = "target"
+    record.dt = "2023-06-01T05:24:00.060423"
+    handler.emit(record)
+    assert handler.writer.send_bytes.mock_calls[1][1] == (
+        b"target 2023-06-01T05:24:00.060423 Hello",
+    )
+
+    # Coalesced records are sent at once, one line per record
+    record.msg = "Hello\nworld"
+    handler.emit(record)
+    assert handler.writer.send_bytes.mock_calls[2][1] == (
+        b"target 2023-06-01T05:24:00.060423 Hello\n"
+        b"target 2023-06-01T05:24:00.060423 world",
+    )
 
     handler.close()
-    assert len(handler.writer.send_bytes.mock_calls) == 2
-    assert handler.writer.send_bytes.mock_calls[1][1] == (b"",)
+    assert len(handler.writer.send_bytes.mock_calls) == 4
+    assert handler.writer.send_bytes.mock_calls[3][1] == (b"",)
 
 
 def test_yaml_logger(mocker):
@@ -114,6 +351,7 @@ def test_yaml_logger(mocker):
         if mock_calls == 0:
             return
         assert logger._log.mock_calls[0][1][0] == lvlno
+        assert logger._log.mock_calls[0][2]["extra"]["lvl"] == lvl
         data = yaml_safe_load(logger._log.mock_calls[0][1][1])
         if lvl == "feedback":
             assert list(data.keys()) == ["dt", "lvl", "msg", "ns"]
@@ -174,5 +412,77 @@ def test_yaml_logger(mocker):
     logger.info("a" * 10**7)
     check(logger, "info", logging.INFO, "<line way too long ...>")
 
+    # Many lines are logged at once, each one counting as a line
+    logger._log = mocker.Mock()
+    logger.log_lines(logging.INFO, "target", [])
+    logger.log_lines(logging.INFO, "target", ["first", "second"])
+    logger.log_lines(logging.INFO, "feedback", ["third"], namespace="ns")
+    assert len(logger._log.mock_calls) == 2
+    assert logger._log.mock_calls[0][2]["extra"]["lvl"] == "target"
+    lines = logger._log.mock_calls[0][1][1].split("\n")
+    assert [yaml_safe_load(line)["msg"] for line in lines] == ["first", "second"]
+    assert yaml_safe_load(logger._log.mock_calls[1][1][1])["ns"] == "ns"
+    logger.marker({"case": "1_test", "type": "test_case"})
+    assert logger.markers["1_test"] == {"test_case": 12}
+
+    # Slow log ingestion is reported
+    logger._log = mocker.Mock()
+    logger.handler.stats[0] = 6000
+    logger.handler.stats[1] = 0.5
+    logger.handler.stats_reported -= HTTPHandler.STATS_INTERVAL
+    logger.info("an info")
+    logger.info("an info")
+    assert len(logger._log.mock_calls) == 3
+    data = yaml_safe_load(logger._log.mock_calls[1][1][1])
+    assert data["lvl"] == "warning"
+    assert data["msg"] == (
+        "Slow log ingestion: 6000 lines waiting, last request took 0.5s"
+    )
+
     logger.close()
     assert logger.handler is None
+
+
+def test_load():
+    assert load('{"dt": "2023-06-01T05:24:00.060423", "lvl": "info", "msg": "a"}') == {
+        "dt": "2023-06-01T05:24:00.060423",
+        "lvl": "info",
+        "msg": "a",
+    }
+    # Not valid json
+    assert load('{"lvl": "results", "msg": {"level": !!int "1", "esc": "\\e"}}') == {
+        "lvl": "results",
+        "msg": {"level": 1, "esc": "\x1b"},
+    }
+
+
+def test_dump():
+    def reference(data):
+        return yaml_safe_dump(
+            data, default_flow_style=True, default_style='"', width=10**6
+        )[:-1]
+
+    messages = [
+        "",
+        "hello world",
+        ' "quoted" and \\back\\slashes ',
+        "tab\tnew line\ncarriage return\r\x00\x07\x1b[0m\x7f",
+        "unicode: \xe9\xa0\x85\u2028\u2029\ufeff\u4e2d\U0001f600",
+        "".join(chr(c) for c in range(256)),
+    ]
+    for msg in messages:
+        data = {"lvl": "target", "dt": "2023-06-01T05:24:00.060423", "msg": msg}
+        assert dump(data) == reference(data)
+        assert load(dump(data)) == data
+        data["ns"] = "common"
+        assert dump(data) == reference(data)
+
+    # Other types are handled by the yaml emitter
+    data = {"lvl": "results", "msg": {"case": "a", "result": "pass", "level": 1}}
+    assert dump(data) == reference(data)
+
+    # Long lines are skipped
+    data = {"lvl": "target", "msg": "a" * 10**6}
+    assert dump(data) == '{"lvl": "target", "msg": "<line way too long ...>"}'
+    data = {"lvl": "results", "msg": {"case": "a" * 10**6}}
+    assert dump(data) == '{"lvl": "results", "msg": {"skip": "line way too long ..."}}'
@@ -4,6 +4,7 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import threading
 from pathlib import Path
 from urllib.parse import urlparse
 
@@ -12,6 +13,7 @@ import requests
 
 from lava_common.constants import HTTP_DOWNLOAD_CHUNK_SIZE
 from lava_common.exceptions import InfrastructureError, JobError
+from lava_dispatcher.action import Pipeline
 from lava_dispatcher.actions.deploy.download import (
     CopyToLxcAction,
     DownloaderAction,
@@ -20,6 +22,7 @@ from lava_dispatcher.actions.deploy.download import (
     HttpDownloadAction,
     LxcDownloadAction,
     PreDownloadedAction,
+    Prefetch,
     ScpDownloadAction,
 )
 from lava_dispatcher.job import Job
@@ -509,6 +512,63 @@ def test_http_download_validate(mocker):
     ]
 
 
+def test_http_download_validate_concurrent(mocker):
+    class DummyResponse:
+        def __init__(self, status_code, size):
+            self.status_code = status_code
+            self.headers = {"content-length": str(size)}
+
+        def close(self):
+            pass
+
+    # The three resources are checked at the same time
+    barrier = threading.Barrier(3, timeout=10)
+    calls = []
+
+    def dummyhead(url, allow_redirects, headers, timeout):
+        calls.append(url)
+        barrier.wait()
+        if url == "https://example.com/dtb":
+            return DummyResponse(404, 0)
+        return DummyResponse(requests.codes.OK, len(url))
+
+    def dummyget(url, allow_redirects, stream, headers, timeout):
+        calls.append(url)
+        return DummyResponse(404, 0)
+
+    mocker.patch("requests.head", dummyhead)
+    mocker.patch("requests.get", dummyget)
+
+    job = Job(1234, {"dispatcher": {}}, None)
+    job.pipeline = Pipeline(job=job)
+    for key in ["kernel", "dtb", "rootfs"]:
+        url = f"https://example.com/{key}"
+        action = DownloaderAction(key, "/path/to/file", params={"url": url})
+        action.job = job
+        job.pipeline.add_action(action, {key: {"url": url}, "namespace": "common"})
+
+    actions = [a.pipeline.actions[0] for a in job.pipeline.actions]
+    for action in actions:
+        action.section = "deploy"
+        action.job = job
+        action.validate()
+
+    assert sorted(calls) == [
+        "https://example.com/dtb",
+        "https://example.com/dtb",
+        "https://example.com/kernel",
+        "https://example.com/rootfs",
+    ]
+    assert actions[0].errors == []
+    assert actions[0].size == len("https://example.com/kernel")
+    assert actions[1].errors == [
+        "Resource unavailable at 'https://example.com/dtb' (404)"
+    ]
+    assert actions[2].errors == []
+    assert actions[2].size == len("https://example.com/rootfs")
+    assert all(a.validation is None for a in actions)
+
+
 def test_file_download_reader(tmp_path):
     # Create the file to use
     (tmp_path / "bla.img").write_text("hello", encoding="utf-8")
@@ -639,6 +699,169 @@ def test_http_download_run(tmp_path):
     }
 
 
+def test_http_download_run_checksums(tmp_path):
+    def reader():
+        yield b"hello"
+        yield b"world"
+
+    action = HttpDownloadAction(
+        "dtb", str(tmp_path), urlparse("https://example.com/dtb")
+    )
+    action.job = Job(1234, {"dispatcher": {}}, None)
+    action.url = urlparse("https://example.com/dtb")
+    action.parameters = {
+        "to": "download",
+        "dtb": {
+            "url": "https://example.com/dtb",
+            "md5sum": "fc5e038d38a57032085441e7fe7010b0",
+        },
+        "namespace": "common",
+    }
+    action.params = action.parameters["dtb"]
+    action.reader = reader
+    action.fname = str(tmp_path / "dtb/dtb")
+    action.run(None, 4212)
+
+    # Only sha256 and the requested checksums are computed
+    assert dict(action.results) == {
+        "success": {"md5": "fc5e038d38a57032085441e7fe7010b0"},
+        "label": "dtb",
+        "size": 10,
+        "md5sum": "fc5e038d38a57032085441e7fe7010b0",
+        "sha256sum": "936a185caaa266bb9cbe981e9e05cb78cd732b0b3280eb944412bb6f8f8f07af",
+    }
+    assert action.data["common"]["download-action"]["dtb"] == {
+        "decompressed": False,
+        "file": "%s/dtb/dtb" % str(tmp_path),
+        "md5": "fc5e038d38a57032085441e7fe7010b0",
+        "sha256": "936a185caaa266bb9cbe981e9e05cb78cd732b0b3280eb944412bb6f8f8f07af",
+    }
+
+
+def test_http_download_run_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        "lava_dispatcher.actions.deploy.download.DISPATCHER_DOWNLOAD_CACHE_DIR",
+        str(tmp_path / "cache"),
+    )
+    calls = []
+
+    def reader():
+        calls.append(True)
+        yield b"hello"
+        yield b"world"
+
+    def run(path, compression=None):
+        action = HttpDownloadAction(
+            "dtb", str(tmp_path / path), urlparse("https://example.com/dtb")
+        )
+        action.job = Job(1234, {"dispatcher": {"download_cache_size": 1}}, None)
+        action.url = urlparse("https://example.com/dtb")
+        action.etag = '"5f2b"'
+        action.parameters = {
+            "to": "download",
+            "dtb": {"url": "https://example.com/dtb", "compression": compression},
+            "namespace": "common",
+        }
+        action.params = action.parameters["dtb"]
+        action.reader = reader
+        action.fname = str(tmp_path / path / "dtb/dtb")
+        action.run(None, 4212)
+        return action
+
+    # The first download fills the cache
+    action = run("first")
+    assert len(calls) == 1
+    assert action.get_namespace_data(
+        action="download-action", label="cache", key="stats"
+    ) == {"hits": 0, "misses": 1, "saved": 0}
+
+    # Later downloads are copied from the cache
+    action = run("second")
+    assert len(calls) == 1
+    assert (tmp_path / "second/dtb/dtb").read_bytes() == b"helloworld"
+    assert action.results["size"] == 10
+    assert (
+        action.results["sha256sum"]
+        == "936a185caaa266bb9cbe981e9e05cb78cd732b0b3280eb944412bb6f8f8f07af"
+    )
+    assert action.get_namespace_data(
+        action="download-action", label="cache", key="stats"
+    ) == {"hits": 1, "misses": 0, "saved": 10}
+
+    # A new version of the file is downloaded again
+    action.etag = '"5f2c"'
+    action.run(None, 4212)
+    assert len(calls) == 2
+
+
+def test_prefetch(tmp_path):
+    def reader():
+        yield b"hello"
+        yield b"world"
+
+    prefetch = Prefetch(reader, str(tmp_path / "dtb"), threading.Semaphore(1))
+    assert b"".join(prefetch.reader()) == b"helloworld"
+    # The temporary file is removed once read
+    assert not (tmp_path / "dtb").exists()
+
+    # Errors are raised in the reading thread
+    def failing_reader():
+        yield b"hello"
+        raise InfrastructureError("Unable to download")
+
+    prefetch = Prefetch(failing_reader, str(tmp_path / "dtb"), threading.Semaphore(1))
+    with pytest.raises(InfrastructureError, match="Unable to download"):
+        list(prefetch.reader())
+    assert not (tmp_path / "dtb").exists()
+
+
+def test_downloader_prefetch(monkeypatch, tmp_path):
+    job = Job(1234, {"dispatcher": {"parallel_downloads": 2}}, None)
+    monkeypatch.setattr(job, "mkdtemp", lambda name: str(tmp_path))
+    job.pipeline = Pipeline(job=job)
+    urls = {
+        "kernel": "https://example.com/kernel",
+        "dtb": "https://example.com/dtb",
+        "rootfs": "file:///rootfs",
+    }
+    for key, url in urls.items():
+        action = DownloaderAction(key, str(tmp_path), params={"url": url})
+        action.job = job
+        job.pipeline.add_action(action, {key: {"url": url}})
+    (kernel, dtb, rootfs) = [a.pipeline.actions[0] for a in job.pipeline.actions]
+
+    # Wait for the two downloads to be started
+    barrier = threading.Barrier(2, timeout=10)
+
+    def make_reader(data):
+        def reader():
+            barrier.wait()
+            yield data
+
+        return reader
+
+    kernel.reader = make_reader(b"kernel")
+    dtb.reader = make_reader(b"dtb")
+    job.pipeline.actions[1].prefetch()
+
+    # Local files are not prefetched
+    assert rootfs.prefetch is None
+    assert all(a.prefetched for a in job.pipeline.actions)
+    assert b"".join(kernel.open_reader()) == b"kernel"
+    assert b"".join(dtb.open_reader()) == b"dtb"
+    assert kernel.prefetch is None
+    assert dtb.prefetch is None
+
+    # Without parallel downloads, nothing is prefetched
+    job.parameters["dispatcher"] = {}
+    for action in job.pipeline.actions:
+        action.prefetched = False
+    job.pipeline.actions[0].prefetch()
+    assert kernel.prefetch is None
+    assert dtb.prefetch is None
+    assert all(a.prefetched for a in job.pipeline.actions)
+
+
 def test_http_download_run_compressed(tmp_path):
     def reader():
         yield b"\xfd7zXZ\x00\x00\x04\xe6\xd6\xb4F\x02\x00!\x01\x16\x00\x00"
@@ -9,7 +9,12 @@ import hashlib
 import os
 
 from lava_common.exceptions import InfrastructureError, JobError
-from lava_dispatcher.utils.compression import decompress_command_map, decompress_file
+from lava_dispatcher.utils.compression import (
+    _parallel_command,
+    decompress_command_map,
+    decompress_file,
+    parallel_command,
+)
 from tests.lava_dispatcher.test_basic import Factory, StdoutTestCase
 
 
@@ -159,3 +164,22 @@ class TestBadDecompression(StdoutTestCase):
         ):
             test_multiple_bad_checksums.validate()
             test_multiple_bad_checksums.run(None, None)
+
+
+def test_parallel_command(monkeypatch):
+    installed = {"pigz", "pbzip2"}
+    monkeypatch.setattr(
+        "lava_dispatcher.utils.compression.shutil.which",
+        lambda name: f"/usr/bin/{name}" if name in installed else None,
+    )
+    _parallel_command.cache_clear()
+    try:
+        assert parallel_command(["gunzip"]) == ["pigz", "-d"]
+        assert parallel_command(["gzip"]) == ["pigz"]
+        assert parallel_command(["bunzip2"]) == ["pbzip2", "-d"]
+        # xz is not installed
+        assert parallel_command(["unxz"]) == ["unxz"]
+        assert parallel_command(["xz", "--check=crc32"]) == ["xz", "--check=crc32"]
+        assert parallel_command(["unzip"]) == ["unzip"]
+    finally:
+        _parallel_command.cache_clear()
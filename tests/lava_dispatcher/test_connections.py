@@ -7,14 +7,17 @@
 
 import os
 import unittest
+import unittest.mock
 from unittest.mock import patch
 
 import lava_dispatcher
 from lava_common.exceptions import InfrastructureError, JobError
+from lava_common.log import YAMLLogger
 from lava_common.timeout import Timeout
 from lava_common.yaml import yaml_safe_load
 from lava_dispatcher.actions.boot.ssh import SchrootAction
 from lava_dispatcher.protocols.multinode import MultinodeProtocol
+from lava_dispatcher.shell import ShellLogger
 from lava_dispatcher.utils.filesystem import check_ssh_identity_file
 from tests.lava_dispatcher.test_basic import Factory, StdoutTestCase
 from tests.utils import infrastructure_error
@@ -693,3 +696,32 @@ class TestDisconnect(StdoutTestCase):
             "\"LAVA does not know how to disconnect: ensure that primary connection has one of the following tags: ('telnet', 'ssh', 'shell')\"]"
         )
         self.assertEqual(str(the_exception).strip(), err_msg)
+
+
+def test_shell_logger():
+    logger = YAMLLogger("lava")
+    logger._log = unittest.mock.Mock()
+    shell_logger = ShellLogger(logger)
+
+    # Partial lines are kept until the end of line is received
+    shell_logger.write('Hello "world"\r\n\x1b[0mline')
+    shell_logger.write("s\n\nlast")
+    assert shell_logger.line == "last"
+    # Every line is counted, even when logged at once
+    assert logger.line == 2
+    assert len(logger._log.mock_calls) == 2
+    messages = [
+        yaml_safe_load(line)["msg"]
+        for c in logger._log.mock_calls
+        for line in c[1][1].split("\n")
+    ]
+    assert messages == ['Hello \\"world\\"', "[0mlines"]
+
+    shell_logger.is_feedback = True
+    shell_logger.namespace = "ns"
+    shell_logger.flush(force=True)
+    data = yaml_safe_load(logger._log.mock_calls[-1][1][1])
+    assert data["lvl"] == "feedback"
+    assert data["msg"] == "last"
+    assert data["ns"] == "ns"
+    assert logger.line == 3
@@ -8,8 +8,19 @@ import decimal
 import os
 import re
 
-from lava_common.exceptions import JobError, LAVATimeoutError, TestError
+import pexpect
+import pytest
+
+from lava_common.exceptions import (
+    ConnectionClosedError,
+    JobError,
+    LAVATimeoutError,
+    TestError,
+)
+from lava_common.timeout import Timeout
 from lava_common.yaml import yaml_safe_load
+from lava_dispatcher.actions.test.shell import SignalSearcher
+from lava_dispatcher.shell import ShellCommand
 from tests.lava_dispatcher.test_basic import Factory, StdoutTestCase
 from tests.lava_dispatcher.test_multi import DummyLogger
 
@@ -159,3 +170,145 @@ class TestPatterns(StdoutTestCase):
         params = ["case", "pass"]
         with self.assertRaises(TestError):
             self.test_shell.signal_test_reference(params)
+
+
+PATTERNS = [
+    "<LAVA_TEST_RUNNER EXIT>",
+    "<LAVA_TEST_RUNNER INSTALL_FAIL>",
+    pexpect.EOF,
+    pexpect.TIMEOUT,
+    r"<LAVA_SIGNAL_(\S+) ([^>]+)>",
+    r"<LAVA_MULTI_NODE> <LAVA_(\S+) ([^>]+)>",
+    re.compile(r"^(?P<test_case_id>\w+): (?P<result>PASS|FAIL)\r?\n", re.M),
+]
+
+
+def test_signal_searcher():
+    searcher = SignalSearcher(PATTERNS)
+    assert searcher.eof_index == 2
+    assert searcher.timeout_index == 3
+
+    # A signal split between two reads
+    buffer = "hello\n<LAVA_SIGNAL_TEST"
+    assert searcher.search(buffer, len(buffer), 4000) == -1
+    data = "CASE TEST_CASE_ID=a RESULT=pass>\n"
+    buffer += data
+    assert searcher.search(buffer, len(data), 4000) == 4
+    assert searcher.match.groups() == ("TESTCASE", "TEST_CASE_ID=a RESULT=pass")
+    assert (searcher.start, searcher.end) == (6, len(buffer) - 1)
+
+    # A candidate is kept until it matches
+    buffer = "<LAVA_MULTI_NODE>"
+    assert searcher.search(buffer, len(buffer), 4000) == -1
+    data = " <LAVA_SEND job=1>\n"
+    buffer += data
+    assert searcher.search(buffer, len(data), 4000) == 5
+    assert searcher.match.groups() == ("SEND", "job=1")
+
+    # The prefix can be split
+    buffer = "abc <LAV"
+    assert searcher.search(buffer, len(buffer), 4000) == -1
+    buffer += "A_TEST_RUNNER EXIT>"
+    assert searcher.search(buffer, 19, 4000) == 0
+    assert searcher.start == 4
+
+    # The earliest match wins and other patterns are searched in the whole
+    # search window
+    buffer = "test1: PA"
+    assert searcher.search(buffer, len(buffer), 4000) == -1
+    buffer += "SS\n<LAVA_TEST_RUNNER EXIT>\n"
+    assert searcher.search(buffer, 27, 4000) == 6
+    assert searcher.match.groupdict() == {"test_case_id": "test1", "result": "PASS"}
+
+    # Data outside of the search window is ignored
+    buffer = "<LAVA_TEST_RUNNER EXIT>" + "a" * 4000
+    assert searcher.search(buffer, len(buffer), 4000) == -1
+
+
+def replay(console, expect, patterns=PATTERNS):
+    # Replay a console in small reads and return the matched events
+    shell = pexpect.spawn(
+        "cat",
+        [str(console)],
+        encoding="utf-8",
+        maxread=7,
+        searchwindowsize=4000,
+    )
+    events = []
+    while True:
+        index = expect(shell, patterns)
+        if patterns[index] in [pexpect.EOF, "<LAVA_TEST_RUNNER EXIT>"]:
+            return events
+        events.append((index, shell.match.groups(), shell.before))
+
+
+def compare_with_pexpect(console, patterns=PATTERNS):
+    reference = replay(
+        console,
+        lambda shell, patterns: shell.expect(patterns, timeout=10),
+        patterns,
+    )
+    searcher = SignalSearcher(patterns)
+    events = replay(
+        console,
+        lambda shell, patterns: shell.expect_loop(searcher, timeout=10),
+        patterns,
+    )
+    assert events == reference
+    return reference
+
+
+def test_signal_searcher_pexpect(tmp_path):
+    lines = []
+    for index in range(0, 500):
+        lines.append(f"[  {index}.000] some kernel message <{index}>")
+        lines.append(f"<LAVA_SIGNAL_STARTTC test{index}>")
+        lines.append(f"test{index}: {'PASS' if index % 3 else 'FAIL'}")
+        lines.append(
+            f"<LAVA_SIGNAL_TESTCASE TEST_CASE_ID=test{index} RESULT=pass> <LAVA_SIGN"
+        )
+        lines.append(f"<LAVA_MULTI_NODE> <LAVA_WAIT id{index}>")
+    lines.append("<LAVA_TEST_RUNNER EXIT>")
+    (tmp_path / "console.txt").write_text("\n".join(lines) + "\n")
+    assert len(compare_with_pexpect(tmp_path / "console.txt")) == 2000
+
+
+def test_signal_searcher_wrapped_lines(tmp_path):
+    # The console wraps the long lines: the signals can contain end of lines
+    # and multinode messages contain an inner "<LAVA_" and ">"
+    lines = []
+    for index in range(0, 100):
+        lines.append(f"<LAVA_MULTI_NODE> <LAVA_SEND key{index}=val\r\nmore=1>")
+        lines.append(f"<LAVA_SIGNAL_TESTCASE TEST_CASE_ID=test{index}\r\nRESULT=pass>")
+        lines.append(f"<LAVA_SIGNAL_ENDTC\r\n test{index}> <LAVA_SIGNAL_STARTTC x>")
+    lines.append("<LAVA_TEST_RUNNER EXIT>")
+    (tmp_path / "console.txt").write_text("\n".join(lines) + "\n")
+    events = compare_with_pexpect(tmp_path / "console.txt")
+    assert len(events) == 300
+    assert [event[1][0] for event in events[:3]] == ["SEND", "TESTCASE", "STARTTC"]
+
+
+def test_signal_searcher_multiline_pattern(tmp_path):
+    # Test case result patterns can span several lines
+    patterns = PATTERNS[:-1] + [
+        re.compile(r"^(?P<test_case_id>\w+)\r?\n(?P<result>PASS|FAIL)", re.M)
+    ]
+    lines = []
+    for index in range(0, 100):
+        lines.append(f"<LAVA_SIGNAL_STARTTC test{index}>")
+        lines.append(f"test{index}")
+        lines.append("PASS" if index % 3 else "FAIL")
+    lines.append("<LAVA_TEST_RUNNER EXIT>")
+    (tmp_path / "console.txt").write_text("\n".join(lines) + "\n")
+    events = compare_with_pexpect(tmp_path / "console.txt", patterns)
+    assert len([event for event in events if event[0] == 6]) == 100
+
+
+def test_expect_searcher():
+    # Errors are translated like ShellCommand.expect() does
+    shell = ShellCommand("true", Timeout("test", 10), DummyLogger())
+    with pytest.raises(TestError):
+        shell.expect_searcher(SignalSearcher([r"<LAVA_SIGNAL_(\S+"]), timeout=10)
+    with pytest.raises(ConnectionClosedError):
+        shell.expect_searcher(SignalSearcher(PATTERNS[:2]), timeout=10)
+    shell.close()
@@ -0,0 +1,88 @@
+# Copyright (C) 2023 Linaro Limited
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import hashlib
+import os
+
+from lava_dispatcher.utils.cache import DownloadCache, copy_file, is_sha256
+
+
+def add(cache, data, key=None):
+    tmp = cache.tmp_file()
+    with tmp:
+        tmp.write(data)
+    sha256 = hashlib.sha256(data).hexdigest()
+    cache.add(tmp.name, key, {"size": len(data), "sha256": sha256, "md5": "md5"})
+    return sha256
+
+
+def test_url_key():
+    assert DownloadCache.url_key("https://example.com/dtb", None, None) is None
+    key = DownloadCache.url_key("https://example.com/dtb", '"abc"', None)
+    assert is_sha256(key)
+    assert key != DownloadCache.url_key("https://example.com/dtb", '"abd"', None)
+    assert key != DownloadCache.url_key("https://example.com/dtb", None, '"abc"')
+
+
+def test_is_sha256():
+    assert is_sha256(hashlib.sha256(b"").hexdigest())
+    assert not is_sha256(None)
+    assert not is_sha256("../../etc/passwd")
+    assert not is_sha256(hashlib.sha256(b"").hexdigest().upper())
+
+
+def test_download_cache(tmp_path):
+    cache = DownloadCache(tmp_path / "cache", 10)
+    assert cache.lookup("key", None) is None
+
+    sha256 = add(cache, b"hello", "key")
+    entry = cache.lookup("key", None)
+    assert entry == {
+        "size": 5,
+        "sha256": sha256,
+        "md5": "md5",
+        "path": str(tmp_path / "cache" / "data" / sha256),
+    }
+    assert cache.lookup(None, sha256) == entry
+    assert cache.lookup("other", None) is None
+    assert list((tmp_path / "cache" / "tmp").iterdir()) == []
+
+    # Truncated files are ignored
+    with open(entry["path"], "ab") as f_out:
+        f_out.write(b"!")
+    assert cache.lookup("key", None) is None
+
+    copy_file(tmp_path / "cache" / "data" / sha256, tmp_path / "copy")
+    assert (tmp_path / "copy").read_bytes() == b"hello!"
+
+
+def test_download_cache_eviction(tmp_path):
+    cache = DownloadCache(tmp_path / "cache", 10)
+    first = add(cache, b"first", "first")
+    os.utime(tmp_path / "cache" / "data" / first, (1, 1))
+    second = add(cache, b"12345", "second")
+    os.utime(tmp_path / "cache" / "data" / second, (2, 2))
+
+    # Using a file makes it the most recently used
+    assert cache.lookup("first", None) is not None
+    add(cache, b"third", "third")
+    assert cache.lookup("first", None) is not None
+    assert cache.lookup("second", None) is None
+    assert cache.lookup("third", None) is not None
+    assert not (tmp_path / "cache" / "data" / f"{second}.json").exists()
+
+
+def test_download_cache_locks(tmp_path):
+    cache = DownloadCache(tmp_path / "cache", 10)
+    with cache.lock("held"):
+        with cache.lock("other"):
+            pass
+        add(cache, b"hello", "key")
+        # Only the lock files that are held are kept
+        assert sorted(p.name for p in (tmp_path / "cache" / "locks").iterdir()) == [
+            "evict",
+            "held",
+        ]
+    with cache.lock("held"):
+        pass
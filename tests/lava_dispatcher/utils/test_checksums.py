@@ -0,0 +1,28 @@
+# Copyright (C) 2023 Linaro Limited
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import hashlib
+
+from lava_dispatcher.utils.checksums import Checksums
+
+
+def test_checksums():
+    data = [b"hello", b"world" * 10000]
+    with Checksums(["md5", "sha512"]) as checksums:
+        for buff in data:
+            checksums.update(buff)
+    assert checksums.hexdigests() == {
+        "md5": hashlib.md5(b"".join(data)).hexdigest(),  # nosec - test.
+        "sha512": hashlib.sha512(b"".join(data)).hexdigest(),
+    }
+
+
+def test_checksums_from_params():
+    assert list(Checksums.from_params({}).hashes) == ["sha256"]
+    assert list(Checksums.from_params({"sha256sum": "1234"}).hashes) == ["sha256"]
+    assert list(
+        Checksums.from_params(
+            {"url": "https://example.com/dtb", "md5sum": "1234", "sha512sum": "5678"}
+        ).hashes
+    ) == ["sha256", "md5", "sha512"]
@@ -349,6 +349,46 @@ class TestRestApi:
         )
         assert response.status_code == 404  # nosec - unit test support
 
+    def test_testjob_logs_range(self, monkeypatch, tmp_path):
+        (tmp_path / "output.yaml").write_text(LOG_FILE, encoding="utf-8")
+        monkeypatch.setattr(TestJob, "output_dir", str(tmp_path))
+        url = (
+            reverse("api-root", args=[self.version])
+            + "jobs/%s/logs/?start=1&end=2" % self.public_testjob1.id
+        )
+
+        response = self.userclient.get(url)
+        assert response.status_code == 200  # nosec - unit test support
+        assert response["Accept-Ranges"] == "bytes"  # nosec - unit test support
+        assert response["Content-Length"] == "120"  # nosec - unit test support
+        data = b"".join(response.streaming_content)
+        etag = response["ETag"]
+
+        # The content did not change
+        response = self.userclient.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304  # nosec - unit test support
+
+        # Resume the download
+        response = self.userclient.get(url, HTTP_RANGE="bytes=100-", HTTP_IF_RANGE=etag)
+        assert response.status_code == 206  # nosec - unit test support
+        assert response["Content-Range"] == "bytes 100-119/120"  # nosec
+        assert b"".join(response.streaming_content) == data[100:]  # nosec
+
+        response = self.userclient.get(url, HTTP_RANGE="bytes=-10")
+        assert response.status_code == 206  # nosec - unit test support
+        assert b"".join(response.streaming_content) == data[-10:]  # nosec
+
+        # The range is ignored when the content changed
+        response = self.userclient.get(
+            url, HTTP_RANGE="bytes=100-", HTTP_IF_RANGE='"0"'
+        )
+        assert response.status_code == 200  # nosec - unit test support
+        assert b"".join(response.streaming_content) == data  # nosec
+
+        response = self.userclient.get(url, HTTP_RANGE="bytes=200-")
+        assert response.status_code == 416  # nosec - unit test support
+        assert response["Content-Range"] == "bytes */120"  # nosec
+
     def test_testjob_nologs(self):
         response = self.userclient.get(
             reverse("api-root", args=[self.version])
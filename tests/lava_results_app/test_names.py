@@ -6,7 +6,11 @@ from django.core.validators import URLValidator
 from django.test import TestCase as DjangoTestCase
 
 from lava_common.yaml import yaml_safe_dump, yaml_safe_load
-from lava_results_app.dbutils import map_scanned_results
+from lava_results_app.dbutils import (
+    create_metadata_stores,
+    map_scanned_results,
+    new_test_cases,
+)
 from lava_results_app.models import TestCase, TestSuite
 from lava_scheduler_app.models import Device, DeviceType, TestJob
 
@@ -222,3 +226,75 @@ class TestTestSuite(TestCaseWithFactory):
             self.assertTrue(testcase.name.startswith("linux-INLINE-"))
             val("http://localhost/%s" % testcase.get_absolute_url())
         self.factory.cleanup()
+
+
+class TestBatch(TestCaseWithFactory):
+    """
+    Batched results ingestion
+    """
+
+    def test_cache(self):
+        job = TestJob.from_yaml_and_user(self.factory.make_job_yaml(), self.user)
+        result_samples = [
+            {
+                "case": "case-%d" % i,
+                "definition": "smoke-tests",
+                "result": "pass",
+                "set": "set-%d" % (i % 2),
+            }
+            for i in range(10)
+        ]
+        cache = {}
+        # One suite and two sets to create, with 4 queries each
+        with self.assertNumQueries(3 * 4):
+            test_cases = [
+                map_scanned_results(
+                    results=sample,
+                    job=job,
+                    starttc=i,
+                    endtc=i,
+                    meta_filename=None,
+                    cache=cache,
+                )
+                for i, sample in enumerate(result_samples)
+            ]
+        self.assertEqual(
+            [tc.test_set.name for tc in test_cases], ["set-0", "set-1"] * 5
+        )
+        TestCase.objects.bulk_create(test_cases[:6])
+
+        # Only the test cases that are not already saved are kept
+        with self.assertNumQueries(1):
+            self.assertEqual(new_test_cases(job, test_cases), test_cases[6:])
+        self.factory.cleanup()
+
+    def test_metadata_stores(self):
+        job = TestJob.from_yaml_and_user(self.factory.make_job_yaml(), self.user)
+        result_samples = [
+            {
+                "case": "case",
+                "definition": "lava",
+                "level": "1.1",
+                "extra": {"a": 1},
+                "result": "pass",
+            },
+            {"case": "no-extra", "definition": "lava", "result": "pass"},
+            {
+                "case": "case",
+                "definition": "lava",
+                "level": "1.1",
+                "extra": {"b": 2},
+                "result": "pass",
+            },
+        ]
+        filenames = create_metadata_stores(result_samples, job)
+        meta_filename = os.path.join(job.output_dir, "metadata", "lava-case-1.1.yaml")
+        self.assertEqual(filenames, [meta_filename, None, meta_filename])
+        with open(meta_filename) as f_in:
+            self.assertEqual(yaml_safe_load(f_in), {"a": 1, "b": 2})
+
+        # Existing stores are updated
+        create_metadata_stores([dict(result_samples[0], extra={"c": 3})], job)
+        with open(meta_filename) as f_in:
+            self.assertEqual(yaml_safe_load(f_in), {"a": 1, "b": 2, "c": 3})
+        self.factory.cleanup()
@@ -1,3 +1,4 @@
+import pytest
 import yaml
 from django.contrib.auth.models import Group, Permission, User
 from django.db.models import Q
@@ -274,3 +275,55 @@ class DeviceTypeTest(TestCaseWithFactory):
             {"beaglebone-black", "qemu"},
             set(active_device_types().values_list("name", flat=True)),
         )
+
+
+@pytest.mark.django_db
+def test_device_cache(mocker, settings, tmp_path):
+    (tmp_path / "devices").mkdir()
+    (tmp_path / "health-checks").mkdir()
+    settings.HEALTH_CHECKS_PATH = str(tmp_path / "health-checks")
+    mocker.patch.dict(
+        "lava_server.files.File.KINDS",
+        {"device": ([str(tmp_path / "devices")], "{name}.jinja2")},
+    )
+
+    def devices():
+        return JinjaSandboxEnv(
+            loader=File("device").loader(), autoescape=False, trim_blocks=True
+        )
+
+    mocker.patch("lava_scheduler_app.environment.devices", devices)
+
+    dt = DeviceType.objects.create(name="qemu")
+    device = Device.objects.create(
+        device_type=dt, hostname="qemu-cache-01", health=Device.HEALTH_GOOD
+    )
+    device_dict = tmp_path / "devices" / "qemu-cache-01.jinja2"
+    device_dict.write_text(
+        "{% extends 'qemu.jinja2' %}\n{% set mac_addr = '52:54:00:12:34:59' %}\n",
+        encoding="utf-8",
+    )
+    health_check = tmp_path / "health-checks" / "qemu.yaml"
+    health_check.write_text("job_name: qemu\n", encoding="utf-8")
+
+    load_configuration = mocker.spy(Device, "load_configuration")
+    assert device.is_valid() is True
+    assert device.get_extends() == "qemu"
+    assert device.get_health_check() == "job_name: qemu\n"
+    calls = load_configuration.call_count
+
+    # Nothing changed: everything is served from the cache
+    assert device.is_valid() is True
+    assert device.get_extends() == "qemu"
+    assert device.get_health_check() == "job_name: qemu\n"
+    assert load_configuration.call_count == calls
+
+    # Updating the health-check invalidates the cached content
+    health_check.write_text("job_name: qemu health-check\n", encoding="utf-8")
+    assert device.get_health_check() == "job_name: qemu health-check\n"
+
+    # Updating the device dictionary invalidates every checks
+    device_dict.write_text("{% extends 'unknown.jinja2' %}\n", encoding="utf-8")
+    assert device.is_valid() is False
+    assert device.get_extends() == "unknown"
+    assert device.get_health_check() is None
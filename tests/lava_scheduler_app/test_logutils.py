@@ -11,7 +11,12 @@ import pytest
 from django.conf import settings
 
 from lava_common.yaml import yaml_safe_dump, yaml_safe_load
-from lava_scheduler_app.logutils import LogsElasticsearch, LogsFilesystem, LogsMongo
+from lava_scheduler_app.logutils import (
+    LogsElasticsearch,
+    LogsFilesystem,
+    LogsMongo,
+    LogsStream,
+)
 
 
 def check_pymongo():
@@ -104,6 +109,172 @@ def test_write_logs(mocker, tmp_path, logs_filesystem):
         assert f_idx.read(8) == b"\x0c\x00\x00\x00\x00\x00\x00\x00"  # nosec
 
 
+def test_write_lines(mocker, tmp_path, logs_filesystem):
+    job = mocker.Mock()
+    job.output_dir = tmp_path / "job"
+    assert logs_filesystem.line_count(job) == 0  # nosec
+
+    lines = [
+        b'- {"dt": "2023-06-01T05:24:00.060423", "lvl": "info", "msg": "a"}\n',
+        b'- {"dt": "2023-06-01T05:24:01.000000", "lvl": "debug", "msg": "b"}\n',
+        b'- {"dt": "2023-06-01T05:24:02.000000", "lvl": "info", "msg": "c"}\n',
+    ]
+    get_handles = mocker.spy(logs_filesystem, "_get_handles")
+    logs_filesystem.write_lines(
+        job,
+        [
+            (lines[0], "info", "2023-06-01T05:24:00.060423"),
+            (lines[1], "debug", "2023-06-01T05:24:01.000000"),
+        ],
+    )
+    logs_filesystem.write_lines(job, [(lines[2], "info", "2023-06-01T05:24:02")])
+    logs_filesystem.write_lines(job, [])
+    # The files are only opened once
+    assert len(logs_filesystem.handles) == 1  # nosec
+    assert get_handles.call_count == 2  # nosec
+
+    assert logs_filesystem.read(job) == b"".join(lines).decode("utf-8")  # nosec
+    assert logs_filesystem.line_count(job) == 3  # nosec
+    assert logs_filesystem.read(job, start=1, end=2) == lines[1].decode()  # nosec
+    assert logs_filesystem.line_metadata(job, 1) == [
+        ("debug", 1685597041.0),
+        ("info", 1685597042.0),
+    ]  # nosec
+
+    # Filter by level without parsing the lines
+    mocker.patch("lava_scheduler_app.logutils.yaml_safe_load", side_effect=Exception)
+    assert logs_filesystem.read_levels(job, ["info"]) == (lines[0] + lines[2]).decode(
+        "utf-8"
+    )  # nosec
+    assert logs_filesystem.read_levels(job, ["debug"], start=2) == ""  # nosec
+
+    # Closing the files
+    logs_filesystem.close(job)
+    assert logs_filesystem.handles == {}  # nosec
+
+
+def test_open_range(mocker, tmp_path, logs_filesystem):
+    job = mocker.Mock()
+    job.output_dir = tmp_path
+    (tmp_path / "output.yaml").write_bytes(b"line 1\nline 2\nline 3\n")
+
+    log_range = logs_filesystem.open_range(job, 1, 2)
+    assert (log_range.offset, log_range.length) == (7, 7)  # nosec
+    assert log_range.read() == b"line 2\n"  # nosec
+    log_range.close()
+
+    log_range = logs_filesystem.open_range(job, 1)
+    log_range.narrow(2, 5)
+    assert log_range.read(2) == b"ne"  # nosec
+    assert log_range.read() == b" "  # nosec
+    log_range.close()
+
+    log_range = logs_filesystem.open_range(job, 5)
+    assert log_range.length == 0  # nosec
+    log_range.close()
+
+    # Compressed logs are not served directly
+    (tmp_path / "output.yaml").unlink()
+    assert logs_filesystem.open_range(job) is None  # nosec
+
+
+def test_read_levels_without_metadata(mocker, tmp_path, logs_filesystem):
+    job = mocker.Mock()
+    job.output_dir = tmp_path
+    (tmp_path / "output.yaml").write_text(
+        '- {"dt": "2023-06-01T05:24:00.060423", "lvl": "info", "msg": "a"}\n'
+        '- {"dt": "2023-06-01T05:24:01.000000", "lvl": "debug", "msg": "b"}\n',
+        encoding="utf-8",
+    )
+    assert logs_filesystem.line_metadata(job) is None  # nosec
+    assert (
+        logs_filesystem.read_levels(job, ["debug"])
+        == '- {"dt": "2023-06-01T05:24:01.000000", "lvl": "debug", "msg": "b"}\n'
+    )  # nosec
+
+
+def test_read_logs_compressed_blocks(mocker, tmp_path, logs_filesystem):
+    job = mocker.Mock()
+    job.output_dir = tmp_path
+    lines = [
+        f'- {{"dt": "2023-06-01T05:24:00.060423", "lvl": "info", "msg": "{i}"}}\n'
+        for i in range(20)
+    ]
+    data = "".join(lines).encode("utf-8")
+    (tmp_path / "output.yaml").write_bytes(data)
+    logs_filesystem._build_index(job)
+    (tmp_path / "output.yaml").unlink()
+
+    # Blocks of about three lines
+    mocker.patch.object(LogsFilesystem, "BLOCK_SIZE", len(lines[0]) * 3 - 10)
+    logs_filesystem.compress(job, data)
+    assert (tmp_path / "output.yaml.xz.blocks").stat().st_size == 7 * 16  # nosec
+
+    # Still a valid xz file
+    with lzma.open(str(tmp_path / "output.yaml.xz"), "rb") as f_in:
+        assert f_in.read() == data  # nosec
+
+    decompress = mocker.spy(lzma, "decompress")
+    assert logs_filesystem.read(job, start=4, end=5) == lines[4]  # nosec
+    assert decompress.call_count == 1  # nosec
+    assert logs_filesystem.read(job, start=2, end=10) == "".join(lines[2:10])  # nosec
+    assert logs_filesystem.read(job, start=17) == "".join(lines[17:])  # nosec
+    assert logs_filesystem.read(job, start=19, end=30) == lines[19]  # nosec
+    assert logs_filesystem.read(job, start=21) == ""  # nosec
+    assert logs_filesystem.read(job) == data.decode("utf-8")  # nosec
+
+
+def test_iter_lines(mocker, tmp_path, logs_filesystem):
+    job = mocker.Mock()
+    job.output_dir = tmp_path
+    lines = [
+        f'- {{"dt": "2023-06-01T05:24:00.060423", "lvl": "info", "msg": "{i}"}}\n'
+        for i in range(20)
+    ]
+    data = "".join(lines).encode("utf-8")
+    (tmp_path / "output.yaml").write_bytes(data)
+    logs_filesystem._build_index(job)
+
+    # Read about two lines at once: chunks are only made of complete lines
+    mocker.patch.object(LogsFilesystem, "CHUNK_SIZE", len(lines[0]) * 2 - 10)
+    chunks = list(logs_filesystem.iter_bytes(job))
+    assert b"".join(chunks) == data  # nosec
+    assert len(chunks) > 5  # nosec
+    assert all(chunk.endswith(b"\n") for chunk in chunks)  # nosec
+    assert max(len(chunk) for chunk in chunks) <= len(lines[0]) * 3  # nosec
+
+    chunks = list(logs_filesystem.iter_lines(job, start=5, end=9))
+    assert len(chunks) > 1  # nosec
+    assert [line["msg"] for chunk in chunks for line in chunk] == [
+        "5",
+        "6",
+        "7",
+        "8",
+    ]  # nosec
+    assert list(logs_filesystem.iter_lines(job, start=20)) == []  # nosec
+    assert logs_filesystem.read_lines(job, start=18) == [
+        {"dt": "2023-06-01T05:24:00.060423", "lvl": "info", "msg": "18"},
+        {"dt": "2023-06-01T05:24:00.060423", "lvl": "info", "msg": "19"},
+    ]  # nosec
+
+    # Compressed logs are streamed block by block
+    (tmp_path / "output.yaml").unlink()
+    mocker.patch.object(LogsFilesystem, "BLOCK_SIZE", len(lines[0]) * 3 - 10)
+    logs_filesystem.compress(job, data)
+    assert b"".join(logs_filesystem.iter_bytes(job, start=3)) == b"".join(
+        line.encode("utf-8") for line in lines[3:]
+    )  # nosec
+    assert logs_filesystem.open(job).read() == data  # nosec
+
+
+def test_logs_stream():
+    stream = LogsStream(iter([b"hello ", b"", b"world\n"]))
+    assert stream.read(3) == b"hel"  # nosec
+    assert stream.read(10) == b"lo "  # nosec
+    assert stream.read() == b"world\n"  # nosec
+    assert stream.read(10) == b""  # nosec
+
+
 @unittest.skipIf(check_pymongo(), "openocd not installed")
 def test_mongo_logs(mocker):
     mocker.patch("pymongo.database.Database.command")
@@ -141,7 +312,7 @@ def test_mongo_logs(mocker):
     assert len(result) == 2  # nosec
     assert result == find_ret_val  # nosec
     # size of find_ret_val in bytes
-    assert logs_mongo.size(job) == 137  # nosec
+    assert logs_mongo.size(job) == 157  # nosec
 
     assert logs_mongo.read(job) == yaml_safe_dump(find_ret_val)
 
@@ -183,7 +354,12 @@ def test_elasticsearch_logs(mocker, logs_elasticsearch):
         {"dt": "2020-03-25T19:44:36.210000", "lvl": "info", "msg": "second message"},
     ]  # nosec
     # size of get_ret_val in bytes
-    assert logs_elasticsearch.size(job) == 137  # nosec
+    assert logs_elasticsearch.size(job) == 157  # nosec
+    # The logs are streamed with one line per record
+    assert logs_elasticsearch.open(job).read() == (
+        b'- {"dt": "2020-03-25T19:44:36.209000", "lvl": "info", "msg": "first message"}\n'
+        b'- {"dt": "2020-03-25T19:44:36.210000", "lvl": "info", "msg": "second message"}\n'
+    )  # nosec
 
     assert logs_elasticsearch.read(job) == yaml_safe_dump(
         [
@@ -5,6 +5,7 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import json
 import logging
 import time
 from datetime import timedelta
@@ -13,8 +14,15 @@ from django.contrib.auth.models import User
 from django.test import TestCase
 from django.utils import timezone
 
-from lava_scheduler_app.models import Device, DeviceType, TestJob, Worker
-from lava_scheduler_app.scheduler import schedule, schedule_health_checks
+from lava_common.yaml import yaml_safe_dump, yaml_safe_load
+from lava_scheduler_app.models import Device, DeviceType, Tag, TestJob, Worker
+from lava_scheduler_app.scheduler import (
+    WorkersView,
+    check_queue_timeout,
+    schedule,
+    schedule_health_checks,
+    worker_summary,
+)
 
 
 def _minimal_valid_job(self):
@@ -821,6 +829,28 @@ class TestJobLimit(TestCase):
         assert TestJob.objects.filter(state=TestJob.STATE_SCHEDULED).count() == 4
         assert TestJob.objects.filter(state=TestJob.STATE_SUBMITTED).count() == 0
 
+    def test_workers_view(self):
+        for i in range(0, 4):
+            TestJob.objects.create(
+                requested_device_type=self.device_type01,
+                submitter=self.user,
+                definition=_minimal_valid_job(None),
+            )
+        view = WorkersView()
+        view.reconcile()
+        assert view.summary() == worker_summary()
+        schedule(self.logger, ["qemu"], ["worker-01"], view.summary())
+        assert TestJob.objects.filter(state=TestJob.STATE_SCHEDULED).count() == 2
+
+        # Replay the device events: updates are idempotent
+        for device in Device.objects.filter(state=Device.STATE_RESERVED):
+            for _ in range(0, 2):
+                view.update_device(device.hostname, "worker-01", "qemu", "Reserved")
+        assert view.summary() == worker_summary()
+        assert view.summary()["worker-01"].overused()
+        schedule(self.logger, ["qemu"], ["worker-01"], view.summary())
+        assert TestJob.objects.filter(state=TestJob.STATE_SCHEDULED).count() == 2
+
 
 # test both healthcheck and normal testjobs with joblimit
 class TestJobQueueTimeout(TestCase):
@@ -849,6 +879,7 @@ class TestJobQueueTimeout(TestCase):
             requested_device_type=self.device_type01,
             submitter=self.user,
             queue_timeout=int(timedelta(seconds=1).total_seconds()),
+            queue_deadline=timezone.now() + timedelta(seconds=1),
         )
         assert TestJob.objects.all().count() == 1
         # Limit the number of jobs that can run
@@ -865,3 +896,131 @@ class TestJobQueueTimeout(TestCase):
         else:
             assert canceling == 1
             assert canceled == 0
+
+    def test_multinode(self):
+        deadline = timezone.now() - timedelta(seconds=1)
+        jobs = [
+            TestJob.objects.create(
+                requested_device_type=self.device_type01,
+                submitter=self.user,
+                target_group="group-01",
+                sub_id=f"1.{i}",
+                queue_timeout=1,
+                queue_deadline=deadline if i == 0 else None,
+            )
+            for i in range(0, 3)
+        ]
+        other = TestJob.objects.create(
+            requested_device_type=self.device_type01,
+            submitter=self.user,
+            queue_timeout=3600,
+            queue_deadline=timezone.now() + timedelta(hours=1),
+        )
+        check_queue_timeout(self.logger)
+        for job in jobs:
+            job.refresh_from_db()
+            assert job.state == TestJob.STATE_FINISHED
+            assert job.health == TestJob.HEALTH_CANCELED
+        other.refresh_from_db()
+        assert other.state == TestJob.STATE_SUBMITTED
+
+
+class TestSchedulingEngine(TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger()
+        self.worker01 = Worker.objects.create(
+            hostname="worker-01", state=Worker.STATE_ONLINE
+        )
+        self.user = User.objects.create(username="user-01")
+        self.device_type01 = DeviceType.objects.create(
+            name="qemu", disable_health_check=True
+        )
+        self.tag01 = Tag.objects.create(name="usb")
+        self.device01 = Device.objects.create(
+            hostname="qemu01",
+            device_type=self.device_type01,
+            worker_host=self.worker01,
+            health=Device.HEALTH_GOOD,
+        )
+        self.device01.tags.add(self.tag01)
+        self.device02 = Device.objects.create(
+            hostname="qemu02",
+            device_type=self.device_type01,
+            worker_host=self.worker01,
+            health=Device.HEALTH_GOOD,
+        )
+
+    def _submit(self, count, tags=None, priority=TestJob.MEDIUM):
+        jobs = []
+        for _ in range(0, count):
+            job = TestJob.objects.create(
+                requested_device_type=self.device_type01,
+                submitter=self.user,
+                definition=_minimal_valid_job(None),
+                priority=priority,
+            )
+            if tags:
+                job.tags.add(*tags)
+            jobs.append(job)
+        return jobs
+
+    def test_tags(self):
+        (job01,) = self._submit(1, tags=[self.tag01])
+        (job02,) = self._submit(1, tags=[self.tag01])
+        (job03,) = self._submit(1, priority=TestJob.LOW)
+
+        stats = schedule(self.logger, [], ["worker-01"])
+        assert stats.jobs == 3
+        assert stats.scheduled == 2
+
+        job01.refresh_from_db()
+        job02.refresh_from_db()
+        job03.refresh_from_db()
+        assert job01.state == TestJob.STATE_SCHEDULED
+        assert job01.actual_device == self.device01
+        assert job02.state == TestJob.STATE_SUBMITTED
+        assert job02.actual_device is None
+        assert job03.state == TestJob.STATE_SCHEDULED
+        assert job03.actual_device == self.device02
+
+    def test_queries_do_not_depend_on_queue_length(self):
+        self.device02.health = Device.HEALTH_MAINTENANCE
+        self.device02.save()
+        self._submit(5, tags=[self.tag01])
+        stats_short = schedule(self.logger, [], ["worker-01"])
+        assert stats_short.scheduled == 1
+        for job in TestJob.objects.filter(state=TestJob.STATE_SCHEDULED):
+            job.go_state_finished(TestJob.HEALTH_COMPLETE)
+            job.save()
+
+        self._submit(50, tags=[self.tag01])
+        stats_long = schedule(self.logger, [], ["worker-01"])
+        assert stats_long.scheduled == 1
+        assert stats_long.jobs == 54
+        # The queue is loaded once, not once per device and per job
+        assert stats_long.queries < stats_long.jobs
+        assert stats_long.queries <= stats_short.queries
+
+    def test_multinode(self):
+        jobs = []
+        for role in ["server", "client"]:
+            definition = {"protocols": {"lava-multinode": {"role": role}}}
+            jobs.append(
+                TestJob.objects.create(
+                    requested_device_type=self.device_type01,
+                    submitter=self.user,
+                    definition=yaml_safe_dump(definition),
+                    requirements=json.dumps({"role": role}),
+                    target_group="group-01",
+                )
+            )
+
+        stats = schedule(self.logger, [], ["worker-01"])
+        assert stats.scheduled == 2
+        roles = {str(job.id): role for (job, role) in zip(jobs, ["server", "client"])}
+        for job in jobs:
+            job.refresh_from_db()
+            assert job.state == TestJob.STATE_SCHEDULED
+            assert job.actual_device.state == Device.STATE_RESERVED
+            definition = yaml_safe_load(job.definition)
+            assert definition["protocols"]["lava-multinode"]["roles"] == roles
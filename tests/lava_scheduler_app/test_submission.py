@@ -1,9 +1,10 @@
+import datetime
 import json
 import logging
 import os
 from pathlib import Path
-from tempfile import TemporaryDirectory
-from unittest.mock import patch
+from tempfile import TemporaryDirectory, TemporaryFile
+from unittest.mock import MagicMock, patch
 
 from django.contrib.auth.models import Group, Permission, User
 from django.test import TestCase
@@ -217,6 +218,28 @@ class TestTestJob(TestCaseWithFactory):
             data["state_string"], TestJob.STATE_CHOICES[TestJob.STATE_SUBMITTED][1]
         )
 
+    def test_queue_deadline(self):
+        self.factory.cleanup()
+        user = self.factory.make_user()
+        dt = self.factory.make_device_type(name="qemu")
+        device = self.factory.make_device(device_type=dt, hostname="qemu-1")
+        device.save()
+        definition = yaml_safe_load(
+            self.factory.make_job_data_from_file("qemu-pipeline-first-job.yaml")
+        )
+        job = testjob_submission(yaml_safe_dump(definition), user, None)
+        self.assertIsNone(job.queue_deadline)
+
+        definition["timeouts"]["queue"] = {"minutes": 5}
+        job = testjob_submission(yaml_safe_dump(definition), user, None)
+        job.refresh_from_db()
+        self.assertEqual(job.queue_timeout, 300)
+        self.assertAlmostEqual(
+            job.queue_deadline - job.submit_time,
+            datetime.timedelta(seconds=300),
+            delta=datetime.timedelta(seconds=1),
+        )
+
     def test_device_type_alias(self):
         self.factory.cleanup()
         user = self.factory.make_user()
@@ -301,6 +324,49 @@ class TestNotificationPost(TestNotificationBase):
             # Post requests generate compressed JSON
             self.assertTrue(tuple(Path(self.job_temp_dir.name).iterdir()))
 
+    def test_notification_callback_post_json_logs(self):
+        (Path(self.job_temp_dir.name) / "output.yaml").write_text(
+            '- {"dt": "2023-06-01T05:24:00", "lvl": "info", "msg": "a \\"quoted\\" line"}\n',
+            encoding="utf-8",
+        )
+        callback = self.job.notification.notificationcallback_set.first()
+        callback.content_type = NotificationCallback.JSON
+        callback.dataset = NotificationCallback.ALL
+
+        # The logs are streamed but the json is the same
+        data = self.job.create_job_data(output=True, results=True)
+        self.assertEqual(
+            json.loads("".join(self.job.iter_job_data(output=True, results=True))),
+            data,
+        )
+
+        # The body is a file, so requests sends a Content-Length
+        bodies = []
+
+        def post(url, data, **kwargs):
+            bodies.append(data.read())
+            return MagicMock()
+
+        with patch("lava_scheduler_app.models.requests") as mock_requests:
+            mock_requests.post.side_effect = post
+            callback.invoke_callback()
+            mock_requests.post.assert_called_once()
+            kwargs = mock_requests.post.call_args[1]
+            self.assertEqual(kwargs["headers"]["Content-Type"], "application/json")
+            body = json.loads(bodies[0])
+            self.assertEqual(body["log"], data["log"])
+            self.assertEqual(body["token"], "abc123")
+
+        # The logs are left out if they cannot be read
+        with patch(
+            "lava_scheduler_app.models.logs_instance.iter_bytes",
+            side_effect=OSError,
+        ):
+            with TemporaryFile() as f_out:
+                self.job.write_job_data(f_out, output=True)
+                f_out.seek(0)
+                self.assertEqual(json.loads(f_out.read()), self.job.create_job_data())
+
 
 class TestNotificationCustomHeader(TestNotificationBase):
     JOB_DEFINITION_FILE = "qemu_callback_custom_header.yaml"
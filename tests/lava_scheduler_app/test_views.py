@@ -450,17 +450,32 @@ def test_job_status(client, setup):
 
 
 @pytest.mark.django_db
-def test_job_timing(client, monkeypatch, setup):
-    monkeypatch.setattr(
-        "lava_scheduler_app.logutils.logs_instance.read",
-        lambda dir_name: """
-- {"dt": "2019-11-05T09:06:14.952630", "lvl": "debug", "msg": "start: 1.1 deploy-device-env (timeout 00:03:52) [common]"}
+def test_job_timing(client, monkeypatch, setup, tmp_path):
+    monkeypatch.setattr(TestJob, "output_dir", property(lambda x: str(tmp_path)))
+    (tmp_path / "output.yaml").write_text(
+        """- {"dt": "2019-11-05T09:06:14.952630", "lvl": "debug", "msg": "start: 1.1 deploy-device-env (timeout 00:03:52) [common]"}
 - {"dt": "2019-11-05T09:06:14.953059", "lvl": "debug", "msg": "end: 1.1 deploy-device-env (duration 00:00:10) [common]"}
 """,
+        encoding="utf-8",
     )
     job_1 = TestJob.objects.get(description="test job 01")
     ret = client.post(reverse("lava.scheduler.job.timing", args=[job_1.pk]))
     assert ret.status_code == 200  # nosec
+    assert json_loads(ret.content)["graph"] == [
+        ["1.1", "deploy-device-env", 10.0, 232.0, False]
+    ]  # nosec
+    # The markers of finished jobs are saved: the logs are not read anymore
+    assert (tmp_path / "output.timing").read_text() == (
+        "start 1.1 deploy-device-env 232.0\nend 1.1 deploy-device-env 10.0\n"
+    )  # nosec
+    monkeypatch.setattr(
+        "lava_scheduler_app.logutils.logs_instance.iter_lines",
+        lambda dir_name: pytest.fail("logs should not be read"),
+    )
+    ret = client.post(reverse("lava.scheduler.job.timing", args=[job_1.pk]))
+    assert json_loads(ret.content)["graph"] == [
+        ["1.1", "deploy-device-env", 10.0, 232.0, False]
+    ]  # nosec
 
 
 @pytest.mark.django_db
@@ -509,22 +524,37 @@ def test_job_log_incremental_large_file(client, monkeypatch, setup):
 
 
 @pytest.mark.django_db
-def test_job_log_incremental(client, monkeypatch, setup):
-    monkeypatch.setattr(
-        "lava_scheduler_app.logutils.logs_instance.size", lambda dir_name: 100
-    )
-    monkeypatch.setattr(
-        "lava_scheduler_app.logutils.logs_instance.read",
-        lambda dir_name, first_line: """
-- {"dt": "2019-11-04T15:39:52.345099", "lvl": "results", "msg": {"case": "validate", "definition": "lava", "result": "pass"}}
+def test_job_log_incremental(client, monkeypatch, setup, tmp_path):
+    monkeypatch.setattr(TestJob, "output_dir", property(lambda x: str(tmp_path)))
+    job_1 = TestJob.objects.get(description="test job 01")
+    # Missing logs
+    ret = client.post(reverse("lava.scheduler.job.log_incremental", args=[job_1.pk]))
+    assert ret.status_code == 200  # nosec
+    assert json_loads(b"".join(ret.streaming_content)) == []  # nosec
+
+    (tmp_path / "output.yaml").write_text(
+        """- {"dt": "2019-11-04T15:39:52.345099", "lvl": "results", "msg": {"case": "validate", "definition": "lava", "result": "pass"}}
 - {"dt": "2019-11-04T15:39:52.345794", "lvl": "info", "msg": "start: 1 lxc-deploy (timeout 00:05:00) [tlxc]"}
 """,
+        encoding="utf-8",
     )
-    job_1 = TestJob.objects.get(description="test job 01")
     ret = client.post(reverse("lava.scheduler.job.log_incremental", args=[job_1.pk]))
     assert ret.status_code == 200  # nosec
     assert ret["X-Is-Finished"] == "1"  # nosec
-    assert ret.json()[0]["msg"]["result"] == "pass"
+    data = json_loads(b"".join(ret.streaming_content))
+    assert len(data) == 2  # nosec
+    assert data[0]["msg"]["result"] == "pass"  # nosec
+
+    # The lines are streamed by chunks
+    monkeypatch.setattr(
+        "lava_scheduler_app.logutils.logs_instance.CHUNK_SIZE", 10, raising=False
+    )
+    ret = client.post(reverse("lava.scheduler.job.log_incremental", args=[job_1.pk]))
+    assert json_loads(b"".join(ret.streaming_content)) == data  # nosec
+    ret = client.post(
+        reverse("lava.scheduler.job.log_incremental", args=[job_1.pk]) + "?line=1"
+    )
+    assert json_loads(b"".join(ret.streaming_content)) == data[1:]  # nosec
 
 
 @pytest.mark.django_db
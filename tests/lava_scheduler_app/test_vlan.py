@@ -112,6 +112,31 @@ class TestVlandDevices(TestCaseWithFactory):
                 match_vlan_interface(self.cubie2, yaml_safe_load(job.definition))
             )
 
+    def test_requirements(self):
+        self.factory.ensure_tag("usb-eth")
+        self.factory.ensure_tag("sata")
+        self.factory.bbb1.tags.set(Tag.objects.filter(name="usb-eth"))
+        self.factory.cubie1.tags.set(Tag.objects.filter(name="sata"))
+        user = self.factory.make_user()
+        vlan_job = TestJob.from_yaml_and_user(
+            yaml_safe_dump(self.factory.make_vland_job()), user
+        )
+        self.assertEqual(len(vlan_job), 2)
+        for job in vlan_job:
+            requirements = job.get_requirements()
+            definition = yaml_safe_load(job.definition)
+            role = definition["protocols"]["lava-multinode"]["role"]
+            self.assertEqual(requirements["role"], role)
+            self.assertEqual(
+                requirements["vland"], definition["protocols"]["lava-vland"]
+            )
+            self.assertNotIn("connection", requirements)
+            self.assertFalse(job.dynamic_connection)
+
+            # Jobs submitted before the requirements were stored
+            job.requirements = ""
+            self.assertEqual(job.get_requirements(), requirements)
+
     def test_jinja_template(self):
         yaml_data = self.factory.bbb1.load_configuration()
         self.assertIn("parameters", yaml_data)
@@ -4,7 +4,9 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import gzip
 from pathlib import Path
+from urllib.parse import urlencode
 
 import pytest
 from django.contrib.auth.models import User
@@ -14,6 +16,7 @@ from django.utils import timezone
 from lava_common.version import __version__
 from lava_common.yaml import yaml_safe_load
 from lava_results_app.models import TestCase
+from lava_scheduler_app.logutils import logs_instance, timing_instance
 from lava_scheduler_app.models import Device, DeviceType, TestJob, Worker
 
 
@@ -406,6 +409,121 @@ def test_internal_v1_jobs_logs(client, mocker, settings):
     assert tc.suite.job == j1
     assert tc.suite.name == "0_smoke-tests"
 
+    # Records: only the results and events are parsed
+    settings.EVENT_NOTIFICATION = True
+    mocker.patch("lava_scheduler_app.views.yaml_safe_load", side_effect=Exception)
+    mocker.patch("lava_common.log.yaml_safe_load", side_effect=Exception)
+    ret = client.post(
+        reverse("lava.scheduler.internal.v1.jobs.logs", args=[j1.id]),
+        data={"index": 5, "records": "info {}"},
+        HTTP_LAVA_TOKEN=j1.token,
+    )
+    assert ret.status_code == 400
+    assert ret.json()["error"] == "Invalid 'records'"
+
+    ret = client.post(
+        reverse("lava.scheduler.internal.v1.jobs.logs", args=[j1.id]),
+        data={
+            "index": 4,
+            "records": 'results 2023-06-01T05:24:00.000000 {"dt": "2023-06-01T05:24:00.000000", "lvl": "results", "msg": {"case": "linux-posix-pwd", "definition": "0_smoke-tests", "endtc": 20, "result": "pass", "starttc": 10}}\n'
+            'target 2023-06-01T05:24:01.000000 {"dt": "2023-06-01T05:24:01.000000", "lvl": "target", "msg": "a target \\e message"}\n'
+            'event 2023-06-01T05:24:02.000000 {"dt": "2023-06-01T05:24:02.000000", "lvl": "event", "msg": "an event"}',
+        },
+        HTTP_LAVA_TOKEN=j1.token,
+    )
+    assert ret.status_code == 200
+    assert ret.json() == {"line_count": 3}
+    assert (Path(j1.output_dir) / "output.yaml").read_text().split("\n")[5:] == [
+        '- {"dt": "2023-06-01T05:24:01.000000", "lvl": "target", "msg": "a target \\e message"}',
+        '- {"dt": "2023-06-01T05:24:02.000000", "lvl": "debug", "msg": "an event"}',
+        "",
+    ]
+    assert len(send_event.mock_calls) == 3
+    assert send_event.mock_calls[1][1] == (
+        ".event",
+        "lavaserver",
+        {"message": "an event", "job": j1.id},
+    )
+    # lava-publisher is notified of the new lines
+    assert send_event.mock_calls[2][1] == (
+        ".logs",
+        "lavaserver",
+        {"job": j1.id, "line_count": 7},
+    )
+    # The resent test case is not duplicated
+    assert TestCase.objects.count() == 1
+    assert logs_instance.line_metadata(j1, 5) == [
+        ("target", 1685597041.0),
+        ("debug", 1685597042.0),
+    ]
+
+    # The start and end of the actions are recorded for the timing view
+    ret = client.post(
+        reverse("lava.scheduler.internal.v1.jobs.logs", args=[j1.id]),
+        data={
+            "index": 7,
+            "records": 'info 2023-06-01T05:24:03.000000 {"dt": "2023-06-01T05:24:03.000000", "lvl": "info", "msg": "start: 1 deploy (timeout 00:01:00) [common]"}\n'
+            'debug 2023-06-01T05:24:04.000000 {"dt": "2023-06-01T05:24:04.000000", "lvl": "debug", "msg": "end: 1.1 download (duration 00:00:02) [common]"}\n'
+            'info 2023-06-01T05:24:05.000000 {"dt": "2023-06-01T05:24:05.000000", "lvl": "info", "msg": "end: 1 deploy (duration 00:00:12) [common]"}',
+        },
+        HTTP_LAVA_TOKEN=j1.token,
+    )
+    assert ret.status_code == 200
+    assert timing_instance.read(j1) == [
+        ("start", "1", "deploy", 60.0),
+        ("end", "1.1", "download", 2.0),
+        ("end", "1", "deploy", 12.0),
+    ]
+
+    # Compressed requests
+    url = reverse("lava.scheduler.internal.v1.jobs.logs", args=[j1.id])
+    body = urlencode(
+        {
+            "index": 10,
+            "records": 'target 2023-06-01T05:24:06.000000 {"dt": "2023-06-01T05:24:06.000000", "lvl": "target", "msg": "compressed"}',
+        }
+    ).encode()
+    ret = client.post(
+        url,
+        data=gzip.compress(body),
+        content_type="application/x-www-form-urlencoded",
+        HTTP_CONTENT_ENCODING="gzip",
+        HTTP_LAVA_TOKEN=j1.token,
+    )
+    assert ret.status_code == 200
+    assert ret.json() == {"line_count": 1}
+    assert logs_instance.read(j1, 10) == (
+        '- {"dt": "2023-06-01T05:24:06.000000", "lvl": "target", "msg": "compressed"}\n'
+    )
+
+    ret = client.post(
+        url,
+        data=body,
+        content_type="application/x-www-form-urlencoded",
+        HTTP_CONTENT_ENCODING="br",
+        HTTP_LAVA_TOKEN=j1.token,
+    )
+    assert ret.status_code == 415
+    ret = client.post(
+        url,
+        data=gzip.compress(body)[:-5],
+        content_type="application/x-www-form-urlencoded",
+        HTTP_CONTENT_ENCODING="gzip",
+        HTTP_LAVA_TOKEN=j1.token,
+    )
+    assert ret.status_code == 400
+    assert ret.json()["error"] == "Invalid body"
+    # The limit also applies to the uncompressed data
+    settings.DATA_UPLOAD_MAX_MEMORY_SIZE = len(gzip.compress(body)) + 1
+    ret = client.post(
+        url,
+        data=gzip.compress(body),
+        content_type="application/x-www-form-urlencoded",
+        HTTP_CONTENT_ENCODING="gzip",
+        HTTP_LAVA_TOKEN=j1.token,
+    )
+    assert ret.status_code == 413
+
 
 @pytest.mark.django_db
 def test_internal_v1_workers_get(client, mocker, settings):
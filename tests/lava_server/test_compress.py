@@ -6,6 +6,7 @@
 
 from __future__ import annotations
 
+import lzma
 from os import urandom
 from pathlib import Path
 from shutil import rmtree
@@ -57,3 +58,32 @@ class TestJobCompression(TestCase):
             (self.output_dir / self.log_system.compressed_log_filename).exists(),
             "Compressed log should exist",
         )
+
+        self.assertTrue(
+            (self.output_dir / self.log_system.compressed_blocks_filename).exists(),
+            "Compressed log blocks should exist",
+        )
+
+    def test_job_recompression(self) -> None:
+        data = (self.output_dir / self.log_system.log_filename).read_bytes()
+        with lzma.open(
+            str(self.output_dir / self.log_system.compressed_log_filename), "wb"
+        ) as f_out:
+            f_out.write(data)
+        (self.output_dir / self.log_system.log_filename).unlink()
+
+        with patch("lava_server.management.commands.jobs.chown"):
+            call_command("jobs", "recompress", f"--submitter={self.user.username}")
+
+        self.assertTrue(
+            (self.output_dir / self.log_system.compressed_blocks_filename).exists(),
+            "Compressed log blocks should exist",
+        )
+        with lzma.open(
+            str(self.output_dir / self.log_system.compressed_log_filename), "rb"
+        ) as f_in:
+            self.assertEqual(f_in.read(), data)
+        self.assertEqual(
+            (self.output_dir / "output.yaml.size").read_text(encoding="utf-8"),
+            str(len(data)),
+        )
@@ -0,0 +1,168 @@
+# Copyright (C) 2023 Linaro Limited
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import asyncio
+import importlib
+import json
+from pathlib import Path
+from shutil import rmtree
+
+import pytest
+from django.contrib.auth.models import User
+
+from lava_results_app.models import TestCase, TestSuite
+from lava_scheduler_app.models import TestJob
+
+lava_publisher = importlib.import_module(
+    "lava_server.management.commands.lava-publisher"
+)
+
+
+class FakeSocket:
+    def __init__(self):
+        self.messages = []
+
+    async def send_json(self, data):
+        self.messages.append(data)
+
+    def events(self):
+        return [json.loads(m[4]) for m in self.messages if isinstance(m, list)]
+
+
+@pytest.fixture
+def publisher(monkeypatch):
+    # Run the database queries in the event loop thread
+    monkeypatch.setenv("DJANGO_ALLOW_ASYNC_UNSAFE", "true")
+
+    def sync_to_async(func):
+        async def wrapper(*args, **kwargs):
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    monkeypatch.setattr(lava_publisher, "sync_to_async", sync_to_async)
+    return {"logs": {}}
+
+
+def write_lines(job, lines):
+    Path(job.output_dir).mkdir(parents=True, exist_ok=True)
+    with open(Path(job.output_dir) / "output.yaml", "a") as f_out:
+        for line in lines:
+            f_out.write(f"- {line}\n")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_logs_subscription(publisher):
+    user = User.objects.create(username="user")
+    job = TestJob.objects.create(
+        submitter=user, is_public=True, state=TestJob.STATE_RUNNING
+    )
+    suite = TestSuite.objects.create(job=job, name="lava")
+    case = TestCase.objects.create(suite=suite, name="validate", result=0)
+    rmtree(job.output_dir, ignore_errors=True)
+    write_lines(
+        job,
+        [
+            '{"dt": "2023-06-01T05:24:00", "lvl": "info", "msg": "first"}',
+            '{"dt": "2023-06-01T05:24:01", "lvl": "results", "msg": {"case": "validate", "definition": "lava", "result": "pass"}}',
+        ],
+    )
+
+    async def scenario():
+        ws1 = lava_publisher.Websocket("user", None, FakeSocket())
+        ws2 = lava_publisher.Websocket("user", None, FakeSocket())
+
+        # Invalid requests
+        await lava_publisher.handle_request(publisher, ws1, "{}")
+        await lava_publisher.handle_request(
+            publisher, ws1, json.dumps({"action": "subscribe", "job": job.id + 1})
+        )
+        assert ws1.socket.messages == [
+            {"error": "Invalid request"},
+            {"error": f"Unknown job '{job.id + 1}'"},
+        ]
+        ws1.socket.messages.clear()
+
+        # Lines already available are sent on subscription
+        await lava_publisher.handle_request(
+            publisher, ws1, json.dumps({"action": "subscribe", "job": job.id})
+        )
+        # Late joiners can choose the starting line
+        await lava_publisher.handle_request(
+            publisher,
+            ws2,
+            json.dumps({"action": "subscribe", "job": job.id, "line": 1}),
+        )
+        assert ws1.socket.events() == [
+            {
+                "job": job.id,
+                "line": 0,
+                "logs": [
+                    {"dt": "2023-06-01T05:24:00", "lvl": "info", "msg": "first"},
+                    {
+                        "dt": "2023-06-01T05:24:01",
+                        "lvl": "results",
+                        "msg": {
+                            "case": "validate",
+                            "definition": "lava",
+                            "result": "pass",
+                            "case_id": case.id,
+                        },
+                    },
+                ],
+            }
+        ]
+        assert [e["line"] for e in ws2.socket.events()] == [1]
+        assert publisher["logs"][job.id].sockets == {ws1: 2, ws2: 2}
+
+        # New lines are pushed to every subscriber
+        write_lines(
+            job, ['{"dt": "2023-06-01T05:24:02", "lvl": "target", "msg": "third"}']
+        )
+        await lava_publisher.push_logs(publisher, job.id)
+        assert ws1.socket.events()[-1] == ws2.socket.events()[-1]
+        assert ws1.socket.events()[-1]["line"] == 2
+        assert ws1.socket.events()[-1]["logs"][0]["msg"] == "third"
+
+        lava_publisher.unsubscribe(publisher, ws2)
+        assert publisher["logs"][job.id].sockets == {ws1: 3}
+
+        # The subscribers are notified when the job is finished
+        await lava_publisher.finish_logs(publisher, job.id)
+        assert ws1.socket.events()[-1] == {"job": job.id, "finished": True}
+        assert publisher["logs"] == {}
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_logs_subscription_chunks(publisher, monkeypatch):
+    monkeypatch.setattr(lava_publisher, "LOGS_CHUNK_LINES", 2)
+    user = User.objects.create(username="user")
+    job = TestJob.objects.create(
+        submitter=user, is_public=True, state=TestJob.STATE_RUNNING
+    )
+    rmtree(job.output_dir, ignore_errors=True)
+    write_lines(
+        job,
+        [
+            f'{{"dt": "2023-06-01T05:24:0{i}", "lvl": "target", "msg": "{i}"}}'
+            for i in range(0, 5)
+        ],
+    )
+
+    async def scenario():
+        ws = lava_publisher.Websocket("user", None, FakeSocket())
+        # Late joiners receive the lines by chunks
+        await lava_publisher.handle_request(
+            publisher, ws, json.dumps({"action": "subscribe", "job": job.id})
+        )
+        assert [(e["line"], len(e["logs"])) for e in ws.socket.events()] == [
+            (0, 2),
+            (2, 2),
+            (4, 1),
+        ]
+        assert publisher["logs"][job.id].sockets == {ws: 5}
+
+    asyncio.run(scenario())
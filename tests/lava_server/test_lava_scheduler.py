@@ -90,6 +90,53 @@ def test_get_available_dts(mocker):
     assert cmd.get_available_dts() == {"docker", "qemu"}
 
 
+@pytest.mark.django_db
+def test_get_available_dts_workers(mocker):
+    cmd = Command()
+    cmd.logger = mocker.Mock()
+    cmd.sub = mocker.Mock()
+    cmd.view.limits = {"worker-01": 1}
+    cmd.view.devices = {"qemu-01": ("worker-01", "qemu", False)}
+
+    def event(topic, data):
+        return [topic, "", "", "", json.dumps(data)]
+
+    cmd.sub.recv_multipart = mocker.Mock(
+        side_effect=[
+            event(
+                b"test.device",
+                {
+                    "state": "Reserved",
+                    "health": "Good",
+                    "device": "qemu-01",
+                    "device_type": "qemu",
+                    "worker": "worker-01",
+                },
+            ),
+            event(
+                b"test.worker",
+                {"hostname": "worker-01", "state": "Online", "health": "Active"},
+            ),
+            zmq.ZMQError,
+        ]
+    )
+    assert cmd.get_available_dts() == {"qemu"}
+    assert cmd.workers == ["worker-01"]
+    assert cmd.view.summary()["worker-01"].overused()
+
+    cmd.sub.recv_multipart = mocker.Mock(
+        side_effect=[
+            event(
+                b"test.worker",
+                {"hostname": "worker-01", "state": "Online", "health": "Maintenance"},
+            ),
+            zmq.ZMQError,
+        ]
+    )
+    assert cmd.get_available_dts() == set()
+    assert cmd.workers == []
+
+
 @pytest.mark.django_db
 def test_main_loop(mocker):
     schedule = mocker.Mock()
@@ -98,7 +145,7 @@ def test_main_loop(mocker):
     cmd = Command()
     cmd.logger = mocker.Mock()
     cmd.poller = mocker.Mock()
-    cmd.check_workers = mocker.Mock()
+    cmd.check_workers = mocker.Mock(return_value=[])
     cmd.get_available_dts = mocker.Mock(side_effect=[{"qemu", "docker"}, KeyError])
 
     with pytest.raises(KeyError):
@@ -107,6 +154,29 @@ def test_main_loop(mocker):
     assert len(schedule.mock_calls) == 2
     assert schedule.mock_calls[0][1][1] == set()
     assert schedule.mock_calls[1][1][1] == {"qemu", "docker"}
+    # Only the full pass is checking the workers
+    assert len(cmd.check_workers.mock_calls) == 1
+
+
+@pytest.mark.django_db
+def test_main_loop_reconcile(mocker):
+    schedule = mocker.Mock()
+    mocker.patch(__name__ + ".lava_scheduler.schedule", schedule)
+    monotonic = mocker.patch(__name__ + ".lava_scheduler.time.monotonic")
+    monotonic.side_effect = [0, 0, 0, lava_scheduler.INTERVAL, 0, 0]
+
+    cmd = Command()
+    cmd.logger = mocker.Mock()
+    cmd.poller = mocker.Mock()
+    cmd.check_workers = mocker.Mock(return_value=[])
+    cmd.get_available_dts = mocker.Mock(side_effect=[{"qemu"}, KeyError])
+
+    with pytest.raises(KeyError):
+        cmd.main_loop()
+    # Events were received but the last full pass is too old
+    assert len(schedule.mock_calls) == 2
+    assert schedule.mock_calls[1][1][1] == set()
+    assert len(cmd.check_workers.mock_calls) == 2
 
 
 @pytest.mark.django_db
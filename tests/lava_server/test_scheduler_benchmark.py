@@ -0,0 +1,103 @@
+# Copyright (C) 2026 Linaro Limited
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import importlib
+import json
+from io import StringIO
+
+import pytest
+from django.contrib.auth.models import User
+from django.core.management import call_command
+
+from lava_scheduler_app.models import Device, DeviceType, TestJob, Worker
+
+benchmark = importlib.import_module(
+    "lava_server.management.commands.scheduler-benchmark"
+)
+
+
+@pytest.fixture
+def test_database(mocker):
+    # The tests are already running in a test database
+    mocker.patch(__name__ + ".benchmark.setup_databases", return_value=[])
+    mocker.patch(__name__ + ".benchmark.teardown_databases")
+
+
+@pytest.mark.django_db
+def test_synthetic(test_database, tmp_path):
+    out = StringIO()
+    call_command(
+        "scheduler-benchmark",
+        "synthetic",
+        "--workers=2",
+        "--device-types=2",
+        "--devices=10",
+        "--jobs=20",
+        "--multinode=2",
+        "--iterations=2",
+        "--output",
+        str(tmp_path / "snapshot.json"),
+        stdout=out,
+    )
+    lines = out.getvalue().split("\n")
+    iterations = [line for line in lines if line.startswith("[")]
+    assert len(iterations) == 2
+    # Dry-run: every pass is scheduling the same jobs
+    assert iterations[0].split(" ")[1:3] == iterations[1].split(" ")[1:3]
+    assert "  * health-checks" in "\n".join(lines)
+    assignments = [line for line in lines if line.endswith(" assignments")]
+    assert assignments[0] == assignments[1]
+    assert assignments[0] != "  * 0 assignments"
+
+    # Nothing is left in the database
+    assert Device.objects.count() == 0
+    assert TestJob.objects.count() == 0
+
+    data = json.loads((tmp_path / "snapshot.json").read_text(encoding="utf-8"))
+    assert len(data["devices"]) == 10
+    assert len([j for j in data["jobs"] if not j["target_group"]]) == 20
+
+
+@pytest.mark.django_db
+def test_snapshot_replay(test_database, tmp_path):
+    user = User.objects.create(username="user-01")
+    worker = Worker.objects.create(
+        hostname="worker-01",
+        state=Worker.STATE_ONLINE,
+        health=Worker.HEALTH_ACTIVE,
+    )
+    dt = DeviceType.objects.create(name="qemu", disable_health_check=True)
+    Device.objects.create(
+        hostname="qemu01",
+        device_type=dt,
+        worker_host=worker,
+        health=Device.HEALTH_GOOD,
+    )
+    TestJob.objects.create(requested_device_type=dt, submitter=user)
+
+    out = StringIO()
+    call_command(
+        "scheduler-benchmark", "snapshot", str(tmp_path / "snapshot.json"), stdout=out
+    )
+    assert out.getvalue() == "1 devices and 1 jobs recorded\n"
+
+    # Replay in an empty database
+    TestJob.objects.all().delete()
+    Device.objects.all().delete()
+    DeviceType.objects.all().delete()
+    Worker.objects.all().delete()
+    user.delete()
+
+    out = StringIO()
+    call_command(
+        "scheduler-benchmark",
+        "replay",
+        str(tmp_path / "snapshot.json"),
+        "--iterations=1",
+        verbosity=2,
+        stdout=out,
+    )
+    assert "  * 1 assignments" in out.getvalue()
+    assert " => qemu01" in out.getvalue()
+    assert TestJob.objects.count() == 0